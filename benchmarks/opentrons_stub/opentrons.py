@@ -0,0 +1,24 @@
+# Stand-in for the opentrons package used by the benchmarks to execute generated protocols without a robot or the
+# opentrons simulator. Every attribute and call returns the same stub object, so any API call a template makes
+# succeeds and is counted (in commands). robot.is_simulating() is truthy, so templates use their modelled clock.
+
+commands = [0]
+
+class Stub:
+	def __getattr__(self, name):
+		return self
+
+	def __call__(self, *args, **kwargs):
+		commands[0] += 1
+		return self
+
+	def __getitem__(self, key):
+		return self
+
+	def __iter__(self):
+		return iter([])
+
+robot = Stub()
+instruments = Stub()
+labware = Stub()
+modules = Stub()
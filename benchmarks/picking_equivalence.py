@@ -0,0 +1,342 @@
+import argparse
+import copy
+import importlib
+import json
+import math
+import random
+import sys
+import time
+from benchmarks import picking_reference
+from ot2_moclo_jove.colony_picking import colony_pick_generator
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Functions of the picking core an engine can provide. Each is checked against the frozen copy in picking_reference.py
+# on the same inputs.
+CORE_FUNCTIONS = ['get_relative_locations', 'get_colonies_in_region', 'measure_colony_distances', 'pick_colonies']
+
+# Engines checked by default. More can be added with --engine (any importable module providing some of
+# CORE_FUNCTIONS). An engine may declare DOCUMENTED_DIFFERENCES, a dict of function name to a description of how its
+# results are allowed to differ from the reference; differences in those functions are reported but don't fail.
+DEFAULT_ENGINES = {'generator': colony_pick_generator}
+
+# Largest difference in mm (or mm^2) between results that still counts as the same, so engines may compute in a
+# different order than the reference.
+DEFAULT_TOLERANCE = 1e-9
+
+# Culture block sizes picks are placed in. Small blocks make picks spill over into several blocks.
+BLOCK_SIZES = [(8, 12), (4, 3), (2, 2)]
+
+# Share of detections OpenCFU marks invalid, share of valid ones that are exact duplicates of another (so their
+# scores tie), and share of plate map cells left blank.
+INVALID_SHARE = 0.1
+DUPLICATE_SHARE = 0.05
+BLANK_SHARE = 0.2
+
+
+#################################################################################################################
+# Main function of script
+#################################################################################################################
+
+def main():
+	args = parse_args()
+	engines = dict(DEFAULT_ENGINES)
+	for module_name in args.engine:
+		engines[module_name] = importlib.import_module(module_name)
+
+	cases = [generate_case(random.Random('{0} {1}'.format(args.seed, i)), args.colonies) for i in range(0, args.cases)]
+	results = check_engines(engines, cases, args.repeat, args.tolerance)
+
+	failures = report(results, args.seed)
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			json.dump(results, output_file, indent=1, sort_keys=True)
+	sys.exit(1 if failures else 0)
+
+
+#################################################################################################################
+# Functions for getting user input
+#################################################################################################################
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Checks that faster implementations (engines) of the colony picking core pick the same colonies into the same wells as a frozen copy of the original code, on randomized plates, and times each against it.')
+	parser.add_argument('--engine', action='append', default=[], help='Module of an extra engine to check (may be given more than once).')
+	parser.add_argument('--cases', type=int, default=50, help='Number of randomized cases (sets of plates, regions and detections).')
+	parser.add_argument('--colonies', type=int, default=200, help='Detections per plate.')
+	parser.add_argument('--seed', default='0', help='Seed of the randomized cases. Case i of a seed is always the same.')
+	parser.add_argument('--repeat', type=int, default=3, help='Runs of each function on all cases (the fastest is kept).')
+	parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Largest difference in mm between results that counts as the same.')
+	parser.add_argument('--output', help='Also write the results (differences and speedups) to this JSON file.')
+	return parser.parse_args()
+
+
+#################################################################################################################
+# Functions for generating randomized cases
+#################################################################################################################
+
+# Returns random colony regions (a circle or rectangle grid, as in settings.yaml).
+def generate_colony_regions(generator):
+	x_spacing = generator.uniform(8, 40)
+	y_spacing = generator.uniform(6, 12)
+	colony_regions = {
+		'rows': generator.randint(1, 8),
+		'columns': generator.randint(1, 4),
+		'x_spacing': x_spacing,
+		'y_spacing': y_spacing
+	}
+	if generator.random() < 0.5:
+		colony_regions.update({
+			'type': 'circle',
+			'x': generator.uniform(5, 15),
+			'y': generator.uniform(5, 15),
+			'r': generator.uniform(1, min(x_spacing, y_spacing) / 2)})
+	else:
+		x_1 = generator.uniform(5, 15)
+		y_1 = generator.uniform(5, 15)
+		colony_regions.update({
+			'type': 'rectangle',
+			'x_1': x_1,
+			'y_1': y_1,
+			'x_2': x_1 + generator.uniform(1, x_spacing - 1),
+			'y_2': y_1 + generator.uniform(1, y_spacing - 1)})
+	return colony_regions
+
+# Returns OpenCFU output rows for num_colonies detections scattered over (and just around) the colony regions, in
+# the pixel coordinates of a plate at plate_location rotated by rotate.
+def generate_opencfu_output(generator, num_colonies, colony_regions, plate_location, rotate, pixels_per_mm, plate_origin):
+	x_min, y_min, x_max, y_max = colony_pick_generator.get_colony_regions_extent(colony_regions)
+	opencfu_output = []
+	for i in range(0, num_colonies):
+		if opencfu_output and generator.random() < DUPLICATE_SHARE:
+			opencfu_output.append(dict(generator.choice(opencfu_output)))
+			continue
+
+		# Detections are generated in mm relative to the plate origin and mapped into the image as
+		# get_relative_locations expects (see get_image_location).
+		px_x, px_y = colony_pick_generator.get_image_location(
+			generator.uniform(x_min - 2, x_max + 2) - plate_origin['x'],
+			generator.uniform(y_min - 2, y_max + 2) - plate_origin['y'],
+			plate_location,
+			rotate,
+			pixels_per_mm,
+			plate_origin)
+		radius = generator.uniform(1, 12)
+		opencfu_output.append({
+			'X': '{0:.2f}'.format(px_x),
+			'Y': '{0:.2f}'.format(px_y),
+			'IsValid': '0' if generator.random() < INVALID_SHARE else '1',
+			'Radius': '{0:.2f}'.format(radius) if generator.random() < 0.9 else '',
+			'Area': '{0:.1f}'.format(math.pi * radius**2 * generator.uniform(0.6, 1.1)) if generator.random() < 0.9 else ''})
+	return opencfu_output
+
+# Returns a plate map for colony_regions with some cells blank and some rows cut short.
+def generate_source_plate_map(generator, colony_regions, plate_index):
+	plate_map = []
+	for row in range(0, colony_regions['rows']):
+		columns = colony_regions['columns'] if generator.random() < 0.9 else generator.randint(0, colony_regions['columns'])
+		plate_map.append(['' if generator.random() < BLANK_SHARE else 'plasmid_{0}_{1}_{2}'.format(plate_index, row, column) for column in range(0, columns)])
+	return plate_map
+
+# Returns culture block maps already holding num_picks picks, filled as pick_colonies fills them.
+def generate_culture_blocks(num_picks, block_rows, block_columns):
+	culture_blocks_dict = {'culture_block_0': [[]]}
+	for k in range(0, num_picks):
+		n, position = divmod(k, block_rows * block_columns)
+		j, i = divmod(position, block_rows)
+		block_map = culture_blocks_dict.setdefault('culture_block_{0}'.format(n), [])
+		if i == len(block_map):
+			block_map.append([])
+		block_map[i].append({'name': 'earlier_{0}'.format(k), 'source': 'earlier_plate', 'x': 0.0, 'y': 0.0})
+	return culture_blocks_dict
+
+# Returns one randomized case: the plates (with their OpenCFU output and calibration), colony regions and picking
+# settings, as the generator would pass them.
+def generate_case(generator, num_colonies):
+	colony_regions = generate_colony_regions(generator)
+	plate_origin = {'x': generator.uniform(0, 3), 'y': generator.uniform(0, 3)}
+	block_rows, block_columns = generator.choice(BLOCK_SIZES)
+	weights = generator.choice([None, {}, {'isolation': 1, 'radius': 2, 'edge': 0.5, 'circularity': 1}, {'isolation': 0, 'radius': 1, 'edge': 0, 'circularity': 0}])
+
+	plates = []
+	for i in range(0, generator.randint(1, 3)):
+		plate_location = {'x': generator.uniform(500, 2500), 'y': generator.uniform(500, 2500)}
+		rotate = generator.uniform(-180, 180)
+		pixels_per_mm = generator.uniform(5, 15)
+		plates.append({
+			'source_plate_name': 'plate_{0}'.format(i),
+			'source_plate_map': generate_source_plate_map(generator, colony_regions, i),
+			'opencfu_output': generate_opencfu_output(generator, num_colonies, colony_regions, plate_location, rotate, pixels_per_mm, plate_origin),
+			'location_in_image': plate_location,
+			'rotate': rotate,
+			'pixels_per_mm': pixels_per_mm})
+
+	return {
+		'plates': plates,
+		'colony_regions': colony_regions,
+		'plate_origin': plate_origin,
+		'colonies_to_pick': generator.randint(1, 4),
+		'block_rows': block_rows,
+		'block_columns': block_columns,
+		'pick_weights': weights,
+		'radius_range_mm': generator.choice([(0, float('inf')), (0.3, 1.5)]),
+		'earlier_picks': generator.choice([0, 0, generator.randint(1, 2 * block_rows * block_columns)])
+	}
+
+
+#################################################################################################################
+# Functions for checking engines
+#################################################################################################################
+
+# Returns the arguments of each call of a core function made for a case, in the order the generator makes them. Calls
+# after get_relative_locations use the reference's colony locations, so a difference is put down to the function that
+# made it. Each call gets its own copy of anything the function may change.
+def get_calls(function_name, case):
+	plates = []
+	for plate in case['plates']:
+		plates.append(dict(plate, colony_locations=picking_reference.get_relative_locations(
+			plate['opencfu_output'], plate['location_in_image'], plate['rotate'], plate['pixels_per_mm'], case['plate_origin'])))
+
+	calls = []
+	if function_name == 'get_relative_locations':
+		for plate in plates:
+			calls.append((plate['opencfu_output'], plate['location_in_image'], plate['rotate'], plate['pixels_per_mm'], case['plate_origin']))
+	elif function_name == 'get_colonies_in_region':
+		for plate in plates:
+			for i in range(0, case['colony_regions']['rows']):
+				for j in range(0, case['colony_regions']['columns']):
+					calls.append((plate['colony_locations'], case['colony_regions'], case['plate_origin'], i, j))
+	elif function_name == 'measure_colony_distances':
+		for plate in plates:
+			for i in range(0, case['colony_regions']['rows']):
+				for j in range(0, case['colony_regions']['columns']):
+					calls.append((picking_reference.get_colonies_in_region(plate['colony_locations'], case['colony_regions'], case['plate_origin'], i, j),))
+	elif function_name == 'pick_colonies':
+		calls.append((
+			[dict((x, plate[x]) for x in ('source_plate_name', 'source_plate_map', 'colony_locations')) for plate in plates],
+			case['colony_regions'],
+			case['colonies_to_pick'],
+			case['block_rows'],
+			case['block_columns'],
+			case['plate_origin'],
+			case['pick_weights'],
+			case['radius_range_mm'],
+			generate_culture_blocks(case['earlier_picks'], case['block_rows'], case['block_columns'])))
+	return calls
+
+# Returns the path (e.g. [2, 'x']) to the first place a and b differ by more than tolerance, or None if they match.
+def find_difference(a, b, tolerance, path=()):
+	if isinstance(a, float) and isinstance(b, (int, float)) or isinstance(b, float) and isinstance(a, (int, float)):
+		return None if abs(a - b) <= tolerance or a == b else list(path)
+	if isinstance(a, dict) and isinstance(b, dict):
+		if sorted(a) != sorted(b):
+			return list(path) + ['keys']
+		for key in sorted(a):
+			difference = find_difference(a[key], b[key], tolerance, path + (key,))
+			if difference is not None:
+				return difference
+		return None
+	if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+		if len(a) != len(b):
+			return list(path) + ['length']
+		for i, (x, y) in enumerate(zip(a, b)):
+			difference = find_difference(x, y, tolerance, path + (i,))
+			if difference is not None:
+				return difference
+		return None
+	return None if a == b else list(path)
+
+# Calls function on a fresh copy of the arguments of each call repeat times, and returns the results of the last run
+# and the fastest total time in seconds. Copying is not timed.
+def time_calls(function, calls, repeat):
+	best = None
+	for k in range(0, repeat):
+		arguments = copy.deepcopy(calls)
+		results = []
+		start_time = time.perf_counter()
+		for call in arguments:
+			results.append(function(*call))
+		seconds = time.perf_counter() - start_time
+		best = seconds if best is None else min(best, seconds)
+	return results, best
+
+# Checks each engine's core functions against the reference on every case. Returns, for each engine and function,
+# the number of cases checked, the cases that differ (with where), whether differences are documented, and the time
+# of the engine and the reference.
+def check_engines(engines, cases, repeat, tolerance):
+	calls_by_function = dict((x, [get_calls(x, case) for case in cases]) for x in CORE_FUNCTIONS)
+	results = {}
+	for function_name in CORE_FUNCTIONS:
+		reference_results = []
+		reference_seconds = 0.0
+		for calls in calls_by_function[function_name]:
+			case_results, seconds = time_calls(getattr(picking_reference, function_name), calls, repeat)
+			reference_results.append(case_results)
+			reference_seconds += seconds
+
+		for engine_name, engine in engines.items():
+			function = getattr(engine, function_name, None)
+			if function is None:
+				continue
+			documented = getattr(engine, 'DOCUMENTED_DIFFERENCES', {}).get(function_name)
+			differences = []
+			engine_seconds = 0.0
+			for i, (calls, expected) in enumerate(zip(calls_by_function[function_name], reference_results)):
+				case_results, seconds = time_calls(function, calls, repeat)
+				engine_seconds += seconds
+				difference = find_difference(expected, case_results, tolerance)
+				if difference is not None:
+					differences.append({'case': i, 'path': difference})
+			results.setdefault(engine_name, {})[function_name] = {
+				'cases': len(cases),
+				'differences': differences,
+				'documented': documented,
+				'seconds': engine_seconds,
+				'reference_seconds': reference_seconds,
+				'speedup': reference_seconds / engine_seconds if engine_seconds else None
+			}
+	return results
+
+
+#################################################################################################################
+# Functions for reporting
+#################################################################################################################
+
+# Prints whether each engine matches the reference and its speedup. Returns the (engine, function) pairs with
+# differences that the engine doesn't document.
+def report(results, seed):
+	failures = []
+	for engine_name, functions in sorted(results.items()):
+		for function_name in CORE_FUNCTIONS:
+			if not function_name in functions:
+				continue
+			result = functions[function_name]
+			if not result['differences']:
+				verdict = 'same on {0} cases'.format(result['cases'])
+			else:
+				first = result['differences'][0]
+				# The first step of the path is the call within the case.
+				verdict = 'DIFFERENT on {0} of {1} cases (first: case {2} of seed {3}, call {4} at {5})'.format(
+					len(result['differences']), result['cases'], first['case'], seed, first['path'][0], '/'.join(str(x) for x in first['path'][1:]) or 'result')
+				if result['documented']:
+					verdict += ', documented: {0}'.format(result['documented'])
+				else:
+					failures.append((engine_name, function_name))
+			print('{0} {1}: {2}, {3:.4f} s vs {4:.4f} s reference ({5})'.format(
+				engine_name,
+				function_name,
+				verdict,
+				result['seconds'],
+				result['reference_seconds'],
+				'{0:.2f}x'.format(result['speedup']) if result['speedup'] else 'not timed'))
+	return failures
+
+
+#################################################################################################################
+# Call main function
+#################################################################################################################
+
+if __name__ == '__main__':
+	main()
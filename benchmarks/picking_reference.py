@@ -0,0 +1,147 @@
+import heapq
+import math
+
+
+#################################################################################################################
+# Frozen reference of the colony picking core
+#################################################################################################################
+
+# Copies of the picking functions of colony_pick_generator as they were when picking_equivalence.py was written, so
+# faster implementations can be checked against them (see picking_equivalence.py). Do not change these to match the
+# generator: a change in picks should show up as a difference in the harness, and be documented by the engine that
+# makes it. Only the instrumentation counters have been left out.
+
+DEFAULT_PICK_WEIGHTS = {'isolation': 1, 'radius': 0, 'edge': 0, 'circularity': 0}
+
+def get_relative_locations(opencfu_output, plate_location, rotate, pixels_per_mm, plate_origin):
+	relative_locations = []
+	for row in opencfu_output:
+		if row['IsValid'] == '1':
+			x = float(row['X'])
+			y = float(row['Y'])
+
+			translated_x = x - plate_location['x']
+			translated_y = y - plate_location['y']
+			cosine = math.cos(math.radians(rotate))
+			sine = math.sin(math.radians(rotate))
+			rotated_x = translated_x*cosine - translated_y*sine
+			rotated_y = translated_y*cosine + translated_x*sine
+			mm_x = rotated_x / pixels_per_mm
+			mm_y = rotated_y / pixels_per_mm
+
+			adjusted_x = mm_x - plate_origin['x']
+			adjusted_y = mm_y - plate_origin['y']
+
+			location = {'x': adjusted_x, 'y': adjusted_y}
+			if row.get('Radius'):
+				location['radius'] = float(row['Radius']) / pixels_per_mm
+			if row.get('Area'):
+				location['area'] = float(row['Area']) / pixels_per_mm**2
+			relative_locations.append(location)
+
+	return relative_locations
+
+def measure_colony_distances(colony_list):
+	colonies_with_distances = []
+	for colony_1 in colony_list:
+		colonies_with_distances.append(colony_1)
+		colonies_with_distances[-1]['dist'] = 10000
+		for colony_2 in colony_list:
+			if not colony_1 == colony_2:
+				dist = ((colony_2['x']-colony_1['x'])**2 + (colony_2['y']-colony_1['y'])**2)**0.5
+				if dist < colonies_with_distances[-1]['dist']:
+					colonies_with_distances[-1]['dist'] = dist
+
+	return colonies_with_distances
+
+def get_plasmid_name(source_plate_map, row, column):
+	try:
+		plasmid_name = source_plate_map[row][column]
+	except IndexError:
+		plasmid_name = ''
+
+	return plasmid_name
+
+def get_region_edge_distance(colony, colony_regions, plate_origin, i, j):
+	if colony_regions['type'] == 'circle':
+		target_x = colony_regions['x'] + j*colony_regions['x_spacing'] - plate_origin['x']
+		target_y = colony_regions['y'] + i*colony_regions['y_spacing'] - plate_origin['y']
+		delta_x = colony['x'] - target_x
+		delta_y = colony['y'] - target_y
+		return colony_regions['r'] - (delta_x**2 + delta_y**2)**0.5
+
+	elif colony_regions['type'] == 'rectangle':
+		x_min = colony_regions['x_1'] + j*colony_regions['x_spacing'] - plate_origin['x']
+		x_max = colony_regions['x_2'] + j*colony_regions['x_spacing'] - plate_origin['x']
+		y_min = colony_regions['y_1'] + i*colony_regions['y_spacing'] - plate_origin['y']
+		y_max = colony_regions['y_2'] + i*colony_regions['y_spacing'] - plate_origin['y']
+		return min(colony['x'] - x_min, x_max - colony['x'], colony['y'] - y_min, y_max - colony['y'])
+
+	else:
+		raise ValueError('Invalid colony_regions type: {0}'.format(colony_regions['type']))
+
+def get_colonies_in_region(colony_locations, colony_regions, plate_origin, i, j):
+	colonies_in_region = []
+	for colony in colony_locations:
+		edge_dist = get_region_edge_distance(colony, colony_regions, plate_origin, i, j)
+		if edge_dist > 0:
+			colony['edge_dist'] = edge_dist
+			colonies_in_region.append(colony)
+
+	return colonies_in_region
+
+def score_colonies(colonies, pick_weights, radius_range_mm):
+	scores = []
+	for colony in colonies:
+		radius = colony.get('radius')
+		area = colony.get('area')
+		radius_in_range = 1.0 if radius is not None and radius_range_mm[0] <= radius <= radius_range_mm[1] else 0.0
+		circularity = min(area / (math.pi * radius**2), 1.0) if radius and area is not None else 0.0
+		scores.append(
+			pick_weights['isolation'] * colony['dist']
+			+ pick_weights['radius'] * radius_in_range
+			+ pick_weights['edge'] * colony['edge_dist']
+			+ pick_weights['circularity'] * circularity)
+
+	return scores
+
+def select_colonies(colonies, colonies_to_pick, pick_weights, radius_range_mm):
+	scores = score_colonies(colonies, pick_weights, radius_range_mm)
+	best = heapq.nlargest(colonies_to_pick, range(0, len(colonies)), key=lambda x: scores[x])
+	return [colonies[x] for x in best]
+
+def pick_colonies(plates, colony_regions, colonies_to_pick, block_rows, block_columns, calibration_point_location, pick_weights=None, radius_range_mm=(0, float('inf')), culture_blocks_dict=None):
+	pick_weights = dict(DEFAULT_PICK_WEIGHTS, **(pick_weights or {}))
+
+	if culture_blocks_dict is None:
+		culture_blocks_dict = {'culture_block_0': [[]]}
+	num_picks = sum(len(row) for block_map in culture_blocks_dict.values() for row in block_map)
+
+	for plate in plates:
+		for row in range(0, colony_regions['rows']):
+			for col in range(0, colony_regions['columns']):
+
+				plasmid_name = get_plasmid_name(plate['source_plate_map'], row, col)
+
+				if plasmid_name:
+					colonies = get_colonies_in_region(plate['colony_locations'], colony_regions, calibration_point_location, row, col)
+					colonies_with_distances = measure_colony_distances(colonies)
+					selected_colonies = select_colonies(colonies_with_distances, colonies_to_pick, pick_weights, radius_range_mm)
+
+					for colony in selected_colonies:
+						colony_dict = {
+							'name': plasmid_name,
+							'source': plate['source_plate_name'],
+							'x': colony['x'],
+							'y': -colony['y']
+						}
+
+						n, position = divmod(num_picks, block_rows * block_columns)
+						j, i = divmod(position, block_rows)
+						block_map = culture_blocks_dict.setdefault('culture_block_{0}'.format(n), [])
+						if i == len(block_map):
+							block_map.append([])
+						block_map[i].append(colony_dict)
+						num_picks += 1
+
+	return culture_blocks_dict
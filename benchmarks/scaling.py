@@ -0,0 +1,284 @@
+import argparse
+import csv
+import math
+import os
+import random
+import runpy
+import sys
+import tempfile
+import time
+from ot2_moclo_jove import pipeline
+from ot2_moclo_jove.moclo_transform import moclo_transform_generator
+from ot2_moclo_jove.miniprep import miniprep_generator
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Numbers of assemblies to benchmark the stages that don't need a deck with, all in one piece.
+DEFAULT_SIZES = [48, 200, 1000, 3000, 10000]
+
+# Numbers of assemblies in a single run, up to what the deck holds (see get_moclo_run_size). Each run is generated with
+# the settings in settings.yaml, so the reaction and deck layout optimizers are on.
+DEFAULT_RUN_SIZES = [8, 16, 24, 32, 40, 48]
+
+# Largest allowed growth of each stage with the number of assemblies, as the exponent k in time ~ n^k (fitted on a
+# log-log scale). Emitted file sizes are budgeted the same way. Stages starting with run_ are fitted over the run
+# sizes. Each budget is the highest exponent measured from 48 to 10,000 assemblies (or from 8 to 48 in a run) plus a
+# margin for timing noise. Within a run most of the time is fixed, so those exponents are low. Optimizing the reaction
+# layout grows as about n^3 (each swap pass compares every pair of wells), which the 48 wells of a run keep small.
+COMPLEXITY_BUDGETS = {
+	'moclo_read_inputs': 1.2,
+	'moclo_plate_maps': 1.3,
+	'moclo_dna_reformat': 1.2,
+	'run_moclo_generate': 1.0,
+	'run_reaction_layout': 3.5,
+	'run_deck_layout': 0.9,
+	'run_moclo_protocol_bytes': 0.2,
+	'run_moclo_simulate': 0.9,
+	'run_miniprep_generate': 0.5,
+	'run_miniprep_protocol_bytes': 0.2,
+	'run_miniprep_simulate': 0.5
+}
+
+# Stages faster than this (in seconds) at every size are too noisy to fit and are only reported.
+MIN_FIT_SECONDS = 0.0005
+
+# Parts per assembly and DNA plates (of 96 parts each) in the synthetic inputs.
+PARTS_PER_ASSEMBLY = 4
+NUM_DNA_PLATES = 2
+
+STUB_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opentrons_stub')
+
+
+#################################################################################################################
+# Main function of script
+#################################################################################################################
+
+def main():
+	args = parse_args()
+	results = {}
+	with tempfile.TemporaryDirectory() as folder:
+		for n in args.sizes:
+			for stage_name, value in benchmark_size(n, folder, args.repeat).items():
+				results.setdefault(stage_name, {})[n] = value
+			print('{0} assemblies done'.format(n), file=sys.stderr)
+		for n in args.run_sizes:
+			for stage_name, value in benchmark_run(n, folder, args.repeat).items():
+				results.setdefault(stage_name, {})[n] = value
+			print('Run of {0} assemblies done'.format(n), file=sys.stderr)
+
+	failures = report(results)
+	sys.exit(1 if failures else 0)
+
+
+#################################################################################################################
+# Functions for getting user input
+#################################################################################################################
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Times the MoClo and miniprep generators and their protocols on synthetic inputs of increasing size, and fails if any stage grows faster than its complexity budget.')
+	parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of assemblies to benchmark the stages that don\'t need a deck with.')
+	parser.add_argument('--run-sizes', type=int, nargs='+', default=DEFAULT_RUN_SIZES, help='Numbers of assemblies in a single run to benchmark the generators and protocols with.')
+	parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage at each size (the fastest is kept).')
+	return parser.parse_args()
+
+
+#################################################################################################################
+# Functions for generating synthetic inputs
+#################################################################################################################
+
+# Writes NUM_DNA_PLATES 8x12 DNA plate maps and a combinations file of n assemblies (each of PARTS_PER_ASSEMBLY
+# distinct parts) to folder. Returns the plate map filenames and the combinations filename.
+def write_synthetic_inputs(n, folder):
+	dna_plate_map_filenames = []
+	parts = []
+	for plate in range(0, NUM_DNA_PLATES):
+		plate_map = [['part_{0}_{1}'.format(plate, row * 12 + column) for column in range(0, 12)] for row in range(0, 8)]
+		parts += [name for row in plate_map for name in row]
+		dna_plate_map_filenames.append(os.path.join(folder, 'dna_plate_{0}.csv'.format(plate)))
+		with open(dna_plate_map_filenames[-1], 'w+', newline='') as f:
+			csv.writer(f).writerows(plate_map)
+
+	generator = random.Random(n)
+	combinations_filename = os.path.join(folder, 'combinations_{0}.csv'.format(n))
+	with open(combinations_filename, 'w+', newline='') as f:
+		writer = csv.writer(f)
+		for i in range(0, n):
+			writer.writerow(['assembly_{0}'.format(i)] + generator.sample(parts, PARTS_PER_ASSEMBLY))
+
+	return dna_plate_map_filenames, combinations_filename
+
+# Culture block maps (as passed to miniprep_generator.run) for n colonies, 96 per block.
+def get_synthetic_culture_blocks(n):
+	culture_blocks_dict = {}
+	for i in range(0, n):
+		block_map = culture_blocks_dict.setdefault('culture_block_{0}'.format(i // 96), [])
+		if i % 96 % 8 == 0:
+			block_map.append([])
+		block_map[-1].append({'name': 'assembly_{0}'.format(i), 'source': 'Agar_plate_{0}'.format(i // 24), 'x': 10.0, 'y': -10.0})
+	return miniprep_generator.plate_maps_from_culture_blocks(culture_blocks_dict)
+
+
+#################################################################################################################
+# Functions for timing stages
+#################################################################################################################
+
+# Runs function repeat times and returns the fastest time in seconds (and the result of the last run).
+def time_best(function, repeat):
+	best = None
+	for i in range(0, repeat):
+		start_time = time.perf_counter()
+		result = function()
+		seconds = time.perf_counter() - start_time
+		best = seconds if best is None else min(best, seconds)
+	return best, result
+
+# Executes a generated protocol with the stub opentrons module in place of the real one.
+def simulate_protocol(protocol_filename):
+	sys.path.insert(0, STUB_FOLDER)
+	saved_module = sys.modules.pop('opentrons', None)
+	try:
+		runpy.run_path(protocol_filename, run_name='__main__')
+	finally:
+		sys.path.remove(STUB_FOLDER)
+		sys.modules.pop('opentrons', None)
+		if saved_module:
+			sys.modules['opentrons'] = saved_module
+
+# Returns True if a protocol compiles (the miniprep template is not always runnable).
+def compiles(protocol_filename):
+	try:
+		with open(protocol_filename) as f:
+			compile(f.read(), protocol_filename, 'exec')
+	except SyntaxError:
+		return False
+	return True
+
+# Assemblies in one MoClo run: the reactions whose columns fit on the agar plates left on the deck next to the DNA
+# plates (see get_agar_layout), and at most one half of the reaction plate.
+def get_moclo_run_size(dna_plate_map_dict, config):
+	max_plates = moclo_transform_generator.get_max_agar_plates(dna_plate_map_dict)
+	per_plate = config['agar_plate_columns'] // config['spots_per_reaction']
+	return min(moclo_transform_generator.REACTION_WELLS, max_plates * per_plate * moclo_transform_generator.ROWS)
+
+# Benchmarks the MoClo stages that work on all n assemblies at once, without a deck: reading the inputs, the agar plate
+# maps and the DNA reformat. Returns the time in seconds of each stage.
+def benchmark_size(n, folder, repeat):
+	results = {}
+	output_folder_path = os.path.join(folder, str(n))
+	os.makedirs(output_folder_path, exist_ok=True)
+	dna_plate_map_filenames, combinations_filename = write_synthetic_inputs(n, folder)
+
+	config = pipeline.load_stage_config(moclo_transform_generator, output_folder_path)
+	results['moclo_read_inputs'], (dna_plate_map_dict, combinations_to_make) = time_best(
+		lambda: (moclo_transform_generator.generate_plate_maps(dna_plate_map_filenames), moclo_transform_generator.generate_combinations(combinations_filename)),
+		repeat)
+
+	def plate_maps():
+		agar_layout = moclo_transform_generator.get_agar_layout(n, config['spots_per_reaction'], config['agar_plate_columns'])
+		output_plate_maps = moclo_transform_generator.generate_output_plate_maps(combinations_to_make, None, agar_layout)
+		moclo_transform_generator.save_output_plate_maps(output_plate_maps, output_folder_path)
+	results['moclo_plate_maps'] = time_best(plate_maps, repeat)[0]
+
+	results['moclo_dna_reformat'] = time_best(
+		lambda: moclo_transform_generator.get_dna_reformat(dna_plate_map_dict, combinations_to_make, list(range(0, n))),
+		repeat)[0]
+
+	return results
+
+# Benchmarks a single run of n assemblies, which must fit on the deck: the MoClo and miniprep generators with the
+# settings in settings.yaml (with the reaction and deck layout optimizers timed on their own too) and their protocols.
+# Returns the time in seconds (or size in bytes) of each stage, or None for protocols that don't compile.
+def benchmark_run(n, folder, repeat):
+	results = {}
+	output_folder_path = os.path.join(folder, 'run_{0}'.format(n))
+	os.makedirs(output_folder_path, exist_ok=True)
+	dna_plate_map_filenames, combinations_filename = write_synthetic_inputs(n, folder)
+	dna_plate_map_dict = moclo_transform_generator.generate_plate_maps(dna_plate_map_filenames)
+	combinations_to_make = moclo_transform_generator.generate_combinations(combinations_filename)
+
+	###### MOCLO/TRANSFORMATION ######
+	config = pipeline.load_stage_config(moclo_transform_generator, output_folder_path)
+	config['incremental'] = False
+	run_size = get_moclo_run_size(dna_plate_map_dict, config)
+	if n > run_size:
+		raise ValueError('A run of {0} assemblies doesn\'t fit on the deck, which holds {1}.'.format(n, run_size))
+
+	results['run_moclo_generate'] = time_best(lambda: moclo_transform_generator.run(config, dna_plate_map_dict, combinations_to_make), repeat)[0]
+	results['run_reaction_layout'], reaction_wells = time_best(
+		lambda: moclo_transform_generator.get_reaction_wells(combinations_to_make, config['optimize_reaction_layout']),
+		repeat)
+	agar_layout = moclo_transform_generator.get_agar_layout(
+		n,
+		config['spots_per_reaction'],
+		config['agar_plate_columns'],
+		moclo_transform_generator.get_max_agar_plates(dna_plate_map_dict))
+	results['run_deck_layout'] = time_best(
+		lambda: moclo_transform_generator.get_deck_layout(dna_plate_map_dict, combinations_to_make, agar_layout, config['optimize_deck_layout']),
+		repeat)[0]
+	protocol_filename = os.path.join(output_folder_path, 'moclo_transform_protocol.py')
+	results['run_moclo_protocol_bytes'] = os.path.getsize(protocol_filename)
+	results['run_moclo_simulate'] = time_best(lambda: simulate_protocol(protocol_filename), repeat)[0] if compiles(protocol_filename) else None
+
+	###### MINIPREP ######
+	config = pipeline.load_stage_config(miniprep_generator, output_folder_path)
+	config['incremental'] = False
+	results['run_miniprep_generate'] = time_best(lambda: miniprep_generator.run(config, get_synthetic_culture_blocks(n)), repeat)[0]
+	protocol_filename = os.path.join(output_folder_path, 'miniprep_protocol.py')
+	results['run_miniprep_protocol_bytes'] = os.path.getsize(protocol_filename)
+	results['run_miniprep_simulate'] = time_best(lambda: simulate_protocol(protocol_filename), repeat)[0] if compiles(protocol_filename) else None
+
+	return results
+
+
+#################################################################################################################
+# Functions for reporting
+#################################################################################################################
+
+# Least squares slope of log(value) against log(n).
+def fit_exponent(values_by_size):
+	points = [(math.log(n), math.log(value)) for n, value in values_by_size.items() if value > 0]
+	if len(points) < 2:
+		return None
+	mean_x = sum(x for x, y in points) / len(points)
+	mean_y = sum(y for x, y in points) / len(points)
+	variance = sum((x - mean_x)**2 for x, y in points)
+	if not variance:
+		return None
+	return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+# Prints the results and fitted exponent of each stage. Returns the names of stages over their complexity budget.
+def report(results):
+	failures = []
+	for stage_name, values_by_size in results.items():
+		# Only protocols that don't compile are left without a value.
+		if None in values_by_size.values():
+			print('{0}: skipped: template does not compile'.format(stage_name))
+			continue
+
+		is_size = stage_name.endswith('_bytes')
+		values = ', '.join(('{0}: {1}' if is_size else '{0}: {1:.4f} s').format(n, value) for n, value in sorted(values_by_size.items()))
+
+		budget = COMPLEXITY_BUDGETS.get(stage_name)
+		fitted = is_size or max(values_by_size.values()) >= MIN_FIT_SECONDS
+		exponent = fit_exponent(values_by_size) if fitted else None
+		if exponent is None:
+			verdict = 'not fitted'
+		elif budget is not None and exponent > budget:
+			verdict = 'n^{0:.2f} OVER BUDGET n^{1}'.format(exponent, budget)
+			failures.append(stage_name)
+		else:
+			verdict = 'n^{0:.2f} (budget n^{1})'.format(exponent, budget)
+		print('{0}: {1} -> {2}'.format(stage_name, values, verdict))
+
+	return failures
+
+
+#################################################################################################################
+# Call main function
+#################################################################################################################
+
+if __name__ == '__main__':
+	main()
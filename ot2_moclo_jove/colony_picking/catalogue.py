@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# File extensions treated as plate images when indexing a folder. Anything else in the folder is ignored.
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.ppm', '.pgm'}
+
+# Bytes read at a time when hashing an image.
+HASH_CHUNK_SIZE = 1 << 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+	id INTEGER PRIMARY KEY,
+	folder TEXT NOT NULL,
+	filename TEXT NOT NULL UNIQUE,
+	mtime REAL NOT NULL,
+	size INTEGER NOT NULL,
+	content_hash TEXT NOT NULL,
+	status TEXT NOT NULL DEFAULT 'new',
+	present INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS images_by_folder_mtime ON images (folder, present, mtime);
+CREATE INDEX IF NOT EXISTS images_by_hash ON images (content_hash);
+CREATE TABLE IF NOT EXISTS runs (
+	id INTEGER PRIMARY KEY,
+	started TEXT NOT NULL,
+	output_folder_path TEXT,
+	settings TEXT
+);
+CREATE TABLE IF NOT EXISTS run_plates (
+	run_id INTEGER NOT NULL REFERENCES runs (id),
+	image_id INTEGER REFERENCES images (id),
+	plate_name TEXT NOT NULL,
+	plate_index INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS run_plates_by_run ON run_plates (run_id);
+CREATE INDEX IF NOT EXISTS run_plates_by_image ON run_plates (image_id);
+CREATE TABLE IF NOT EXISTS detections (
+	run_id INTEGER NOT NULL REFERENCES runs (id),
+	plate_name TEXT NOT NULL,
+	x REAL NOT NULL,
+	y REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS detections_by_run ON detections (run_id, plate_name);
+CREATE TABLE IF NOT EXISTS picks (
+	run_id INTEGER NOT NULL REFERENCES runs (id),
+	block_name TEXT NOT NULL,
+	block_row INTEGER NOT NULL,
+	position INTEGER NOT NULL,
+	colony TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS picks_by_run ON picks (run_id, block_name, block_row, position);
+'''
+
+
+#################################################################################################################
+# Opening the catalogue
+#################################################################################################################
+
+# Opens (creating if needed) the catalogue database at catalogue_path.
+def open_catalogue(catalogue_path):
+	connection = sqlite3.connect(catalogue_path)
+	connection.row_factory = sqlite3.Row
+	connection.executescript(SCHEMA)
+	return connection
+
+
+#################################################################################################################
+# Indexing images
+#################################################################################################################
+
+def get_content_hash(filename):
+	content_hash = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+			content_hash.update(chunk)
+	return content_hash.hexdigest()
+
+# Brings the catalogue up to date with the images in image_folder_path. The folder is listed every time (an image
+# rewritten in place doesn't change the folder's mtime), but files are only hashed if they are new or their mtime or
+# size has changed. Files that have disappeared are marked as no longer present. Returns the number of images added
+# or updated.
+def update_catalogue(connection, image_folder_path):
+	folder = os.path.abspath(image_folder_path)
+	known = {}
+	for image in connection.execute('SELECT filename, mtime, size FROM images WHERE folder = ?', (folder,)):
+		known[image['filename']] = (image['mtime'], image['size'])
+
+	num_updated = 0
+	seen = set()
+	with connection:
+		for entry in os.scandir(folder):
+			if not entry.is_file() or not os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+				continue
+			stat = entry.stat()
+			filename = entry.path
+			seen.add(filename)
+			if known.get(filename) == (stat.st_mtime, stat.st_size):
+				continue
+			connection.execute(
+				'INSERT INTO images (folder, filename, mtime, size, content_hash) VALUES (?, ?, ?, ?, ?) '
+				'ON CONFLICT (filename) DO UPDATE SET mtime = excluded.mtime, size = excluded.size, '
+				'content_hash = excluded.content_hash, status = \'new\', present = 1',
+				(folder, filename, stat.st_mtime, stat.st_size, get_content_hash(filename)))
+			num_updated += 1
+
+		missing = [(x,) for x in known if not x in seen]
+		connection.executemany('UPDATE images SET present = 0 WHERE filename = ?', missing)
+
+	return num_updated
+
+# Returns the filenames of the num_images most recent images (by mtime) in image_folder_path, oldest first. Copies of
+# the same image (same content hash) are only counted once.
+def select_images(connection, image_folder_path, num_images):
+	rows = connection.execute(
+		'SELECT filename FROM images WHERE folder = ? AND present = 1 AND id IN '
+		'(SELECT MAX(id) FROM images WHERE folder = ? AND present = 1 GROUP BY content_hash) '
+		'ORDER BY mtime DESC LIMIT ?',
+		(os.path.abspath(image_folder_path), os.path.abspath(image_folder_path), num_images)).fetchall()
+	return [row['filename'] for row in reversed(rows)]
+
+def set_image_status(connection, image_filenames, status):
+	with connection:
+		connection.executemany('UPDATE images SET status = ? WHERE filename = ?', [(status, os.path.abspath(x)) for x in image_filenames])
+
+
+#################################################################################################################
+# Recording and reloading runs
+#################################################################################################################
+
+# Records the plates (with the images they came from and their colony locations in mm) and the picked colonies
+# (culture_blocks_dict, see pick_colonies) of a run. Returns the id of the run.
+def record_run(connection, plates, culture_blocks_dict, output_folder_path=None, settings=None):
+	with connection:
+		run_id = connection.execute(
+			'INSERT INTO runs (started, output_folder_path, settings) VALUES (?, ?, ?)',
+			(time.strftime('%Y-%m-%dT%H:%M:%S'), output_folder_path, json.dumps(settings))).lastrowid
+
+		for plate_index, plate in enumerate(plates):
+			image = connection.execute('SELECT id FROM images WHERE filename = ?', (os.path.abspath(plate['source_image_filename']),)).fetchone()
+			connection.execute(
+				'INSERT INTO run_plates (run_id, image_id, plate_name, plate_index) VALUES (?, ?, ?, ?)',
+				(run_id, image['id'] if image else None, plate['source_plate_name'], plate_index))
+			connection.executemany(
+				'INSERT INTO detections (run_id, plate_name, x, y) VALUES (?, ?, ?, ?)',
+				[(run_id, plate['source_plate_name'], colony['x'], colony['y']) for colony in plate['colony_locations']])
+
+		for block_name, block_map in culture_blocks_dict.items():
+			for block_row, row in enumerate(block_map):
+				connection.executemany(
+					'INSERT INTO picks (run_id, block_name, block_row, position, colony) VALUES (?, ?, ?, ?, ?)',
+					[(run_id, block_name, block_row, position, json.dumps(colony)) for position, colony in enumerate(row)])
+	return run_id
+
+def list_runs(connection, limit=20):
+	return [dict(row) for row in connection.execute(
+		'SELECT runs.id, runs.started, runs.output_folder_path, COUNT(run_plates.plate_name) AS plates FROM runs '
+		'LEFT JOIN run_plates ON run_plates.run_id = runs.id GROUP BY runs.id ORDER BY runs.id DESC LIMIT ?', (limit,))]
+
+# Returns the culture blocks dict picked in a run.
+def load_picks(connection, run_id):
+	culture_blocks_dict = {}
+	for row in connection.execute('SELECT block_name, block_row, colony FROM picks WHERE run_id = ? ORDER BY rowid', (run_id,)):
+		block_map = culture_blocks_dict.setdefault(row['block_name'], [])
+		while len(block_map) <= row['block_row']:
+			block_map.append([])
+		block_map[row['block_row']].append(json.loads(row['colony']))
+	return culture_blocks_dict
+
+# Returns the colony locations (in mm, see get_relative_locations) detected on each plate of a run, keyed by plate name.
+def load_detections(connection, run_id):
+	detections = {}
+	for row in connection.execute('SELECT plate_name, x, y FROM detections WHERE run_id = ? ORDER BY rowid', (run_id,)):
+		detections.setdefault(row['plate_name'], []).append({'x': row['x'], 'y': row['y']})
+	return detections
+
+
+#################################################################################################################
+# List runs or print the picks of an old run from the command line
+# (python -m ot2_moclo_jove.colony_picking.catalogue catalogue.sqlite [--run ID])
+#################################################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='List colony picking runs recorded in a catalogue, or print the picks of one.')
+	parser.add_argument('catalogue_path')
+	parser.add_argument('--run', type=int, help='Print the culture blocks dict picked in this run.')
+	args = parser.parse_args()
+	connection = open_catalogue(args.catalogue_path)
+	if args.run is None:
+		for run in list_runs(connection):
+			print('{id}: {started}, {plates} plate(s), output folder {output_folder_path}'.format(**run))
+	else:
+		print(json.dumps(load_picks(connection, args.run), indent=1))
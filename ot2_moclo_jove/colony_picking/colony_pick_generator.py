@@ -4,11 +4,18 @@ from tkinter import filedialog, messagebox
 import subprocess
 import sys
 from io import StringIO
+import argparse
 import csv
+import heapq
 import json
-from PIL import Image, ImageDraw, ImageFilter, ImageChops, ImageEnhance
+import logging
+from collections import Counter
+from PIL import Image, ImageDraw, ImageFilter, ImageChops, ImageEnhance, ImageStat
 import math
+import time
 import yaml
+from ot2_moclo_jove import deck_layout, incremental, instrumentation, resume_protocol
+from ot2_moclo_jove.colony_picking import catalogue, detection_queue, plate_localization, region_masks, scheduler
 
 
 #################################################################################################################
@@ -17,91 +24,362 @@ import yaml
 
 CONFIG_PATH = "data/settings.yaml"
 
+# File extensions for the formats supported for intermediate (pre-processed) images.
+INTERMEDIATE_IMAGE_EXTENSIONS = {'PNG': '.png', 'TIFF': '.tif', 'BMP': '.bmp', 'PPM': '.ppm'}
+
+# Rough number of strip-sized buffers alive at once while pre-processing one strip in tiled mode (source, blur,
+# contrast, brightness, background crops, blended background and subtraction).
+TILE_WORKING_COPIES = 8
+
+# Weights of the criteria colonies are scored on when picking (see score_colonies). Only isolation counts by default.
+DEFAULT_PICK_WEIGHTS = {'isolation': 1, 'radius': 0, 'edge': 0, 'circularity': 0}
+
+# Rough number of image-sized buffers OpenCFU (and coarse-to-fine detection) holds at once while detecting colonies in
+# one image, and drawing one preview holds.
+OPENCFU_WORKING_COPIES = 4
+PREVIEW_WORKING_COPIES = 2
+
+# Tips in the tip rack of each protocol part.
+TIPS_PER_RACK = 96
+
+# Slots the template used to load labware into (the last one is used first).
+AVAILABLE_DECK_SLOTS = ['11', '10', '9', '8', '7', '6', '5', '4', '3', '2', '1']
+
+# In coarse-to-fine detection (see detect_colonies_coarse_to_fine), downsampled pixels are candidates if they differ
+# from the background by more than COARSE_NOISE_FACTOR times the typical difference (and at least COARSE_MIN_CONTRAST
+# grey levels). Windows keep a margin of COARSE_WINDOW_MARGIN pixels (at full resolution) around each candidate blob,
+# the whole image is detected instead if they would cover more than COARSE_MAX_COVERAGE of it, and they are separated
+# by COARSE_MOSAIC_GAP pixels in the mosaic OpenCFU is run on.
+COARSE_NOISE_FACTOR = 4
+COARSE_MIN_CONTRAST = 8
+COARSE_WINDOW_MARGIN = 16
+COARSE_MAX_COVERAGE = 0.5
+COARSE_MOSAIC_GAP = 16
+
+logger = logging.getLogger(__name__)
+
 
 #################################################################################################################
 # Main function of script
 #################################################################################################################
 
 def main():
+	args = parse_args()
+	write_trace = instrumentation.start_from_arguments('colony_picking', args)
 
 	###### GETTING USER INPUT ######
 	config = get_config(CONFIG_PATH)
 
 	# User provided input at runtime.
 	num_plates = ask_num_plates()
-	source_plate_filenames = ask_source_plate_filenames(num_plates)
+	source_plate_maps = load_source_plate_maps(ask_source_plate_filenames(num_plates))
+
+	run(config, source_plate_maps)
+
+	instrumentation.finish(config['output_folder_path'] if write_trace else None)
+
+# Picks colonies for each of the source plate maps (dicts with a 'name' and the 'map' as a list of rows) from the most
+# recent plate images and writes the block maps and protocol parts. Returns the culture blocks dict (see pick_colonies).
+# Pre-processed images, detections, previews and outputs whose inputs haven't changed since the last run are reused
+# (see incremental.py).
+def run(config, source_plate_maps):
+	num_plates = len(source_plate_maps)
+
+	# Compile (or load) the label mask that colonies are assigned to regions with, and check that every plasmid in the
+	# plate maps has a region to be picked from.
+	with instrumentation.stage('region_mask'):
+		region_mask = region_masks.load_mask(config['colony_regions'], config['region_mask_cache_path'])
+		check_source_plate_maps(source_plate_maps, region_mask)
+
+	manifest = incremental.load_manifest(config['output_folder_path'], 'colony_picking', config['incremental'])
 
 	# Calculate number of images to fetch from folder.
 	plates_per_image = len(config['plate_locations'])
 	num_images = int(num_plates // plates_per_image) + (num_plates % plates_per_image > 0)
-	image_filenames = get_image_filenames(config['image_folder_path'], num_images)
-	
-	background_filenames = get_background_filenames(config['background_folder_path'])
-
-
-	###### PRE-PROCESSING IMAGES ######
-	preprocessed_image_filenames = preprocess_images(
-		image_filenames,
-		config['temp_folder_path'],
-		inverted=config['inverted'],
-		blur_radius=config['blur_radius'],
-		brightness=config['brightness'],
-		contrast=config['contrast'],
-		background_filenames=background_filenames)
+	with instrumentation.stage('get_images'):
+		if config['catalogue_path']:
+			# Index new images incrementally and select the most recent from the catalogue.
+			catalogue_connection = catalogue.open_catalogue(config['catalogue_path'])
+			catalogue.update_catalogue(catalogue_connection, config['image_folder_path'])
+			image_filenames = catalogue.select_images(catalogue_connection, config['image_folder_path'], num_images)
+		else:
+			image_filenames = get_image_filenames(config['image_folder_path'], num_images)
+		background_filenames = get_background_filenames(config['background_folder_path'])
+	instrumentation.count('images', len(image_filenames))
+
+
+	###### LOCATING PLATES ######
+	with instrumentation.stage('locate_plates'):
+		# Fit the location, rotation and scale of each plate in each image, or use the calibration in settings.yaml.
+		plate_calibrations = {}
+		for image_filename in image_filenames:
+			if config['locate_plates']:
+				plate_calibrations[image_filename] = plate_localization.locate_plates(
+					Image.open(image_filename),
+					config['plate_locations'],
+					config['rotate'],
+					config['pixels_per_mm'],
+					config['plate_localization_cache_path'],
+					config['imager_setup'])
+			else:
+				plate_calibrations[image_filename] = [{'location': x, 'rotate': config['rotate'], 'pixels_per_mm': config['pixels_per_mm']} for x in config['plate_locations']]
+
+		plates = generate_plates(image_filenames, source_plate_maps, num_plates, plate_calibrations)
+
+		# Crop each plate to the bounding box of its colony regions so the bench, rims and labels are not processed.
+		for plate in plates:
+			if config['crop_to_plates']:
+				plate['crop_box'] = get_plate_crop_box(
+					plate['location_in_image'],
+					plate['rotate'],
+					plate['pixels_per_mm'],
+					config['colony_regions'],
+					config['crop_margin_mm'],
+					Image.open(plate['image_filename']).size)
+			else:
+				plate['crop_box'] = None
+	instrumentation.count('plates', len(plates))
+
+
+	###### ANALYSING IMAGES AND CREATING PROTOCOL PARTS ######
+	# Images are analysed in batches of images_per_batch (or all at once), and each protocol part is written as soon as
+	# its picks are final, so the robot can start on the first parts while later plates are still being analysed.
+	culture_blocks_dict = {'culture_block_0': [[]]}
+	image_timings = {}
+	num_parts_written = 0
+	batch_size = config['images_per_batch'] or max(len(image_filenames), 1)
+	for batch_start in range(0, len(image_filenames), batch_size):
+		batch_image_filenames = image_filenames[batch_start:batch_start + batch_size]
+		batch_plates = [x for x in plates if x['image_filename'] in batch_image_filenames]
+		image_timings.update(analyse_plates(config, manifest, batch_plates, background_filenames, region_mask))
+
+		# Selects appropriate colonies for each plasmid based on colony_regions in settings.yaml, continuing from the
+		# colonies picked in earlier batches.
+		with instrumentation.stage('pick_colonies'):
+			culture_blocks_dict = pick_colonies(
+				batch_plates, 
+				config['colony_regions'], 
+				config['colonies_to_pick'], 
+				config['block_rows'], 
+				config['block_columns'],
+				config['calibration_point_location'],
+				config['pick_weights'],
+				config['colony_radius_range_mm'],
+				culture_blocks_dict,
+				region_mask)
+
+		with instrumentation.stage('output'):
+			parts = get_protocol_parts(culture_blocks_dict, config['block_rows'], config['block_columns'])
+			if batch_start + batch_size < len(image_filenames):
+				# Only the last part can still get more picks from later batches.
+				parts = parts[:-1] + [x for x in parts[-1:] if x['full']]
+			for part_number in range(num_parts_written + 1, len(parts) + 1):
+				write_protocol_part(config, manifest, parts[part_number - 1], part_number)
+			num_parts_written = len(parts)
+
+	# Record the detections and picks of this run so they can be reloaded later.
+	if config['catalogue_path']:
+		with instrumentation.stage('catalogue'):
+			catalogue.record_run(catalogue_connection, plates, culture_blocks_dict, config['output_folder_path'], config)
+			catalogue.set_image_status(catalogue_connection, image_filenames, 'processed')
+			catalogue_connection.close()
+
+	###### CREATING OUTPUT BLOCK MAPS ######
+	with instrumentation.stage('output'):
+		output_folder_path = config['output_folder_path']
+		incremental.build(
+			manifest,
+			[os.path.join(output_folder_path, '{0}.csv'.format(x)) for x in culture_blocks_dict],
+			culture_blocks_dict,
+			lambda: create_block_maps(culture_blocks_dict, output_folder_path))
 
+	if not config['keep_temp_files']:
+		delete_temp_files(config['temp_folder_path'])
 
-	###### COLONY IDENTIFICATION ######
-	plates = generate_plates(preprocessed_image_filenames, source_plate_filenames, num_plates, config['plate_locations'])
+	incremental.save_manifest(manifest)
 
-	# Run OpenCFU for each image.
-	opencfu_outputs = run_opencfu(config['opencfu_folder_path'], preprocessed_image_filenames, config['opencfu_arg_string'])
+	report_image_timings(image_timings)
 
-	# Draw colony location previews for each image.
-	if config['draw_previews']:
-		draw_previews(opencfu_outputs, config['temp_folder_path'])
+	return culture_blocks_dict
 
-	# Convert pixel coordinates to mm in coordinate system of each plate.
+# Pre-processes the images (or crops) of plates, detects colonies in them and sets the 'colony_locations' of each plate
+# in mm (see get_relative_locations), drawing previews if set. The 'image_filename' of each plate is replaced by its
+# pre-processed image. Returns the decode and encode time of each image (see preprocess_images). Region previews are
+# drawn from region_mask (see region_masks.load_mask).
+def analyse_plates(config, manifest, plates, background_filenames, region_mask):
+	###### PRE-PROCESSING IMAGES ######
+	# One pre-processing job per crop (or per image if not cropping).
+	preprocessing_jobs = []
 	for plate in plates:
-		opencfu_output = opencfu_outputs[plate['image_filename']]
-		plate_location = plate['location_in_image']
-		plate_origin = config['calibration_point_location']
-		plate['colony_locations'] = get_relative_locations(
-			opencfu_output, 
-			plate_location, 
-			config['rotate'], 
-			config['pixels_per_mm'],
-			plate_origin)
-		if config['draw_previews']:
-			draw_regions(
+		if not (plate['image_filename'], plate['crop_box']) in preprocessing_jobs:
+			preprocessing_jobs.append((plate['image_filename'], plate['crop_box']))
+
+	with instrumentation.stage('preprocess'):
+		# Reuse pre-processed images built from the same image, crop and settings.
+		background_fingerprints = [incremental.get_file_fingerprint(x) for x in background_filenames]
+		preprocessing_settings = [config[x] for x in ('inverted', 'blur_radius', 'brightness', 'contrast', 'intermediate_image_format', 'tile_memory_budget_mb')]
+		preprocessing_keys = []
+		preprocessing_dependencies = []
+		reused_filenames = {}
+		for image_filename, crop_box in preprocessing_jobs:
+			preprocessing_keys.append('preprocess {0} {1}'.format(os.path.abspath(image_filename), crop_box))
+			preprocessing_dependencies.append([incremental.get_file_fingerprint(image_filename), crop_box, background_fingerprints, preprocessing_settings])
+			up_to_date, filename = incremental.lookup(manifest, preprocessing_keys[-1], preprocessing_dependencies[-1])
+			if up_to_date:
+				reused_filenames[(image_filename, crop_box)] = filename
+		jobs_to_build = [job for job in preprocessing_jobs if not job in reused_filenames]
+
+		queued_opencfu_outputs = {}
+		if config['detection_queue_path'] and jobs_to_build:
+			# Pre-process and detect colonies on the queue's workers (which may be on other hosts). The pre-processed
+			# images are saved to the temp folder as usual, so it must be reachable from every worker.
+			built_filenames, queued_opencfu_outputs = detection_queue.detect(
+				config['detection_queue_path'],
+				jobs_to_build,
+				{
+					'temp_folder_path': os.path.abspath(config['temp_folder_path']),
+					'inverted': config['inverted'],
+					'blur_radius': config['blur_radius'],
+					'brightness': config['brightness'],
+					'contrast': config['contrast'],
+					'background_filenames': [os.path.abspath(x) for x in background_filenames],
+					'intermediate_format': config['intermediate_image_format'],
+					'compress_level': config['intermediate_compress_level'],
+					'tile_memory_budget_mb': config['tile_memory_budget_mb'],
+					'opencfu_folder_path': os.path.abspath(config['opencfu_folder_path']),
+					'opencfu_arg_string': config['opencfu_arg_string'],
+					'coarse_detection_factor': config['coarse_detection_factor']
+				},
+				config['detection_queue_timeout_s'],
+				config['detection_queue_max_attempts'],
+				config['detection_workers'])
+			preprocessed_images = {}
+			image_timings = {}
+		else:
+			built_filenames, preprocessed_images, image_timings = preprocess_images(
+				[job[0] for job in jobs_to_build],
 				config['temp_folder_path'],
-				plate['image_filename'],
-				plate_location, 
-				config['rotate'], 
-				config['pixels_per_mm'],
-				config['colony_regions'],
-				plate_origin)
+				inverted=config['inverted'],
+				blur_radius=config['blur_radius'],
+				brightness=config['brightness'],
+				contrast=config['contrast'],
+				background_filenames=background_filenames,
+				intermediate_format=config['intermediate_image_format'],
+				compress_level=config['intermediate_compress_level'],
+				crop_boxes=[job[1] for job in jobs_to_build],
+				max_workers=config['max_workers'],
+				tile_memory_budget_mb=config['tile_memory_budget_mb'],
+				adaptive=config['adaptive_workers'],
+				cpu_budget=config['worker_cpu_budget'],
+				memory_budget_mb=config['worker_memory_budget_mb'])
+
+		preprocessed_image_filenames = []
+		for job, key, dependencies in zip(preprocessing_jobs, preprocessing_keys, preprocessing_dependencies):
+			if job in reused_filenames:
+				preprocessed_image_filenames.append(reused_filenames[job])
+			else:
+				filename = built_filenames[jobs_to_build.index(job)]
+				incremental.store(manifest, key, dependencies, filename, [filename])
+				preprocessed_image_filenames.append(filename)
 
-	# Selects appropriate colonies for each plasmid based on colony_regions in settings.yaml.
-	culture_blocks_dict = pick_colonies(
-		plates, 
-		config['colony_regions'], 
-		config['colonies_to_pick'], 
-		config['block_rows'], 
-		config['block_columns'],
-		config['calibration_point_location'])
+	for plate in plates:
+		job_index = preprocessing_jobs.index((plate['image_filename'], plate['crop_box']))
+		plate['image_filename'] = preprocessed_image_filenames[job_index]
 
-	###### CREATING OUTPUT BLOCK MAPS AND PROTOCOL FILE ######
-	create_block_maps(culture_blocks_dict, config['output_folder_path'])
-	create_protocol(culture_blocks_dict, config['protocol_template_path'], config['output_folder_path'])
 
-	if not config['keep_temp_files']:
-		delete_temp_files(config['temp_folder_path'])
+	###### COLONY IDENTIFICATION ######
+	# Run OpenCFU for each image (or crop).
+	with instrumentation.stage('detect'):
+		# Reuse the detections of pre-processed images that haven't changed.
+		opencfu_outputs = {}
+		detection_dependencies = {}
+		for filename in preprocessed_image_filenames:
+			detection_dependencies[filename] = [incremental.get_file_fingerprint(filename), config['opencfu_folder_path'], config['opencfu_arg_string'], config['coarse_detection_factor']]
+			up_to_date, opencfu_output = incremental.lookup(manifest, 'detect ' + filename, detection_dependencies[filename])
+			if up_to_date:
+				opencfu_outputs[filename] = opencfu_output
+
+		# Images detected on the queue's workers are already done.
+		filenames_to_detect = [x for x in preprocessed_image_filenames if not x in opencfu_outputs and not x in queued_opencfu_outputs]
+		detected_opencfu_outputs = run_opencfu(
+			config['opencfu_folder_path'],
+			filenames_to_detect,
+			config['opencfu_arg_string'],
+			config['max_workers'],
+			config['coarse_detection_factor'],
+			preprocessed_images,
+			config['intermediate_compress_level'],
+			config['adaptive_workers'],
+			config['worker_cpu_budget'],
+			config['worker_memory_budget_mb'])
+		detected_opencfu_outputs.update(queued_opencfu_outputs)
+		for filename, opencfu_output in detected_opencfu_outputs.items():
+			incremental.store(manifest, 'detect ' + filename, detection_dependencies[filename], opencfu_output)
+			opencfu_outputs[filename] = opencfu_output
+	instrumentation.count('detections', sum(len(x) for x in opencfu_outputs.values()))
+
+	# Convert pixel coordinates to mm in coordinate system of each plate.
+	plate_origin = config['calibration_point_location']
+	with instrumentation.stage('relative_locations'):
+		for plate in plates:
+			opencfu_output = opencfu_outputs[plate['image_filename']]
+			# Detections in a crop are mapped back to the plate by moving the plate location into the crop's coordinates.
+			plate['colony_locations'] = get_relative_locations(
+				opencfu_output, 
+				get_location_in_crop(plate['location_in_image'], plate['crop_box']), 
+				plate['rotate'], 
+				plate['pixels_per_mm'],
+				plate_origin)
+
+	# Draw colony location and colony region previews for each image, on the same workers as the other stages.
+	if config['draw_previews']:
+		def draw_colony_preview(filename):
+			opencfu_output = opencfu_outputs[filename]
+			incremental.build(
+				manifest,
+				[config['temp_folder_path'] + '/preview_' + os.path.basename(filename)],
+				[incremental.get_file_fingerprint(filename), opencfu_output],
+				lambda: draw_previews({filename: opencfu_output}, config['temp_folder_path'], preprocessed_images, config['intermediate_compress_level']))
+
+		def draw_region_preview(plate):
+			plate_location_in_crop = get_location_in_crop(plate['location_in_image'], plate['crop_box'])
+			incremental.build(
+				manifest,
+				[config['temp_folder_path'] + '/preview_regions_' + os.path.basename(plate['image_filename'])],
+				[incremental.get_file_fingerprint(plate['image_filename']), plate_location_in_crop, plate['rotate'], plate['pixels_per_mm'], config['colony_regions'], region_masks.MASK_PIXELS_PER_MM],
+				lambda: draw_regions(
+					config['temp_folder_path'],
+					plate['image_filename'],
+					plate_location_in_crop, 
+					plate['rotate'], 
+					plate['pixels_per_mm'],
+					region_mask,
+					preprocessed_images.get(plate['image_filename']),
+					config['intermediate_compress_level']))
+
+		with instrumentation.stage('previews'):
+			scheduler.run_jobs(
+				'previews',
+				[(x, draw_colony_preview, x) for x in opencfu_outputs] + [(x['image_filename'], draw_region_preview, x) for x in plates],
+				lambda job: job[1](job[2]),
+				config['max_workers'],
+				config['adaptive_workers'],
+				config['worker_cpu_budget'],
+				config['worker_memory_budget_mb'],
+				lambda job: estimate_image_memory(job[0], copies=PREVIEW_WORKING_COPIES))
+
+	return image_timings
 
 
 #################################################################################################################
 # Functions for getting user input
 #################################################################################################################
 
+def parse_args():
+	parser = argparse.ArgumentParser(description='Generates an OT2 colony picking protocol from images of agar plates.')
+	instrumentation.add_arguments(parser)
+	return parser.parse_args()
+
 def get_config(config_path):
 	# Load settings from file.
 	config = yaml.safe_load(open(config_path))
@@ -164,6 +442,34 @@ def ask_source_plate_filenames(num_plates):
 
 	return source_plate_filenames
 
+# Reads each plate map CSV once. Returns a list of dicts with the plate 'name' (the filename without extension) and the
+# 'map' as a list of rows.
+def load_source_plate_maps(source_plate_filenames):
+	source_plate_maps = []
+	for source_plate_filename in source_plate_filenames:
+		with open(source_plate_filename, newline='', encoding="utf-8-sig") as csvfile:
+			csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
+			source_plate_maps.append({
+				'name': os.path.splitext(os.path.basename(source_plate_filename))[0],
+				'map': list(csvreader)
+			})
+
+	return source_plate_maps
+
+# Raises a ValueError if any plasmid in source_plate_maps has no colony region (see region_masks.load_mask) to be
+# picked from, e.g. if the agar plate maps have more columns than colony_regions because spots_per_reaction was changed
+# in the MoClo settings without changing colony_regions to match.
+def check_source_plate_maps(source_plate_maps, region_mask):
+	cells = set((cell['row'], cell['column']) for cell in region_mask['cells'])
+	for source_plate_map in source_plate_maps:
+		for i, row in enumerate(source_plate_map['map']):
+			for j, plasmid_name in enumerate(row):
+				if plasmid_name and not (i, j) in cells:
+					raise ValueError(
+						'Plate map {0} has {1} in row {2}, column {3}, but colony_regions has no region there ({4} rows, {5} columns). '
+						'Set colony_regions in settings.yaml to match the agar plate layout.'.format(
+							source_plate_map['name'], plasmid_name, i + 1, j + 1, region_mask['rows'], region_mask['columns']))
+
 
 #################################################################################################################
 # Functions for pre-processing images
@@ -186,71 +492,461 @@ def blend(images, blur_radius):
 	    average = Image.blend(average, img, 1.0 / float(i + 1))
 	return average
 
-# Processes images with various functions to improve colony detection. Saves to temp_folder_path.
-def preprocess_images(image_filenames, temp_folder_path, inverted=False, blur_radius=0.0, brightness=1.0, contrast=1.0, background_filenames=None):
-	
-	preprocessed_image_filenames = []
-
-	for image_filename in image_filenames:
-		
-		image = Image.open(image_filename)
+# Returns the path in temp_folder_path that the pre-processed version of image_filename is saved to. If intermediate_format
+# is not set the source format (and extension) is kept. Crops are named after the position of their crop box.
+def get_intermediate_filename(image_filename, temp_folder_path, intermediate_format, crop_box=None):
+	name, extension = os.path.splitext(os.path.basename(image_filename))
+	if crop_box:
+		name += '_x{0}_y{1}'.format(crop_box[0], crop_box[1])
+	if intermediate_format:
+		extension = INTERMEDIATE_IMAGE_EXTENSIONS[intermediate_format]
+	return temp_folder_path + '/' + name + extension
+
+# Saves an intermediate image using fast (or no) compression. The format is taken from the file extension.
+def save_intermediate_image(image, filename, compress_level):
+	extension = os.path.splitext(filename)[1].lower()
+	if extension == '.png':
+		image.save(filename, compress_level=compress_level)
+	elif extension in ('.tif', '.tiff'):
+		image.save(filename, compression=('raw' if compress_level == 0 else 'packbits'))
+	else:
+		image.save(filename)
+
+# Number of pixels around a crop needed for the blur at its edges to match the blur of the whole image.
+def get_blur_halo(blur_radius):
+	return int(math.ceil(3 * blur_radius)) + 1 if blur_radius else 0
+
+# Grows a (left, top, right, bottom) box by margin pixels on every side without leaving the image.
+def expand_box(box, margin, image_size):
+	return (
+		max(box[0] - margin, 0),
+		max(box[1] - margin, 0),
+		min(box[2] + margin, image_size[0]),
+		min(box[3] + margin, image_size[1]))
+
+# Returns the box to blur for the (left, top, right, bottom) box of an image (the box plus a halo of surrounding pixels)
+# and the position of the original box within it.
+def get_halo_boxes(box, blur_radius, image_size):
+	halo_box = expand_box(box, get_blur_halo(blur_radius), image_size)
+	inner_box = (box[0] - halo_box[0], box[1] - halo_box[1], box[2] - halo_box[0], box[3] - halo_box[1])
+	return halo_box, inner_box
+
+# Blurs the box region of image. The region is blurred together with a halo of surrounding pixels which is then trimmed
+# off, so the result matches the same region of the blurred whole image.
+def blur_region(image, box, blur_radius):
+	halo_box, inner_box = get_halo_boxes(box, blur_radius, image.size)
+	return blur(image.crop(halo_box), blur_radius).crop(inner_box)
+
+# Pre-processes one image (or the crop_box region of it, if given) and saves it in temp_folder_path.
+def preprocess_image(image, image_filename, temp_folder_path, inverted, blur_radius, brightness, contrast, average_background, intermediate_format, compress_level, crop_box=None):
+	if crop_box:
+		image = blur_region(image, crop_box, blur_radius)
+		# The average background was blurred as a whole so it only needs cropping.
+		if average_background is not None:
+			average_background = average_background.crop(crop_box)
+	else:
 		image = blur(image, blur_radius)
-		image = brightness_contrast(image, brightness, contrast)
 
-		if background_filenames:
-			background_images = [Image.open(x) for x in background_filenames]
+	image = brightness_contrast(image, brightness, contrast)
+
+	if average_background is not None:
+		if inverted:
+			image = ImageChops.subtract(average_background, image)
+		else:
+			image = ImageChops.subtract(image, average_background)
+
+	# Save in temporary folder.
+	preprocessed_image_filename = get_intermediate_filename(image_filename, temp_folder_path, intermediate_format, crop_box)
+
+	# Absolute filenames are important for opencfu step.
+	absolute_filename = os.path.abspath(preprocessed_image_filename)
+	start_time = time.perf_counter()
+	save_intermediate_image(image, absolute_filename, compress_level)
+	encode_time = time.perf_counter() - start_time
+
+	return absolute_filename, image, encode_time
+
+# Returns the height in rows of the strips an image region width pixels wide is processed in, so that the buffers for one
+# strip (including the blur halo above, below and beside it) fit in memory_budget bytes.
+def get_strip_height(width, bands, halo, memory_budget):
+	row_bytes = (width + 2 * halo) * bands * TILE_WORKING_COPIES
+	strip_height = int(memory_budget // row_bytes) - 2 * halo
+	if strip_height < 1:
+		raise ValueError('tile_memory_budget_mb is too small to process a {0} pixel wide image with blur_radius halo of {1} pixels.'.format(width, halo))
+	return strip_height
+
+# Pre-processes the rows between top and bottom of the (left, top, right, bottom) region of image. contrast_mean is the
+# mean brightness of the whole blurred region (as used by ImageEnhance.Contrast) so every strip gets the same contrast
+# adjustment.
+def preprocess_strip(image, region, top, bottom, mode, inverted, blur_radius, brightness, contrast, contrast_mean, background_images):
+	strip_box = (region[0], region[1] + top, region[2], region[1] + bottom)
+	strip = blur_region(image, strip_box, blur_radius).convert(mode)
+
+	if contrast != 1:
+		strip = Image.blend(Image.new('L', strip.size, contrast_mean).convert(mode), strip, contrast)
+	strip = ImageEnhance.Brightness(strip).enhance(brightness)
+
+	if background_images:
+		halo_box, inner_box = get_halo_boxes(strip_box, blur_radius, image.size)
+		background = blend([x.crop(halo_box).convert(mode) for x in background_images], blur_radius).crop(inner_box)
+		if inverted:
+			strip = ImageChops.subtract(background, strip)
+		else:
+			strip = ImageChops.subtract(strip, background)
+
+	return strip
+
+# Tiled version of preprocess_image for very large images. The region is processed in overlapping horizontal strips
+# sized so that at most memory_budget bytes of working buffers are allocated, and each strip is written to a PPM (or
+# PGM) file as soon as it is done, so no full-size intermediate image is ever held in memory. The decoded image and
+# background_images (already loaded, as they are shared between threads) are read from but not counted in the budget.
+def preprocess_image_tiled(image, image_filename, temp_folder_path, inverted, blur_radius, brightness, contrast, background_images, memory_budget, crop_box=None):
+	region = crop_box or (0, 0, image.size[0], image.size[1])
+	width = region[2] - region[0]
+	height = region[3] - region[1]
+	mode = image.mode if image.mode in ('L', 'RGB') else 'RGB'
+	strip_height = get_strip_height(width, len(mode), get_blur_halo(blur_radius), memory_budget)
+
+	# The contrast adjustment depends on the mean of the whole blurred region, so that is measured in a first pass.
+	contrast_mean = 0
+	if contrast != 1:
+		histogram_total = 0
+		for top in range(0, height, strip_height):
+			bottom = min(top + strip_height, height)
+			strip_box = (region[0], region[1] + top, region[2], region[1] + bottom)
+			histogram = blur_region(image, strip_box, blur_radius).convert('L').histogram()
+			histogram_total += sum(i * count for i, count in enumerate(histogram))
+		contrast_mean = int(histogram_total / float(width * height) + 0.5)
+
+	preprocessed_image_filename = get_intermediate_filename(image_filename, temp_folder_path, 'PPM', crop_box)
+	absolute_filename = os.path.abspath(preprocessed_image_filename)
+
+	encode_time = 0.0
+	with open(absolute_filename, 'wb') as ppm_file:
+		ppm_file.write('{0}\n{1} {2}\n255\n'.format('P5' if mode == 'L' else 'P6', width, height).encode('ascii'))
+		for top in range(0, height, strip_height):
+			bottom = min(top + strip_height, height)
+			strip = preprocess_strip(image, region, top, bottom, mode, inverted, blur_radius, brightness, contrast, contrast_mean, background_images)
+			start_time = time.perf_counter()
+			ppm_file.write(strip.tobytes())
+			encode_time += time.perf_counter() - start_time
+
+	return absolute_filename, None, encode_time
+
+# Processes images with various functions to improve colony detection. Saves to temp_folder_path in intermediate_format
+# (e.g. uncompressed or fast-compressed PNG/TIFF instead of re-encoding a JPEG). Returns the saved filenames, the
+# pre-processed images keyed by filename (so in-memory stages don't have to decode them again), and the decode and
+# encode time in seconds for each image. If crop_boxes are given (one per image filename, or None for the whole image)
+# only that region of each image is processed. Crops are processed in parallel on up to max_workers threads (see
+# scheduler.run_jobs for adaptive, cpu_budget and memory_budget_mb). If tile_memory_budget_mb is set, images are
+# instead processed in strips with the budget shared between the workers (see preprocess_image_tiled) and are not kept
+# in memory.
+def preprocess_images(image_filenames, temp_folder_path, inverted=False, blur_radius=0.0, brightness=1.0, contrast=1.0, background_filenames=None, intermediate_format='PNG', compress_level=1, crop_boxes=None, max_workers=1, tile_memory_budget_mb=None, adaptive=False, cpu_budget=None, memory_budget_mb=None):
+	
+	preprocessed_image_filenames = []
+	preprocessed_images = {}
+	image_timings = {}
+
+	if not crop_boxes:
+		crop_boxes = [None] * len(image_filenames)
+
+	# The background is the same for every image so it is only decoded and averaged once. In tiled mode it is averaged
+	# strip by strip instead, from background images decoded here: cropping a lazily opened image on several threads at
+	# once would decode it from the same file handle concurrently.
+	background_images = []
+	average_background = None
+	if background_filenames:
+		background_images = [Image.open(x) for x in background_filenames]
+		for background_image in background_images:
+			background_image.load()
+		if not tile_memory_budget_mb:
 			average_background = blend(background_images, blur_radius)
 
-			if inverted:
-				image = ImageChops.subtract(average_background, image)
-			else:
-				image = ImageChops.subtract(image, average_background)
-
-		# Save in temporary folder.
-		preprocessed_image_filename = temp_folder_path + '/' + os.path.basename(image_filename)
-
-		# Absolute filenames are important for opencfu step.
-		absolute_filename = os.path.abspath(preprocessed_image_filename)
-		image.save(absolute_filename)
-
+	# Crops of the same image share one decode. Images are decoded in order as their jobs are admitted, so only the
+	# images of jobs running or queued are held in memory.
+	decoded = {'filename': None, 'image': None}
+	def decode(job):
+		image_filename, crop_box = job
+		decode_time = 0.0
+		if image_filename != decoded['filename']:
+			start_time = time.perf_counter()
+			decoded['image'] = Image.open(image_filename)
+			decoded['image'].load()
+			decode_time = time.perf_counter() - start_time
+			decoded['filename'] = image_filename
+		return decoded['image'], image_filename, crop_box, decode_time
+
+	def preprocess(decoded_job):
+		image, image_filename, crop_box, decode_time = decoded_job
+		if tile_memory_budget_mb:
+			return preprocess_image_tiled(
+				image,
+				image_filename,
+				temp_folder_path,
+				inverted,
+				blur_radius,
+				brightness,
+				contrast,
+				background_images,
+				tile_memory_budget_mb * 1024 * 1024 / max_workers,
+				crop_box) + (decode_time,)
+		return preprocess_image(
+			image,
+			image_filename,
+			temp_folder_path,
+			inverted,
+			blur_radius,
+			brightness,
+			contrast,
+			average_background,
+			intermediate_format,
+			compress_level,
+			crop_box) + (decode_time,)
+
+	# In tiled mode the working memory of each job is already limited to its share of the tile budget.
+	results = scheduler.run_jobs(
+		'preprocess',
+		list(zip(image_filenames, crop_boxes)),
+		preprocess,
+		max_workers,
+		adaptive,
+		cpu_budget,
+		memory_budget_mb,
+		None if tile_memory_budget_mb else lambda job: estimate_image_memory(job[0], job[1], TILE_WORKING_COPIES),
+		decode)
+
+	for absolute_filename, preprocessed_image, encode_time, decode_time in results:
 		preprocessed_image_filenames.append(absolute_filename)
-
-	return preprocessed_image_filenames
+		if preprocessed_image is not None:
+			preprocessed_images[absolute_filename] = preprocessed_image
+		image_timings[absolute_filename] = {'decode': decode_time, 'encode': encode_time}
+		instrumentation.record('decode', decode_time)
+		instrumentation.record('encode', encode_time)
+		instrumentation.count_bytes_written(absolute_filename)
+
+	return preprocessed_image_filenames, preprocessed_images, image_timings
+
+# Rough memory in bytes needed to process an image (or the crop_box region of it) holding copies copies of it at once.
+# Only the image header is read.
+def estimate_image_memory(image_filename, crop_box=None, copies=1):
+	with Image.open(image_filename) as image:
+		width, height = image.size
+		bands = len(image.getbands())
+	if crop_box:
+		width, height = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+	return width * height * bands * copies
+
+# Logs the decode and encode time of each image so the cost of intermediate files can be compared between formats.
+def report_image_timings(image_timings):
+	for image_filename, timings in image_timings.items():
+		logger.info('%s: decode %.1f ms, encode %.1f ms', os.path.basename(image_filename), timings['decode'] * 1000, timings['encode'] * 1000)
 
 
 #################################################################################################################
 # Functions for locating colonies with OpenCFU
 #################################################################################################################
 
-# Generates a list of plates, their images filenames and source plate (map) filenames, and their locations within their source images.
-def generate_plates(preprocessed_image_filenames, source_plate_filenames, num_plates, plate_locations):
-	
-	plates_per_image = len(plate_locations)
-
+# Generates a list of plates, their images filenames and source plate maps, and their locations within their source images.
+# plate_calibrations holds the calibration of each plate in each image (a list of dicts with the 'location' of the
+# plate's A1 corner, 'rotate' and 'pixels_per_mm'), keyed by image filename.
+def generate_plates(image_filenames, source_plate_maps, num_plates, plate_calibrations):
 	plates = []
 	plate_index = 0
-	for preprocessed_image_filename in preprocessed_image_filenames:
-		for i in range(0, plates_per_image):
+	for image_filename in image_filenames:
+		for calibration in plate_calibrations[image_filename]:
 			if plate_index < num_plates:
 				plates.append({
-					'image_filename' : preprocessed_image_filename,
-					'source_plate_filename' : source_plate_filenames[plate_index],
-					'location_in_image' : plate_locations[i]
+					'image_filename' : image_filename,
+					'source_image_filename' : image_filename,
+					'source_plate_name' : source_plate_maps[plate_index]['name'],
+					'source_plate_map' : source_plate_maps[plate_index]['map'],
+					'location_in_image' : calibration['location'],
+					'rotate' : calibration['rotate'],
+					'pixels_per_mm' : calibration['pixels_per_mm']
 				})
 				plate_index += 1
 
 	return plates
 
-# Run opencfu for an image and return the result as a dictionary keyed by image filenames.
-def run_opencfu(opencfu_folder_path, image_filenames, arg_string):
-	opencfu_outputs = {}
-	for image_filename in image_filenames:
-		shell_command = 'cd "{0}/bin" && opencfu -i "{1}" {2}'.format(opencfu_folder_path, image_filename, arg_string)
-		raw_opencfu_output = subprocess.check_output(args = shell_command, shell = True)
-		f = StringIO(raw_opencfu_output.decode("utf-8"))
-		opencfu_outputs[image_filename] = list(csv.DictReader(f, delimiter = ','))
+# Run opencfu for one image and return the result as a list of dicts (one per detection).
+def run_opencfu_on_image(opencfu_folder_path, image_filename, arg_string):
+	shell_command = 'cd "{0}/bin" && opencfu -i "{1}" {2}'.format(opencfu_folder_path, image_filename, arg_string)
+	raw_opencfu_output = subprocess.check_output(args = shell_command, shell = True)
+	f = StringIO(raw_opencfu_output.decode("utf-8"))
+	return list(csv.DictReader(f, delimiter = ','))
+
+# Returns the (left, top, right, bottom) pixel boxes of the candidate colonies in image, found on a copy downsampled by
+# factor, each grown by COARSE_WINDOW_MARGIN pixels. Overlapping boxes are merged. Returns None if the boxes would cover
+# more than COARSE_MAX_COVERAGE of the image (e.g. a crowded plate).
+def find_candidate_boxes(image, factor):
+	grey = image.convert('L')
+	background = int(ImageStat.Stat(grey.reduce(factor)).median[0])
+	small = ImageChops.difference(grey, Image.new('L', grey.size, background)).reduce(factor)
+	width, height = small.size
+	threshold = max(COARSE_MIN_CONTRAST, COARSE_NOISE_FACTOR * ImageStat.Stat(small).median[0])
+	bright = [x > threshold for x in small.getdata()]
+
+	boxes = []
+	for start in range(0, len(bright)):
+		if not bright[start]:
+			continue
+		bright[start] = False
+		stack = [start]
+		box = [width, height, 0, 0]
+		while stack:
+			i = stack.pop()
+			x, y = i % width, i // width
+			box = [min(box[0], x), min(box[1], y), max(box[2], x + 1), max(box[3], y + 1)]
+			for neighbour_y in range(max(y - 1, 0), min(y + 2, height)):
+				for neighbour_x in range(max(x - 1, 0), min(x + 2, width)):
+					j = neighbour_y * width + neighbour_x
+					if bright[j]:
+						bright[j] = False
+						stack.append(j)
+		boxes.append(expand_box([x * factor for x in box], COARSE_WINDOW_MARGIN, image.size))
+
+	boxes = merge_boxes(boxes)
+	if sum((x[2] - x[0]) * (x[3] - x[1]) for x in boxes) > COARSE_MAX_COVERAGE * image.size[0] * image.size[1]:
+		return None
+	return boxes
+
+# Merges overlapping (left, top, right, bottom) boxes into their bounding boxes until none overlap.
+def merge_boxes(boxes):
+	merged = []
+	for box in sorted(boxes):
+		overlapping = True
+		while overlapping:
+			overlapping = [x for x in merged if x[0] < box[2] and box[0] < x[2] and x[1] < box[3] and box[1] < x[3]]
+			for x in overlapping:
+				merged.remove(x)
+				box = (min(box[0], x[0]), min(box[1], x[1]), max(box[2], x[2]), max(box[3], x[3]))
+		merged.append(box)
+	return merged
+
+# Packs the boxes of image side by side (in rows, tallest first) into one mosaic image, separated by COARSE_MOSAIC_GAP
+# pixels of fill. Returns the mosaic and a list of (box, (left, top)) with the position of each box in the mosaic.
+def make_mosaic(image, boxes, fill):
+	total_area = sum((x[2] - x[0] + COARSE_MOSAIC_GAP) * (x[3] - x[1] + COARSE_MOSAIC_GAP) for x in boxes)
+	mosaic_width = max([int(math.sqrt(total_area))] + [x[2] - x[0] + COARSE_MOSAIC_GAP for x in boxes])
+	placements = []
+	left, top, row_height = 0, 0, 0
+	for box in sorted(boxes, key=lambda x: x[1] - x[3]):
+		box_width, box_height = box[2] - box[0] + COARSE_MOSAIC_GAP, box[3] - box[1] + COARSE_MOSAIC_GAP
+		if left + box_width > mosaic_width:
+			left, top, row_height = 0, top + row_height, 0
+		placements.append((box, (left + COARSE_MOSAIC_GAP // 2, top + COARSE_MOSAIC_GAP // 2)))
+		left += box_width
+		row_height = max(row_height, box_height)
+
+	mosaic = Image.new(image.mode, (mosaic_width, top + row_height), fill)
+	for box, position in placements:
+		mosaic.paste(image.crop(box), position)
+	return mosaic, placements
+
+# Coarse-to-fine version of run_opencfu_on_image for sparse plates. Candidate colonies are found on a copy of the
+# (pre-processed) image downsampled by factor, and OpenCFU is only run at full resolution on a mosaic of the windows
+# around them, saved next to the image. Detections are returned in the coordinates of the whole image. Falls back to
+# detecting on the whole image if the windows would cover most of it. If image is given it is used instead of opening
+# image_filename.
+def detect_colonies_coarse_to_fine(opencfu_folder_path, image_filename, arg_string, factor, image=None, compress_level=1):
+	if image is None:
+		image = Image.open(image_filename)
+	boxes = find_candidate_boxes(image, factor)
+	if boxes is None:
+		logger.debug('%s: too many candidate colonies for coarse-to-fine detection.', image_filename)
+		return run_opencfu_on_image(opencfu_folder_path, image_filename, arg_string)
+	if not boxes:
+		return []
+
+	# The gaps between windows are filled with the typical (background) value of the image.
+	fill = tuple(int(x) for x in ImageStat.Stat(image.reduce(factor)).median)
+	mosaic, placements = make_mosaic(image, boxes, fill if len(fill) > 1 else fill[0])
+	mosaic_filename = '{0}_mosaic{1}'.format(*os.path.splitext(image_filename))
+	save_intermediate_image(mosaic, mosaic_filename, compress_level)
+	instrumentation.count('coarse_detection_pixels', mosaic.size[0] * mosaic.size[1])
+	instrumentation.count('full_detection_pixels', image.size[0] * image.size[1])
+
+	opencfu_output = []
+	for row in run_opencfu_on_image(opencfu_folder_path, mosaic_filename, arg_string):
+		x, y = float(row['X']), float(row['Y'])
+		for box, (left, top) in placements:
+			if left <= x < left + box[2] - box[0] and top <= y < top + box[3] - box[1]:
+				row['X'] = '{0:.2f}'.format(x - left + box[0])
+				row['Y'] = '{0:.2f}'.format(y - top + box[1])
+				opencfu_output.append(row)
+				break
+	return opencfu_output
+
+# Detects colonies in one pre-processed image, coarse-to-fine if coarse_detection_factor is set (see
+# detect_colonies_coarse_to_fine). image is the pre-processed image if it is in memory.
+def detect_colonies(opencfu_folder_path, image_filename, arg_string, coarse_detection_factor=None, image=None, compress_level=1):
+	if coarse_detection_factor:
+		return detect_colonies_coarse_to_fine(opencfu_folder_path, image_filename, arg_string, coarse_detection_factor, image, compress_level)
+	return run_opencfu_on_image(opencfu_folder_path, image_filename, arg_string)
+
+# Run opencfu for each image (on up to max_workers images at once, see scheduler.run_jobs for adaptive, cpu_budget and
+# memory_budget_mb) and return the result as a dictionary keyed by image filenames.
+# Images already in memory (keyed by filename) are used for coarse-to-fine detection instead of reading them back from disk.
+def run_opencfu(opencfu_folder_path, image_filenames, arg_string, max_workers=1, coarse_detection_factor=None, images=None, compress_level=1, adaptive=False, cpu_budget=None, memory_budget_mb=None):
+	images = images or {}
+	outputs = scheduler.run_jobs(
+		'detect',
+		image_filenames,
+		lambda x: detect_colonies(opencfu_folder_path, x, arg_string, coarse_detection_factor, images.get(x), compress_level),
+		max_workers,
+		adaptive,
+		cpu_budget,
+		memory_budget_mb,
+		lambda x: estimate_image_memory(x, copies=OPENCFU_WORKING_COPIES))
+
+	return dict(zip(image_filenames, outputs))
+
+# Returns the (left, top, right, bottom) pixel box around the colony regions of a plate, plus margin_mm on every side,
+# using the plate's calibration (location, rotation and scale). The box is limited to the image.
+def get_plate_crop_box(plate_location, rotate, pixels_per_mm, colony_regions, margin_mm, image_size):
+	x_min, y_min, x_max, y_max = get_colony_regions_extent(colony_regions)
+
+	# Colony regions are relative to corner A1 of the plate, so no origin adjustment is needed here.
+	corners = []
+	for mm_x in (x_min - margin_mm, x_max + margin_mm):
+		for mm_y in (y_min - margin_mm, y_max + margin_mm):
+			corners.append(get_image_location(mm_x, mm_y, plate_location, rotate, pixels_per_mm, {'x': 0, 'y': 0}))
+
+	box = (
+		int(math.floor(min(x for x, y in corners))),
+		int(math.floor(min(y for x, y in corners))),
+		int(math.ceil(max(x for x, y in corners))),
+		int(math.ceil(max(y for x, y in corners))))
+	return expand_box(box, 0, image_size)
+
+# Returns the (x_min, y_min, x_max, y_max) extent in mm (relative to corner A1 of the plate) covered by all colony regions.
+def get_colony_regions_extent(colony_regions):
+	if colony_regions['type'] == 'shapes':
+		return region_masks.get_cells_extent(region_masks.get_cells(colony_regions))
+
+	x_offset = (colony_regions['columns'] - 1) * colony_regions['x_spacing']
+	y_offset = (colony_regions['rows'] - 1) * colony_regions['y_spacing']
+
+	if colony_regions['type'] == 'circle':
+		return (
+			colony_regions['x'] - colony_regions['r'],
+			colony_regions['y'] - colony_regions['r'],
+			colony_regions['x'] + x_offset + colony_regions['r'],
+			colony_regions['y'] + y_offset + colony_regions['r'])
+	elif colony_regions['type'] == 'rectangle':
+		return (
+			min(colony_regions['x_1'], colony_regions['x_2']),
+			min(colony_regions['y_1'], colony_regions['y_2']),
+			max(colony_regions['x_1'], colony_regions['x_2']) + x_offset,
+			max(colony_regions['y_1'], colony_regions['y_2']) + y_offset)
+	else:
+		raise ValueError('Invalid colony_regions type: {0}'.format(colony_regions['type']))
 
-	return opencfu_outputs
+# Returns the location of a plate in the coordinates of a crop of its image (or the original location if not cropped).
+def get_location_in_crop(plate_location, crop_box):
+	if not crop_box:
+		return plate_location
+	return {'x': plate_location['x'] - crop_box[0], 'y': plate_location['y'] - crop_box[1]}
 
 # converts opencfu output (locations in px coordinates) into mm coordinates relative to origin.
 def get_relative_locations(opencfu_output, plate_location, rotate, pixels_per_mm, plate_origin):
@@ -272,7 +968,13 @@ def get_relative_locations(opencfu_output, plate_location, rotate, pixels_per_mm
 			adjusted_x = mm_x - plate_origin['x']
 			adjusted_y = mm_y - plate_origin['y']
 
-			relative_locations.append({'x': adjusted_x, 'y': adjusted_y})
+			location = {'x': adjusted_x, 'y': adjusted_y}
+			# Size of the colony in mm (and mm^2), if OpenCFU reported it.
+			if row.get('Radius'):
+				location['radius'] = float(row['Radius']) / pixels_per_mm
+			if row.get('Area'):
+				location['area'] = float(row['Area']) / pixels_per_mm**2
+			relative_locations.append(location)
 
 	return relative_locations
 
@@ -295,10 +997,14 @@ def get_image_location(x, y, plate_location, rotate, pixels_per_mm, plate_origin
 	return (translated_x, translated_y)
 
 # Intakes a list of opencfu outputs (DictReaders) keyed by image filename and draws previews to temp_folder_path.
-def draw_previews(opencfu_outputs, preview_path):
+# Images already in memory (keyed by filename) are used instead of reading them back from disk.
+def draw_previews(opencfu_outputs, preview_path, images=None, compress_level=1):
+	images = images or {}
 	for image_filename, opencfu_output in opencfu_outputs.items():
 		# Create preview image of colony picking
-		original = Image.open(image_filename)
+		original = images.get(image_filename)
+		if original is None:
+			original = Image.open(image_filename)
 		im = original.copy()
 		draw = ImageDraw.Draw(im)
 
@@ -312,39 +1018,23 @@ def draw_previews(opencfu_outputs, preview_path):
 
 		preview_filename = preview_path + '/preview_' + os.path.basename(image_filename)
 		# Save image preview
-		im.save(preview_filename)
+		save_intermediate_image(im, preview_filename, compress_level)
 
-# Draws the colony regions and saves output in temp folder.
-def draw_regions(preview_path, image_filename, plate_location, rotate, pixels_per_mm, colony_regions, plate_origin):
+# Draws the outlines of the colony regions of a label mask (see region_masks.load_mask) onto a plate and saves output in
+# temp folder. If image is given it is used instead of opening image_filename.
+def draw_regions(preview_path, image_filename, plate_location, rotate, pixels_per_mm, region_mask, image=None, compress_level=1):
 	# Open source image
-	original = Image.open(image_filename)
+	original = image if image is not None else Image.open(image_filename)
 	im = original.copy()
 	draw = ImageDraw.Draw(im)
 
-	# Draw (different for circles vs rectangles)
-	for i in range(0, colony_regions["rows"]):
-		for j in range(0, colony_regions["columns"]):
-			if colony_regions['type'] == 'circle':
-				mm_x = colony_regions['x'] + j*colony_regions['x_spacing'] - plate_origin['x']
-				mm_y = colony_regions['y'] + i*colony_regions['y_spacing'] - plate_origin['y']
-				px_x, px_y = get_image_location(mm_x, mm_y, plate_location, rotate, pixels_per_mm, plate_origin)
-				px_r = colony_regions['r'] * pixels_per_mm
-				draw.ellipse((px_x-px_r, px_y-px_r, px_x+px_r, px_y+px_r), outline=(255, 0, 0, 255))
-			elif colony_regions['type'] == 'rectangle':
-				mm_x_min = colony_regions['x_1'] + j*colony_regions['x_spacing'] - plate_origin['x']
-				mm_x_max = colony_regions['x_2'] + j*colony_regions['x_spacing'] - plate_origin['x']
-				mm_y_min = colony_regions['y_1'] + i*colony_regions['y_spacing'] - plate_origin['y']
-				mm_y_max = colony_regions['y_2'] + i*colony_regions['y_spacing'] - plate_origin['y']
-				px_x_min, px_y_min = get_image_location(mm_x_min, mm_y_min, plate_location, rotate, pixels_per_mm, plate_origin)
-				px_x_max, px_y_max = get_image_location(mm_x_max, mm_y_max, plate_location, rotate, pixels_per_mm, plate_origin)
-				print(px_x_min, px_y_min, px_x_max, px_y_max)
-				draw.rectangle([(px_x_min, px_y_min), (px_x_max, px_y_max)], outline=(255, 0, 0, 255))
-			else:
-				raise ValueError('Invalid colony_regions type: {0}'.format(colony_regions['type']))
+	# Outline the regions as the mask assigns colonies to them, mapped onto the image with the plate's calibration.
+	labels = region_masks.get_image_labels(region_mask, im.size, plate_location, rotate, pixels_per_mm)
+	draw.bitmap((0, 0), region_masks.get_outlines(labels), fill=(255, 0, 0, 255))
 
 	# Save
 	preview_filename = preview_path + '/preview_regions_' + os.path.basename(image_filename)
-	im.save(preview_filename)
+	save_intermediate_image(im, preview_filename, compress_level)
 
 # Find the minimum distance from other colonies for each colony
 def measure_colony_distances(colony_list):
@@ -360,45 +1050,78 @@ def measure_colony_distances(colony_list):
 
 	return colonies_with_distances
 
-# Gets plasmid name from user-provided plate map file.
-def get_plasmid_name(source_plate_filename, row, column):
-	# Get name of the plasmid by reading user-supplied plate map.
-	with open(source_plate_filename, newline='', encoding="utf-8-sig") as csvfile:
-		csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-		try:
-			plasmid_name = list(csvreader)[row][column]
-		except:
-			plasmid_name = ''
+# Gets plasmid name from a user-provided plate map (list of rows, see load_source_plate_maps).
+def get_plasmid_name(source_plate_map, row, column):
+	try:
+		plasmid_name = source_plate_map[row][column]
+	except IndexError:
+		plasmid_name = ''
 
 	return plasmid_name
 
-# Returns a list of only the colonies which are inside colony region i, j.
-def get_colonies_in_region(colony_locations, colony_regions, plate_origin, i, j):
-	colonies_in_region = []
-
+# Returns the distance in mm from a colony to the nearest edge of colony region i, j (negative if outside the region).
+# The cells of 'shapes' layouts are looked up in layout (see region_masks.load_layout), worked out here if not given.
+def get_region_edge_distance(colony, colony_regions, plate_origin, i, j, layout=None):
 	if colony_regions['type'] == 'circle':
-		for colony in colony_locations:
-			target_x = colony_regions['x'] + j*colony_regions['x_spacing'] - plate_origin['x']
-			target_y = colony_regions['y'] + i*colony_regions['y_spacing'] - plate_origin['y']
-			delta_x = colony['x'] - target_x
-			delta_y = colony['y'] - target_y
-			if (delta_x**2 + delta_y**2)**0.5 < colony_regions['r']:
-				colonies_in_region.append(colony)
+		target_x = colony_regions['x'] + j*colony_regions['x_spacing'] - plate_origin['x']
+		target_y = colony_regions['y'] + i*colony_regions['y_spacing'] - plate_origin['y']
+		delta_x = colony['x'] - target_x
+		delta_y = colony['y'] - target_y
+		return colony_regions['r'] - (delta_x**2 + delta_y**2)**0.5
 
 	elif colony_regions['type'] == 'rectangle':
-		for colony in colony_locations:
-			x_min = colony_regions['x_1'] + j*colony_regions['x_spacing'] - plate_origin['x']
-			x_max = colony_regions['x_2'] + j*colony_regions['x_spacing'] - plate_origin['x']
-			y_min = colony_regions['y_1'] + i*colony_regions['y_spacing'] - plate_origin['y']
-			y_max = colony_regions['y_2'] + i*colony_regions['y_spacing'] - plate_origin['y']
-			if colony['x'] > x_min and colony['x'] < x_max and colony['y'] > y_min and colony['y'] < y_max:
-				colonies_in_region.append(colony)
+		x_min = colony_regions['x_1'] + j*colony_regions['x_spacing'] - plate_origin['x']
+		x_max = colony_regions['x_2'] + j*colony_regions['x_spacing'] - plate_origin['x']
+		y_min = colony_regions['y_1'] + i*colony_regions['y_spacing'] - plate_origin['y']
+		y_max = colony_regions['y_2'] + i*colony_regions['y_spacing'] - plate_origin['y']
+		return min(colony['x'] - x_min, x_max - colony['x'], colony['y'] - y_min, y_max - colony['y'])
+
+	elif colony_regions['type'] == 'shapes':
+		cell = region_masks.get_cell(layout or region_masks.load_layout(colony_regions), i, j)
+		return region_masks.get_cell_edge_distance(colony, cell, plate_origin) if cell else float('-inf')
 
 	else:
 		raise ValueError('Invalid colony_regions type: {0}'.format(colony_regions['type']))
-	
+
+# Returns a list of only the colonies which are inside colony region i, j. Each colony's distance from the edge of the
+# region is stored in 'edge_dist'. Every colony is tested against the region; pick_colonies looks them up in a label
+# mask instead (see region_masks.assign_colonies), which gives the same colonies.
+def get_colonies_in_region(colony_locations, colony_regions, plate_origin, i, j):
+	layout = region_masks.load_layout(colony_regions) if colony_regions['type'] == 'shapes' else None
+	colonies_in_region = []
+	for colony in colony_locations:
+		edge_dist = get_region_edge_distance(colony, colony_regions, plate_origin, i, j, layout)
+		if edge_dist > 0:
+			colony['edge_dist'] = edge_dist
+			colonies_in_region.append(colony)
+
 	return colonies_in_region
 
+# Scores each colony (with 'dist' and 'edge_dist' measured) for picking, as a weighted sum of its distance to the
+# nearest other colony, whether its radius is within radius_range_mm (1 or 0), its distance from the edge of its region
+# and its circularity (area relative to a circle of its radius, up to 1). Colonies without a radius or area reported
+# by OpenCFU score 0 on those criteria.
+def score_colonies(colonies, pick_weights, radius_range_mm):
+	scores = []
+	for colony in colonies:
+		radius = colony.get('radius')
+		area = colony.get('area')
+		radius_in_range = 1.0 if radius is not None and radius_range_mm[0] <= radius <= radius_range_mm[1] else 0.0
+		circularity = min(area / (math.pi * radius**2), 1.0) if radius and area is not None else 0.0
+		scores.append(
+			pick_weights['isolation'] * colony['dist']
+			+ pick_weights['radius'] * radius_in_range
+			+ pick_weights['edge'] * colony['edge_dist']
+			+ pick_weights['circularity'] * circularity)
+
+	return scores
+
+# Returns the colonies_to_pick highest scoring colonies (best first). Ties keep the order the colonies were found in.
+def select_colonies(colonies, colonies_to_pick, pick_weights, radius_range_mm):
+	scores = score_colonies(colonies, pick_weights, radius_range_mm)
+	best = heapq.nlargest(colonies_to_pick, range(0, len(colonies)), key=lambda x: scores[x])
+	return [colonies[x] for x in best]
+
 # Output of this function is a dict of output culture blocks. Each culture block is represented by a list of lists. 
 # Each entry contains the name of the plasmid ('name'), the agar plate it came from ('source'), and the x y position
 # in mm of the colony it came from ('x', 'y', and 'z').
@@ -425,49 +1148,52 @@ def get_colonies_in_region(colony_locations, colony_regions, plate_origin, i, j)
 # 		]
 # 	],
 # }
-def pick_colonies(plates, colony_regions, colonies_to_pick, block_rows, block_columns, calibration_point_location):
-	# Tracking output block number, row, and column.
-	n = 0
-	i = 0
-	j = 0
-	culture_blocks_dict = {}
-	culture_blocks_dict['culture_block_0'] = []
-	culture_blocks_dict['culture_block_0'].append([])
+# The region of each colony is looked up in region_mask (see region_masks.load_mask), compiled from colony_regions if
+# not given.
+def pick_colonies(plates, colony_regions, colonies_to_pick, block_rows, block_columns, calibration_point_location, pick_weights=None, radius_range_mm=(0, float('inf')), culture_blocks_dict=None, region_mask=None):
+	pick_weights = dict(DEFAULT_PICK_WEIGHTS, **(pick_weights or {}))
+	if region_mask is None:
+		region_mask = region_masks.load_mask(colony_regions)
+
+	# Picks fill each output block column by column, continuing after those already in culture_blocks_dict (if given).
+	if culture_blocks_dict is None:
+		culture_blocks_dict = {'culture_block_0': [[]]}
+	num_picks = sum(len(row) for block_map in culture_blocks_dict.values() for row in block_map)
 
 	for plate in plates:
-		for row in range(0, colony_regions['rows']):
-			for col in range(0, colony_regions['columns']):
+		colonies_by_region = region_masks.assign_colonies(region_mask, plate['colony_locations'], calibration_point_location)
+		for row in range(0, region_mask['rows']):
+			for col in range(0, region_mask['columns']):
 				
-				plasmid_name = get_plasmid_name(plate['source_plate_filename'], row, col)
+				plasmid_name = get_plasmid_name(plate['source_plate_map'], row, col)
 
 				if plasmid_name:
-					colonies = get_colonies_in_region(plate['colony_locations'], colony_regions, calibration_point_location, row, col)
+					instrumentation.count('regions')
+					colonies = []
+					for colony, edge_dist in colonies_by_region.get((row, col), []):
+						colony['edge_dist'] = edge_dist
+						colonies.append(colony)
 					colonies_with_distances = measure_colony_distances(colonies)
-					sorted_colonies = sorted(colonies_with_distances, key=lambda c: c['dist'], reverse=True)
-					selected_colonies = sorted_colonies[:colonies_to_pick]
+					selected_colonies = select_colonies(colonies_with_distances, colonies_to_pick, pick_weights, radius_range_mm)
 
+					instrumentation.count('picks', len(selected_colonies))
 					for colony in selected_colonies:
 						colony_dict = {
 							'name': plasmid_name, 
-							'source': '{0}'.format(os.path.splitext(os.path.basename(plate['source_plate_filename']))[0]), 
+							'source': plate['source_plate_name'], 
 							'x': colony['x'],
 							# INVERT COLONY Y FOR LOWER-LEFT-ORIGIN OPENTRONS LABWARE COORDINATE SYSTEM
 							'y': -colony['y']
 						}
-						try:
-							culture_blocks_dict['culture_block_{0}'.format(n)][i].append(colony_dict)
-						except IndexError:
-							culture_blocks_dict['culture_block_{0}'.format(n)].append([colony_dict])
-
-						if i == block_rows - 1:
-							if j == block_columns - 1:
-								n += 1
-								j = 0
-							else:
-								j += 1
-							i = 0
-						else:
-							i += 1
+
+						# Output block number, row, and column of this pick.
+						n, position = divmod(num_picks, block_rows * block_columns)
+						j, i = divmod(position, block_rows)
+						block_map = culture_blocks_dict.setdefault('culture_block_{0}'.format(n), [])
+						if i == len(block_map):
+							block_map.append([])
+						block_map[i].append(colony_dict)
+						num_picks += 1
 
 	return culture_blocks_dict
 
@@ -484,22 +1210,108 @@ def delete_temp_files(temp_folder_path):
 
 def create_block_maps(culture_blocks_dict, output_folder_path):
 	for block_name, block_map in culture_blocks_dict.items():
-		with open(output_folder_path + '/' + '{0}.csv'.format(block_name), 'w+', newline="") as block_map_file:
+		block_map_filename = output_folder_path + '/' + '{0}.csv'.format(block_name)
+		with open(block_map_filename, 'w+', newline="") as block_map_file:
 			writer = csv.writer(block_map_file)
 			for row in block_map:
 				writer.writerow([x['name'] for x in row])
-
-def create_protocol(culture_blocks_dict, protocol_template_path, output_folder_path):
+		instrumentation.count_bytes_written(block_map_filename)
+
+# Returns the layout (a dict of labware name to slot) to paste into a protocol part and a comment with its estimated
+# travel. Each colony of picks is picked with a new tip from its source plate into the culture block. If optimize is
+# False the slots are assigned in load order, as the template used to.
+def get_deck_layout(picks, optimize=True):
+	labware_names = ['tiprack-10ul', 'culture_block']
+	moves = Counter()
+	for colony in picks:
+		if not colony['source'] in labware_names:
+			labware_names.append(colony['source'])
+		deck_layout.add_path(moves, ['tiprack-10ul', colony['source'], 'culture_block', deck_layout.TRASH])
+
+	default_layout = deck_layout.get_load_order_layout(labware_names, AVAILABLE_DECK_SLOTS)
+	if not optimize:
+		return default_layout, deck_layout.get_travel_comment(default_layout, default_layout, moves)
+
+	layout = deck_layout.solve_layout(labware_names, moves, AVAILABLE_DECK_SLOTS)
+	travel_comment = deck_layout.get_travel_comment(layout, default_layout, moves)
+	logger.info(travel_comment[2:].strip())
+	return layout, travel_comment
+
+# Splits the picks of culture_blocks_dict into protocol parts that each fit on the deck at once: one culture block and
+# one tip rack, so at most TIPS_PER_RACK picks. Each part is a dict with the 'culture_block' name, its 'picks' (the
+# colony dicts, each with the index of the 'well' it goes into) in the order they were picked, and whether it is 'full'
+# (no later pick can be added to it).
+def get_protocol_parts(culture_blocks_dict, block_rows, block_columns):
+	parts = []
+	for block_name, block_map in culture_blocks_dict.items():
+		# block_map[i][j] goes into row i and column j of the culture block, which is well i + j * block_rows
+		# (wells are numbered down each column). Picks were made down each column of the block map.
+		picks = []
+		for i, row in enumerate(block_map):
+			for j, colony in enumerate(row):
+				picks.append((j * block_rows + i, dict(colony, well=i + j * block_rows)))
+		picks = [x[1] for x in sorted(picks, key=lambda x: x[0])]
+
+		for start in range(0, len(picks), TIPS_PER_RACK):
+			part_picks = picks[start:start + TIPS_PER_RACK]
+			parts.append({
+				'culture_block': block_name,
+				'picks': part_picks,
+				'full': len(part_picks) == TIPS_PER_RACK or start + len(part_picks) == block_rows * block_columns
+			})
+	return parts
+
+def get_protocol_part_filename(output_folder_path, part_number):
+	return os.path.join(output_folder_path, 'colony_pick_protocol_part_{0}.py'.format(part_number))
+
+# Writes protocol part part_number (counting from 1), with its own deck layout and slot map.
+def write_protocol_part(config, manifest, part, part_number):
+	output_folder_path = config['output_folder_path']
+	layout, travel_comment = incremental.get_value(
+		manifest,
+		'deck_layout part {0}'.format(part_number),
+		[part['picks'], config['optimize_deck_layout']],
+		lambda: get_deck_layout(part['picks'], config['optimize_deck_layout']))
+	slot_map_filename = os.path.join(output_folder_path, 'colony_pick_deck_layout_part_{0}.csv'.format(part_number))
+	incremental.build(manifest, [slot_map_filename], layout, lambda: deck_layout.write_slot_map(layout, slot_map_filename))
+	incremental.build(
+		manifest,
+		[get_protocol_part_filename(output_folder_path, part_number), resume_protocol.get_step_manifest_filename(get_protocol_part_filename(output_folder_path, part_number))],
+		[part, layout, travel_comment, config['step_markers'], config['step_log_filename'], incremental.get_file_hash(config['protocol_template_path'])],
+		lambda: create_protocol(part, part_number, layout, travel_comment, config['protocol_template_path'], output_folder_path, config['step_markers'], config['step_log_filename']))
+	logger.info('Protocol part %d is ready: %d colonies into %s.', part_number, len(part['picks']), part['culture_block'])
+
+def create_protocol(part, part_number, layout, travel_comment, protocol_template_path, output_folder_path, step_markers=False, step_log_filename=None):
 	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
 	with open(protocol_template_path) as template_file:
 		template_string = template_file.read()
 
-	with open(output_folder_path + '/' + 'colony_pick_protocol.py', "w+") as protocol_file:
-		# Paste colony locations dictionary into output file.
-		protocol_file.write("culture_blocks_dict = " + json.dumps(culture_blocks_dict) + "\n\n")
+	protocol_filename = get_protocol_part_filename(output_folder_path, part_number)
+	with open(protocol_filename, "w+") as protocol_file:
+		# Paste the colonies to pick in this part and the culture block they go into.
+		protocol_file.write("picks = " + json.dumps(part['picks']) + "\n\n")
+		protocol_file.write("culture_block_name = {0}\n".format(json.dumps(part['culture_block'])))
+		protocol_file.write("part_number = {0}\n\n".format(part_number))
+
+		# Paste in the slot of each piece of labware.
+		protocol_file.write(travel_comment)
+		protocol_file.write("deck_layout = " + json.dumps(layout) + "\n\n")
+
+		# Paste in whether to log the start and end of each step (see run_timing.py).
+		protocol_file.write("step_markers = {0!r}\n".format(bool(step_markers)))
+		protocol_file.write("step_log_filename = {0!r}\n\n".format(step_log_filename or None))
+
+		# Paste in where to resume a stopped part from (set by resume_protocol.py).
+		protocol_file.write("resume_from = None\n\n")
 
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	instrumentation.count_bytes_written(protocol_filename)
+
+	# Each pick is a step, using the next tip in the rack.
+	resume_protocol.save_step_manifest(protocol_filename, [
+		{'index': i, 'name': 'pick {0} {1}'.format(i, colony['name']), 'well': colony['well'], 'tip': i}
+		for i, colony in enumerate(part['picks'])])
 
 
 #################################################################################################################
@@ -1,34 +1,24 @@
-# This is the template protocol for colony picking. culture_blocks_dict (see below) will be hardcoded 
-# in at the top of this file by the colony_pick_generator.py script to create the final protocol file.
+# This is the template protocol for colony picking. Each part of a colony picking run fills one culture block (with
+# at most one tip rack of picks). The colonies to pick in the part, the name of its culture block and the part number
+# will be hardcoded in at the top of this file by the colony_pick_generator.py script to create the protocol file
+# for each part.
 
-# TODO: Automatically break up into multiple parts if too many colonies to pick
-
-# The structure of the dictionary pasted into the top of this file is below. Each culture block is represented 
-# by a list of lists. Each entry contains the name of the plasmid ('name'), the agar plate it came from 
-# ('source'), and the x y position in mm of the colony it came from ('x' and 'y').
+# The list pasted into the top of this file has an entry for each colony to pick, in the order to pick them. Each
+# entry contains the name of the plasmid ('name'), the agar plate it came from ('source'), the x y position in mm of
+# the colony it came from ('x' and 'y') and the index of the culture block well to put it in ('well', numbered down
+# each column).
 # For example...
-# culture_blocks_dict = {
-# 	'culture_block_0': [
-# 		[
-# 			{'name': 'plasmid_name_1', 'source': 'agar_plate_0', 'x': 12.123, 'y': 14.13}, 
-# 			{'name': 'plasmid_name_1', 'source': 'agar_plate_0', 'x': 15.12, 'y': 12.0}
-# 		],
-# 		[
-# 			{'name': 'plasmid_name_13', 'source': 'agar_plate_3', 'x': 14.123, 'y': 17.13},
-# 			{'name': 'plasmid_name_14', 'source': 'agar_plate_3', 'x': 10.1, 'y': 20.01}
-# 		]
-# 	],
-# 	'culture_block_1': [
-# 		[
-# 			{'name': 'plasmid_name_14', 'source': 'agar_plate_3', 'x': 12.3, 'y': 15.13}, 
-# 			{'name': 'plasmid_name_15', 'source': 'agar_plate_3', 'x': 15.12, 'y': 12.0}
-# 		],
-# 		[
-# 			{'name': 'plasmid_name_17', 'source': 'agar_plate_4', 'x': 17.123, 'y': 11.13},
-# 			{'name': 'plasmid_name_18', 'source': 'agar_plate_4', 'x': 20.1, 'y': 15.01}
-# 		]
-# 	],
-# }
+# picks = [
+# 	{'name': 'plasmid_name_1', 'source': 'agar_plate_0', 'x': 12.123, 'y': 14.13, 'well': 0},
+# 	{'name': 'plasmid_name_1', 'source': 'agar_plate_0', 'x': 15.12, 'y': 12.0, 'well': 1},
+# 	{'name': 'plasmid_name_13', 'source': 'agar_plate_3', 'x': 14.123, 'y': 17.13, 'well': 2}
+# ]
+# culture_block_name = 'culture_block_0'
+# part_number = 1
+#
+# resume_from (see Resuming below) is also pasted in, and is None unless the part is resumed after stopping.
+
+import time
 
 from opentrons import robot, instruments, labware
 from opentrons.util.vector import Vector
@@ -49,38 +39,73 @@ except:
 # How far from the calibration point to move the pipette down when picking colonies.
 PLATE_DEPTH = -7
 
-available_deck_slots = ['11', '10', '9', '8', '7', '6', '5', '4', '3', '2', '1']
+# Rough duration (in seconds) of picking one colony, used to estimate how long picking should take.
+SECONDS_PER_PICK = 30
+
+PROTOCOL_START = time.time()
+
+def elapsed():
+	"""Time since the protocol started, in seconds."""
+	return time.time() - PROTOCOL_START
+
+# If step_markers is set by the generator, the start and end of each pick are logged as robot comments (and appended
+# to step_log_filename on the robot, if set) in the form "STEP start|end <seconds since start> <estimated seconds or
+# -> <step name>". run_timing.py turns a run log into a timing report.
+def mark_step(event, name, estimate=None):
+	if not step_markers:
+		return
+	marker = 'STEP {0} {1:.1f} {2} {3}'.format(event, elapsed(), '-' if estimate is None else '{0:.0f}'.format(estimate), name)
+	robot.comment(marker)
+	if step_log_filename and not robot.is_simulating():
+		with open(step_log_filename, 'a') as step_log:
+			step_log.write(marker + '\n')
 
-tip_rack = [labware.load('tiprack-10ul', available_deck_slots.pop(), 'tiprack-10ul')]
+# The slot of each piece of labware is set by the generator in deck_layout (see deck_layout.py).
+tip_rack = [labware.load('tiprack-10ul', deck_layout['tiprack-10ul'], 'tiprack-10ul')]
 
 p = instruments.P10_Single(mount='right', tip_racks=tip_rack)
 
-culture_block = labware.load('96-deep-well', available_deck_slots.pop(), 'culture_block')
+culture_block = labware.load('96-deep-well', deck_layout['culture_block'], culture_block_name)
 
 source_plate_names = []
-for block_name, block_map in culture_blocks_dict.items():
-	for row in block_map:
-		for element in row:
-			source_name = element['source']
-			if not source_name in source_plate_names:
-				source_plate_names.append(source_name)
+for colony in picks:
+	source_name = colony['source']
+	if not source_name in source_plate_names:
+		source_plate_names.append(source_name)
 
 source_plates = {}
 for name in source_plate_names:
-	source_plates[name] = labware.load('point-for-colony-picking', available_deck_slots.pop(), name)
-
-i = 0
-for block_name, block_map in culture_blocks_dict.items():
-	for row in block_map:
-		for colony in row:
-			p.pick_up_tip()
-			# This aspirate ensures that the OT2 app realizes we are actually using this plate (so that it will 
-			# tell the user to calibrate for it).
-			p.aspirate(10, source_plates[colony['source']].wells(0))
-			robot.move_to((source_plates[colony['source']], Vector([colony['x'], colony['y'], PLATE_DEPTH])), p)
-			p.dispense(10, culture_block.wells(i))
-			p.aspirate(10)
-			p.dispense(10)
-			p.drop_tip()
-
-			i += 1
+	source_plates[name] = labware.load('point-for-colony-picking', deck_layout[name], name)
+
+def get_step_name(i, colony):
+	return 'pick {0} {1}'.format(i, colony['name'])
+
+# If resume_from is set (see resume_protocol.py), the picks before it are skipped. It is the name of a pick step or its
+# index (counting from 0). Each pick uses the next tip, so the pipette starts at the tip the resumed pick would have
+# used. Each colony still goes into its own well.
+first_pick = 0
+if resume_from is not None:
+	resume_picks = [i for i, colony in enumerate(picks) if resume_from in (i, get_step_name(i, colony))]
+	if not resume_picks:
+		raise ValueError('resume_from {0!r} is not a step of this protocol.'.format(resume_from))
+	first_pick = resume_picks[0]
+	robot.comment('Resuming from {0}.'.format(get_step_name(first_pick, picks[first_pick])))
+	p.start_at_tip(tip_rack[0].wells(first_pick))
+
+robot.comment('Part {0}: picking {1} colonies into {2}.'.format(part_number, len(picks) - first_pick, culture_block_name))
+
+for i, colony in enumerate(picks):
+	if i < first_pick:
+		continue
+	step_name = get_step_name(i, colony)
+	mark_step('start', step_name, SECONDS_PER_PICK)
+	p.pick_up_tip()
+	# This aspirate ensures that the OT2 app realizes we are actually using this plate (so that it will 
+	# tell the user to calibrate for it).
+	p.aspirate(10, source_plates[colony['source']].wells(0))
+	robot.move_to((source_plates[colony['source']], Vector([colony['x'], colony['y'], PLATE_DEPTH])), p)
+	p.dispense(10, culture_block.wells(colony['well']))
+	p.aspirate(10)
+	p.dispense(10)
+	p.drop_tip()
+	mark_step('end', step_name)
@@ -0,0 +1,317 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# A queue is a folder (shared between hosts, e.g. on a network drive) with a subfolder for each state a job can be
+# in. Each job is a JSON file that moves between them: workers claim a job by renaming it from pending to claimed,
+# and write its result to done (or the job to failed once it has run out of attempts).
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [PENDING, CLAIMED, DONE, FAILED]
+
+# Workers touch the files of the jobs they have claimed this often (in seconds). A claimed job that hasn't been
+# touched for the queue's timeout is taken to belong to a lost worker and is requeued.
+HEARTBEAT_INTERVAL_S = 5
+
+# Seconds between checks of the queue by idle workers and by the generator waiting for results.
+POLL_INTERVAL_S = 0.5
+
+# Columns of OpenCFU's output that are sent back to the generator (see get_relative_locations and draw_previews).
+RESULT_COLUMNS = ['X', 'Y', 'IsValid', 'Radius', 'Area']
+
+logger = logging.getLogger(__name__)
+
+# Numbers jobs submitted by this process, so job ids are unique even within one second.
+_job_counter = itertools.count()
+
+
+#################################################################################################################
+# Queue folders and job files
+#################################################################################################################
+
+def get_state_folder(queue_path, state):
+	return os.path.join(queue_path, state)
+
+def get_job_filename(queue_path, state, job_id):
+	return os.path.join(queue_path, state, job_id + '.json')
+
+def create_queue(queue_path):
+	for state in STATES:
+		os.makedirs(get_state_folder(queue_path, state), exist_ok=True)
+
+# Writes a job (or result) file so that no other process ever sees it half written.
+def write_job(job, filename):
+	temp_filename = os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename) + '.tmp')
+	with open(temp_filename, 'w+') as f:
+		json.dump(job, f)
+	os.replace(temp_filename, filename)
+
+# Returns the job in filename, or None if it has been moved by another process.
+def read_job(filename):
+	try:
+		with open(filename) as f:
+			return json.load(f)
+	except (FileNotFoundError, ValueError):
+		return None
+
+def remove_file(filename):
+	try:
+		os.remove(filename)
+	except FileNotFoundError:
+		pass
+
+# Returns the ids of the jobs in one state, oldest first.
+def list_jobs(queue_path, state):
+	entries = [x for x in os.scandir(get_state_folder(queue_path, state)) if x.name.endswith('.json') and not x.name.startswith('.')]
+	entries.sort(key=lambda x: x.stat().st_mtime)
+	return [x.name[:-len('.json')] for x in entries]
+
+
+#################################################################################################################
+# Functions for the generator (submitting jobs and gathering results)
+#################################################################################################################
+
+# Adds a job to pre-process and run OpenCFU on one image (or the crop_box region of it). settings holds the arguments
+# of preprocess_images (inverted, blur_radius, brightness, contrast, background_filenames, intermediate_format,
+# compress_level and tile_memory_budget_mb) plus the 'temp_folder_path' to save the pre-processed image to, and the
+# 'opencfu_folder_path' and 'opencfu_arg_string'. Paths must be absolute and reachable from every worker. Returns the
+# id of the job.
+def submit(queue_path, image_filename, crop_box, settings, max_attempts):
+	job_id = '{0}_{1}_{2}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), next(_job_counter))
+	job = {
+		'id': job_id,
+		'image_filename': os.path.abspath(image_filename),
+		'crop_box': crop_box,
+		'settings': settings,
+		'attempts': 0,
+		'max_attempts': max_attempts,
+		'errors': []
+	}
+	write_job(job, get_job_filename(queue_path, PENDING, job_id))
+	return job_id
+
+# Moves a job back to pending (or to failed if it has used up its attempts), recording why.
+def requeue(queue_path, job, error):
+	job['attempts'] += 1
+	job['errors'].append(error)
+	state = FAILED if job['attempts'] >= job['max_attempts'] else PENDING
+	write_job(job, get_job_filename(queue_path, state, job['id']))
+	remove_file(get_job_filename(queue_path, CLAIMED, job['id']))
+	return state
+
+# Requeues claimed jobs whose worker hasn't touched them for timeout seconds (it has crashed, been killed or lost its
+# connection to the queue folder). If the worker was only slow, its result is still accepted when it arrives.
+def requeue_lost_jobs(queue_path, timeout):
+	num_requeued = 0
+	for job_id in list_jobs(queue_path, CLAIMED):
+		filename = get_job_filename(queue_path, CLAIMED, job_id)
+		try:
+			age = time.time() - os.stat(filename).st_mtime
+		except FileNotFoundError:
+			continue
+		job = read_job(filename)
+		if age < timeout or job is None or os.path.exists(get_job_filename(queue_path, DONE, job_id)):
+			continue
+		state = requeue(queue_path, job, 'worker {0} lost (no heartbeat for {1:.0f} s)'.format(job.get('worker'), age))
+		logger.warning('Detection job for %s was claimed by lost worker %s, moved to %s.', os.path.basename(job['image_filename']), job.get('worker'), state)
+		num_requeued += 1
+	return num_requeued
+
+# Waits for the results of job_ids, requeuing the jobs of lost workers. Returns the pre-processed image filename and the
+# (compact) OpenCFU output of each job, keyed by job id. Raises RuntimeError if any job failed on every attempt.
+def gather(queue_path, job_ids, timeout):
+	results = {}
+	last_report_time = time.time()
+	while len(results) < len(job_ids):
+		for job_id in job_ids:
+			if job_id in results:
+				continue
+			result = read_job(get_job_filename(queue_path, DONE, job_id))
+			if result is not None:
+				results[job_id] = result
+				continue
+			job = read_job(get_job_filename(queue_path, FAILED, job_id))
+			if job is not None:
+				raise RuntimeError('Detection failed for {0} after {1} attempt(s): {2}'.format(job['image_filename'], job['attempts'], '; '.join(job['errors'])))
+
+		if len(results) < len(job_ids):
+			requeue_lost_jobs(queue_path, timeout)
+			if time.time() - last_report_time > timeout:
+				logger.info('Waiting for %d detection job(s) in %s.', len(job_ids) - len(results), queue_path)
+				last_report_time = time.time()
+			time.sleep(POLL_INTERVAL_S)
+
+	# Clear up, including copies of jobs that were requeued but then finished by their original worker.
+	for job_id in job_ids:
+		for state in (PENDING, CLAIMED, DONE):
+			remove_file(get_job_filename(queue_path, state, job_id))
+	return results
+
+# Pre-processes and detects colonies in each (image filename, crop box) job on the queue's workers. Starts
+# num_local_workers worker processes on this machine for the duration (more can be started on other hosts with
+# the command line below). Returns the pre-processed image filenames (in the order of jobs) and their OpenCFU outputs
+# keyed by pre-processed image filename.
+def detect(queue_path, jobs, settings, timeout=60, max_attempts=3, num_local_workers=0):
+	# Workers that are alive must get the chance to send a heartbeat or two before they are given up on.
+	timeout = max(timeout, 2 * HEARTBEAT_INTERVAL_S)
+	create_queue(queue_path)
+	job_ids = [submit(queue_path, image_filename, crop_box, settings, max_attempts) for image_filename, crop_box in jobs]
+
+	local_workers = []
+	for i in range(0, min(num_local_workers, len(jobs))):
+		local_workers.append(multiprocessing.Process(target=work, args=(queue_path,), daemon=True))
+		local_workers[-1].start()
+
+	try:
+		results = gather(queue_path, job_ids, timeout)
+	finally:
+		for process in local_workers:
+			process.terminate()
+			process.join()
+
+	preprocessed_image_filenames = [results[x]['preprocessed_image_filename'] for x in job_ids]
+	opencfu_outputs = dict([(results[x]['preprocessed_image_filename'], results[x]['opencfu_output']) for x in job_ids])
+	for job_id in job_ids:
+		logger.debug('%s detected by %s in %.1f s.', os.path.basename(results[job_id]['preprocessed_image_filename']), results[job_id]['worker'], results[job_id]['seconds'])
+	return preprocessed_image_filenames, opencfu_outputs
+
+
+#################################################################################################################
+# Functions for workers
+#################################################################################################################
+
+def get_worker_name():
+	return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+# Claims the oldest pending job. Returns the job, or None if there are none.
+def claim(queue_path, worker_name):
+	for job_id in list_jobs(queue_path, PENDING):
+		pending_filename = get_job_filename(queue_path, PENDING, job_id)
+		claimed_filename = get_job_filename(queue_path, CLAIMED, job_id)
+		try:
+			# Renaming keeps the mtime, so touch the job first or it would look abandoned as soon as it is claimed.
+			os.utime(pending_filename)
+			os.rename(pending_filename, claimed_filename)
+		except (FileNotFoundError, FileExistsError, PermissionError):
+			# Another worker got there first.
+			continue
+		job = read_job(claimed_filename)
+		if job is None:
+			continue
+		job['worker'] = worker_name
+		write_job(job, claimed_filename)
+		return job
+	return None
+
+# Touches the files of claimed jobs every HEARTBEAT_INTERVAL_S until stop is set.
+def send_heartbeats(filename, stop):
+	while not stop.wait(HEARTBEAT_INTERVAL_S):
+		try:
+			os.utime(filename)
+		except FileNotFoundError:
+			# The job was requeued (we were too slow to be seen). Keep going, the result is still accepted.
+			pass
+
+# Pre-processes the job's image and runs OpenCFU on it. Returns the result to write to done.
+def process_job(job, opencfu_folder_path=None):
+	# Imported here as the generator itself imports this module.
+	from ot2_moclo_jove.colony_picking import colony_pick_generator
+
+	settings = job['settings']
+	start_time = time.perf_counter()
+	preprocessed_image_filenames, preprocessed_images = colony_pick_generator.preprocess_images(
+		[job['image_filename']],
+		settings['temp_folder_path'],
+		inverted=settings['inverted'],
+		blur_radius=settings['blur_radius'],
+		brightness=settings['brightness'],
+		contrast=settings['contrast'],
+		background_filenames=settings['background_filenames'],
+		intermediate_format=settings['intermediate_format'],
+		compress_level=settings['compress_level'],
+		crop_boxes=[tuple(job['crop_box']) if job['crop_box'] else None],
+		tile_memory_budget_mb=settings['tile_memory_budget_mb'])[:2]
+	opencfu_output = colony_pick_generator.detect_colonies(
+		opencfu_folder_path or settings['opencfu_folder_path'],
+		preprocessed_image_filenames[0],
+		settings['opencfu_arg_string'],
+		settings['coarse_detection_factor'],
+		preprocessed_images.get(preprocessed_image_filenames[0]),
+		settings['compress_level'])
+
+	return {
+		'id': job['id'],
+		'preprocessed_image_filename': preprocessed_image_filenames[0],
+		'opencfu_output': [dict((x, row[x]) for x in RESULT_COLUMNS if x in row) for row in opencfu_output],
+		'worker': job['worker'],
+		'seconds': time.perf_counter() - start_time
+	}
+
+# Runs jobs from the queue until stopped (or, if exit_when_idle, until there are none left). opencfu_folder_path
+# overrides the OpenCFU installation given in each job, for hosts where it is installed elsewhere.
+def work(queue_path, opencfu_folder_path=None, exit_when_idle=False):
+	create_queue(queue_path)
+	worker_name = get_worker_name()
+	logger.info('Worker %s started on %s.', worker_name, queue_path)
+	while True:
+		# Jobs claimed by other workers may yet be requeued, so only stop once those are done too. They are listed
+		# before looking for pending jobs as requeued jobs are moved to pending before being removed from claimed.
+		busy = list_jobs(queue_path, CLAIMED)
+		job = claim(queue_path, worker_name)
+		if job is None:
+			if exit_when_idle and not busy:
+				return
+			time.sleep(POLL_INTERVAL_S)
+			continue
+
+		claimed_filename = get_job_filename(queue_path, CLAIMED, job['id'])
+		stop = threading.Event()
+		heartbeat = threading.Thread(target=send_heartbeats, args=(claimed_filename, stop), daemon=True)
+		heartbeat.start()
+		try:
+			result = process_job(job, opencfu_folder_path)
+		except Exception as e:
+			state = requeue(queue_path, job, '{0}: {1}'.format(worker_name, e))
+			logger.warning('Detection of %s failed, moved to %s:\n%s', os.path.basename(job['image_filename']), state, traceback.format_exc())
+		else:
+			write_job(result, get_job_filename(queue_path, DONE, job['id']))
+			remove_file(claimed_filename)
+			logger.info('Detected %d colonies in %s.', len(result['opencfu_output']), os.path.basename(job['image_filename']))
+		finally:
+			stop.set()
+			heartbeat.join()
+
+
+#################################################################################################################
+# Start a worker or show the state of a queue from the command line
+# (python -m ot2_moclo_jove.colony_picking.detection_queue worker QUEUE_PATH)
+#################################################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run colony detection jobs from a queue folder shared with the colony picking generator, or show the jobs in it.')
+	parser.add_argument('command', choices=['worker', 'status'])
+	parser.add_argument('queue_path')
+	parser.add_argument('--opencfu-folder-path', help='OpenCFU installation folder on this host (by default the one in settings.yaml on the generator\'s host).')
+	parser.add_argument('--exit-when-idle', action='store_true', help='Stop once the queue is empty instead of waiting for more jobs.')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+	if args.command == 'worker':
+		work(args.queue_path, args.opencfu_folder_path, args.exit_when_idle)
+	else:
+		create_queue(args.queue_path)
+		for state in STATES:
+			print('{0}: {1}'.format(state, len(list_jobs(args.queue_path, state))))
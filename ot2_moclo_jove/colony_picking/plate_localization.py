@@ -0,0 +1,232 @@
+import json
+import logging
+import math
+import os
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Plates are found in a copy of the image downscaled so that its longest side is at most this many pixels.
+LOCALIZATION_MAX_SIZE = 400
+
+# Blobs smaller than this fraction of the downscaled image are not considered plates.
+MIN_PLATE_AREA_FRACTION = 0.02
+
+# Footprint of an SBS (96-well format) plate in mm. Used to predict where a plate's centre is from its A1 corner.
+PLATE_LENGTH_MM = 127.76
+PLATE_WIDTH_MM = 85.48
+
+logger = logging.getLogger(__name__)
+
+
+#################################################################################################################
+# Finding plates in an image
+#################################################################################################################
+
+# Returns the threshold that best separates a 256 bin histogram into two classes (Otsu's method).
+def get_otsu_threshold(histogram):
+	total = sum(histogram)
+	total_sum = sum(i * x for i, x in enumerate(histogram))
+	background_count = 0
+	background_sum = 0
+	best_threshold = 0
+	best_variance = -1
+	for i, count in enumerate(histogram):
+		background_count += count
+		background_sum += i * count
+		foreground_count = total - background_count
+		if not background_count or not foreground_count:
+			continue
+		mean_difference = background_sum / background_count - (total_sum - background_sum) / foreground_count
+		variance = background_count * foreground_count * mean_difference**2
+		if variance > best_variance:
+			best_variance = variance
+			best_threshold = i
+	return best_threshold
+
+# Returns a downscaled mask of an image (a list of rows of booleans) that is True where the plates are, and the
+# factor the image was downscaled by. Of the two sides of an Otsu threshold, the plates are taken to be the side that
+# touches the image border least.
+def get_plate_mask(image):
+	factor = max(1, int(math.ceil(max(image.size) / float(LOCALIZATION_MAX_SIZE))))
+	small = image.convert('L').reduce(factor)
+	width, height = small.size
+	threshold = get_otsu_threshold(small.histogram())
+	pixels = list(small.getdata())
+	bright = [[pixels[y * width + x] > threshold for x in range(0, width)] for y in range(0, height)]
+
+	border = [bright[0][x] for x in range(0, width)] + [bright[-1][x] for x in range(0, width)]
+	border += [bright[y][0] for y in range(0, height)] + [bright[y][-1] for y in range(0, height)]
+	if sum(border) > len(border) / 2:
+		bright = [[not x for x in row] for row in bright]
+	return bright, factor
+
+# Returns the blobs in a mask that are big enough to be plates and don't touch the border. Each blob has its 'centroid'
+# (x, y), the 'angle' in degrees of its long axis (from the x axis towards the y axis, between -90 and 90), its
+# 'length' and 'width' (of a rectangle with the same second moments) and its 'area', in downscaled pixels.
+def find_blobs(mask):
+	height = len(mask)
+	width = len(mask[0])
+	min_area = MIN_PLATE_AREA_FRACTION * width * height
+	seen = [[False] * width for y in range(0, height)]
+	blobs = []
+	for start_y in range(0, height):
+		for start_x in range(0, width):
+			if not mask[start_y][start_x] or seen[start_y][start_x]:
+				continue
+
+			# Flood fill the blob, accumulating its moments.
+			seen[start_y][start_x] = True
+			stack = [(start_x, start_y)]
+			n = sum_x = sum_y = sum_xx = sum_yy = sum_xy = 0
+			touches_border = False
+			while stack:
+				x, y = stack.pop()
+				n += 1
+				sum_x += x
+				sum_y += y
+				sum_xx += x * x
+				sum_yy += y * y
+				sum_xy += x * y
+				if x == 0 or y == 0 or x == width - 1 or y == height - 1:
+					touches_border = True
+				for next_x, next_y in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+					if 0 <= next_x < width and 0 <= next_y < height and mask[next_y][next_x] and not seen[next_y][next_x]:
+						seen[next_y][next_x] = True
+						stack.append((next_x, next_y))
+
+			if n < min_area or touches_border:
+				continue
+			mean_x = sum_x / n
+			mean_y = sum_y / n
+			mu_20 = sum_xx / n - mean_x**2
+			mu_02 = sum_yy / n - mean_y**2
+			mu_11 = sum_xy / n - mean_x * mean_y
+			spread = math.sqrt(((mu_20 - mu_02) / 2)**2 + mu_11**2)
+			blobs.append({
+				'centroid': (mean_x, mean_y),
+				'angle': math.degrees(0.5 * math.atan2(2 * mu_11, mu_20 - mu_02)),
+				'length': math.sqrt(12 * ((mu_20 + mu_02) / 2 + spread)),
+				'width': math.sqrt(12 * max((mu_20 + mu_02) / 2 - spread, 0)),
+				'area': n
+			})
+	return blobs
+
+# Returns the plate-sized blobs in an image, scaled back to full size pixels.
+def find_plates(image):
+	mask, factor = get_plate_mask(image)
+	plates = find_blobs(mask)
+	for plate in plates:
+		plate['centroid'] = ((plate['centroid'][0] + 0.5) * factor, (plate['centroid'][1] + 0.5) * factor)
+		plate['length'] *= factor
+		plate['width'] *= factor
+		plate['area'] *= factor**2
+	return plates
+
+
+#################################################################################################################
+# Fitting plate calibrations
+#################################################################################################################
+
+# Returns the difference between two angles in degrees, between -90 and 90 (the long axis of a plate has no direction).
+def get_axis_angle_difference(angle, reference_angle):
+	return (angle - reference_angle + 90) % 180 - 90
+
+# Returns where the centre of a plate should be (in pixels) given its calibration (the location of its A1 corner in the
+# image, rotate and pixels_per_mm, as in settings.yaml).
+def get_expected_centroid(calibration):
+	half_x = PLATE_LENGTH_MM / 2 * calibration['pixels_per_mm']
+	half_y = PLATE_WIDTH_MM / 2 * calibration['pixels_per_mm']
+	cosine = math.cos(math.radians(-calibration['rotate']))
+	sine = math.sin(math.radians(-calibration['rotate']))
+	return (
+		calibration['location']['x'] + half_x*cosine - half_y*sine,
+		calibration['location']['y'] + half_y*cosine + half_x*sine)
+
+# Returns the index of the plate in plates nearest to point (and not in used), or None if none are within max_distance.
+def get_nearest_plate(plates, point, max_distance, used):
+	best = None
+	best_distance = max_distance
+	for i, plate in enumerate(plates):
+		distance = math.hypot(plate['centroid'][0] - point[0], plate['centroid'][1] - point[1])
+		if not i in used and distance < best_distance:
+			best = i
+			best_distance = distance
+	return best
+
+# Moves a reference calibration by the translation, rotation and scale between a plate as found in the reference image
+# and as found now.
+def transform_calibration(reference, plate):
+	scale = math.sqrt(plate['area'] / reference['plate']['area'])
+	delta_angle = get_axis_angle_difference(plate['angle'], reference['plate']['angle'])
+	cosine = math.cos(math.radians(delta_angle))
+	sine = math.sin(math.radians(delta_angle))
+
+	# Vector from the plate centre to its A1 corner, rotated and scaled with the plate.
+	calibration = reference['calibration']
+	offset_x = calibration['location']['x'] - reference['plate']['centroid'][0]
+	offset_y = calibration['location']['y'] - reference['plate']['centroid'][1]
+	return {
+		'location': {
+			'x': plate['centroid'][0] + scale * (offset_x*cosine - offset_y*sine),
+			'y': plate['centroid'][1] + scale * (offset_y*cosine + offset_x*sine)
+		},
+		'rotate': calibration['rotate'] - delta_angle,
+		'pixels_per_mm': calibration['pixels_per_mm'] * scale
+	}
+
+def load_cache(cache_path):
+	if not os.path.exists(cache_path):
+		return {}
+	with open(cache_path) as cache_file:
+		return json.load(cache_file)
+
+def save_cache(cache, cache_path):
+	with open(cache_path, 'w+') as cache_file:
+		json.dump(cache, cache_file, indent=1, sort_keys=True)
+
+# Returns the calibration (a dict with the 'location' of the A1 corner in pixels, 'rotate' and 'pixels_per_mm') of
+# each plate in plate_locations for an image, with the plates found in the image itself.
+#
+# The first image of each imager setup (imager_setup and image size), or the first after the calibration in
+# settings.yaml changes, is taken as the reference: the plates found in it are matched to plate_locations and cached.
+# For later images each plate's calibration is moved by how far its plate has moved, turned and scaled since the
+# reference image. Plates that can't be found keep their calibration from settings.yaml.
+def locate_plates(image, plate_locations, rotate, pixels_per_mm, cache_path, imager_setup='default'):
+	calibrations = [{'location': location, 'rotate': rotate, 'pixels_per_mm': pixels_per_mm} for location in plate_locations]
+	plates = find_plates(image)
+	max_distance = PLATE_WIDTH_MM / 2 * pixels_per_mm
+
+	cache = load_cache(cache_path)
+	key = '{0} {1}x{2}'.format(imager_setup, *image.size)
+	entry = cache.get(key)
+	if not entry or entry['calibrations'] != calibrations:
+		# New reference: match plates to where settings.yaml says they are.
+		references = []
+		used = []
+		for calibration in calibrations:
+			i = get_nearest_plate(plates, get_expected_centroid(calibration), max_distance, used)
+			if i is None:
+				logger.warning('No plate found near %s in the reference image for %s.', calibration['location'], key)
+				references.append(None)
+			else:
+				used.append(i)
+				references.append({'calibration': calibration, 'plate': plates[i]})
+		cache[key] = {'calibrations': calibrations, 'references': references}
+		save_cache(cache, cache_path)
+		logger.info('Saved plate positions for %s as the reference for later images.', key)
+		return calibrations
+
+	fitted = []
+	used = []
+	for calibration, reference in zip(calibrations, entry['references']):
+		i = get_nearest_plate(plates, reference['plate']['centroid'], max_distance, used) if reference else None
+		if i is None:
+			logger.warning('Plate near %s not found, using its calibration from settings.', calibration['location'])
+			fitted.append(calibration)
+		else:
+			used.append(i)
+			fitted.append(transform_calibration(reference, plates[i]))
+	return fitted
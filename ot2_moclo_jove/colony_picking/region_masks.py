@@ -0,0 +1,377 @@
+import logging
+import math
+import os
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+from ot2_moclo_jove import incremental
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Label masks are rasterized in mm relative to corner A1 of the plate at this many pixels per mm.
+MASK_PIXELS_PER_MM = 10
+
+# Mask pixels within this many pixels of the edge of a region are labelled EDGE_LABEL, as are pixels where regions
+# overlap. Colonies on them are assigned by testing the exact shapes of the regions nearby, so picks don't depend on
+# how the shapes were rasterized.
+EDGE_MARGIN_PIXELS = 2
+
+# Labels are stored in an 8 bit mask: 0 is outside every region, cell n of the layout (see get_cells) is labelled
+# n + 1, and EDGE_LABEL marks edges and overlaps.
+EDGE_LABEL = 255
+MAX_CELLS = EDGE_LABEL - 1
+
+# Cells near a point are found from a grid of squares this many mm wide, each listing the cells that reach into it.
+CELL_BUCKET_MM = 5.0
+
+logger = logging.getLogger(__name__)
+
+# Cell geometry and masks already worked out in this run, by hash of their layout.
+_loaded_layouts = {}
+_loaded_masks = {}
+
+
+#################################################################################################################
+# Region layouts
+#################################################################################################################
+
+# Colony regions are given in settings.yaml either as a grid of identical circles or rectangles, or as a layout of
+# shapes, e.g. for staggered or irregular spot patterns:
+#
+# {type: shapes, cells: [
+# 	{row: 0, column: 0, shapes: [{circle: [x, y, r]}]},
+# 	{row: 0, column: 1, shapes: [{rectangle: [x_1, y_1, x_2, y_2]}, {polygon: [[x, y], [x, y], [x, y]]}]},
+# 	...]}
+#
+# Each cell is the region of one entry (row, column) of the source plate maps, and is the union of its shapes. All
+# coordinates are in mm relative to corner A1 of the plate.
+
+SHAPE_TYPES = ['circle', 'rectangle', 'polygon']
+
+# Returns the cells (a list of dicts with 'row', 'column' and 'shapes') of colony_regions, of any type.
+def get_cells(colony_regions):
+	if colony_regions['type'] == 'circle':
+		cells = []
+		for i in range(0, colony_regions['rows']):
+			for j in range(0, colony_regions['columns']):
+				x = colony_regions['x'] + j*colony_regions['x_spacing']
+				y = colony_regions['y'] + i*colony_regions['y_spacing']
+				cells.append({'row': i, 'column': j, 'shapes': [{'circle': [x, y, colony_regions['r']]}]})
+	elif colony_regions['type'] == 'rectangle':
+		cells = []
+		for i in range(0, colony_regions['rows']):
+			for j in range(0, colony_regions['columns']):
+				cells.append({'row': i, 'column': j, 'shapes': [{'rectangle': [
+					colony_regions['x_1'] + j*colony_regions['x_spacing'],
+					colony_regions['y_1'] + i*colony_regions['y_spacing'],
+					colony_regions['x_2'] + j*colony_regions['x_spacing'],
+					colony_regions['y_2'] + i*colony_regions['y_spacing']]}]})
+	elif colony_regions['type'] == 'shapes':
+		cells = colony_regions['cells']
+		positions = [(cell['row'], cell['column']) for cell in cells]
+		if len(set(positions)) < len(positions):
+			raise ValueError('Each row and column of colony_regions cells must be given only once.')
+		for cell in cells:
+			for shape in cell['shapes']:
+				if len(shape) != 1 or not list(shape)[0] in SHAPE_TYPES:
+					raise ValueError('Invalid colony_regions shape in row {0}, column {1}: {2}'.format(cell['row'], cell['column'], shape))
+	else:
+		raise ValueError('Invalid colony_regions type: {0}'.format(colony_regions['type']))
+
+	if len(cells) > MAX_CELLS:
+		raise ValueError('colony_regions has {0} cells, but at most {1} are supported.'.format(len(cells), MAX_CELLS))
+	return cells
+
+# Returns the cell of a layout (see load_layout) for row i, column j, or None if there isn't one.
+def get_cell(layout, i, j):
+	n = layout['positions'].get((i, j))
+	return layout['cells'][n] if n is not None else None
+
+# Returns the number of rows and columns of source plate map entries that cells cover.
+def get_grid_size(cells):
+	return (max([cell['row'] + 1 for cell in cells] or [0]), max([cell['column'] + 1 for cell in cells] or [0]))
+
+# Returns the (x_min, y_min, x_max, y_max) extent in mm of a shape.
+def get_shape_extent(shape):
+	shape_type, values = list(shape.items())[0]
+	if shape_type == 'circle':
+		x, y, r = values
+		return (x - r, y - r, x + r, y + r)
+	elif shape_type == 'rectangle':
+		x_1, y_1, x_2, y_2 = values
+		return (min(x_1, x_2), min(y_1, y_2), max(x_1, x_2), max(y_1, y_2))
+	else:
+		return (min(x for x, y in values), min(y for x, y in values), max(x for x, y in values), max(y for x, y in values))
+
+# Returns the (x_min, y_min, x_max, y_max) extent in mm of all shapes of cells.
+def get_cells_extent(cells):
+	extents = [get_shape_extent(shape) for cell in cells for shape in cell['shapes']]
+	if not extents:
+		raise ValueError('colony_regions has no shapes.')
+	return (min(x[0] for x in extents), min(x[1] for x in extents), max(x[2] for x in extents), max(x[3] for x in extents))
+
+
+# Returns the index (x, y) of the square of CELL_BUCKET_MM holding x, y in mm relative to corner A1.
+def get_bucket(x, y):
+	return (int(math.floor(x / CELL_BUCKET_MM)), int(math.floor(y / CELL_BUCKET_MM)))
+
+# Returns the geometry of the cells of colony_regions (any type), a dict of:
+# - 'cells': the cells of colony_regions (see get_cells); cell n is labelled n + 1 in masks.
+# - 'positions': the index of the cell of each (row, column).
+# - 'extents': the extent in mm of each cell (see get_cells_extent).
+# - 'buckets': the indices of the cells whose extent (plus the edge margin of masks) reaches into each square of
+#   CELL_BUCKET_MM, by index of the square (see get_bucket), in order.
+#
+# It is worked out once per layout, so finding a cell by position or near a point doesn't go through every cell.
+def load_layout(colony_regions):
+	key = incremental.get_hash(colony_regions)
+	if key in _loaded_layouts:
+		return _loaded_layouts[key]
+
+	cells = get_cells(colony_regions)
+	extents = [get_cells_extent([cell]) for cell in cells]
+	margin = (EDGE_MARGIN_PIXELS + 1) / float(MASK_PIXELS_PER_MM)
+	buckets = {}
+	for n, (x_min, y_min, x_max, y_max) in enumerate(extents):
+		u_min, v_min = get_bucket(x_min - margin, y_min - margin)
+		u_max, v_max = get_bucket(x_max + margin, y_max + margin)
+		for u in range(u_min, u_max + 1):
+			for v in range(v_min, v_max + 1):
+				buckets.setdefault((u, v), []).append(n)
+
+	layout = {
+		'cells': cells,
+		'positions': {(cell['row'], cell['column']): n for n, cell in enumerate(cells)},
+		'extents': extents,
+		'buckets': buckets
+	}
+	_loaded_layouts[key] = layout
+	return layout
+
+
+#################################################################################################################
+# Distances to the edges of regions
+#################################################################################################################
+
+# Returns the distance in mm from a colony (relative to plate_origin) to the nearest edge of a shape (negative if
+# outside the shape). Circles and rectangles are measured as the grids of get_region_edge_distance in
+# colony_pick_generator.py are, so both give the same distances.
+def get_shape_edge_distance(colony, shape, plate_origin):
+	shape_type, values = list(shape.items())[0]
+	if shape_type == 'circle':
+		x, y, r = values
+		delta_x = colony['x'] - (x - plate_origin['x'])
+		delta_y = colony['y'] - (y - plate_origin['y'])
+		return r - (delta_x**2 + delta_y**2)**0.5
+
+	elif shape_type == 'rectangle':
+		x_1, y_1, x_2, y_2 = values
+		x_min = x_1 - plate_origin['x']
+		x_max = x_2 - plate_origin['x']
+		y_min = y_1 - plate_origin['y']
+		y_max = y_2 - plate_origin['y']
+		return min(colony['x'] - x_min, x_max - colony['x'], colony['y'] - y_min, y_max - colony['y'])
+
+	else:
+		# Polygons: inside by the even-odd rule, distance to the nearest point of any side.
+		x = colony['x'] + plate_origin['x']
+		y = colony['y'] + plate_origin['y']
+		inside = False
+		distance = float('inf')
+		for (x_1, y_1), (x_2, y_2) in zip(values, values[1:] + values[:1]):
+			if (y_1 > y) != (y_2 > y) and x < x_1 + (y - y_1) * (x_2 - x_1) / (y_2 - y_1):
+				inside = not inside
+			delta_x = x_2 - x_1
+			delta_y = y_2 - y_1
+			length_squared = delta_x**2 + delta_y**2
+			t = max(0, min(1, ((x - x_1)*delta_x + (y - y_1)*delta_y) / length_squared)) if length_squared else 0
+			distance = min(distance, ((x - x_1 - t*delta_x)**2 + (y - y_1 - t*delta_y)**2)**0.5)
+		return distance if inside else -distance
+
+# Returns the distance in mm from a colony to the nearest edge of a cell, i.e. to that of the shape of the cell it is
+# deepest inside (negative if outside every shape).
+def get_cell_edge_distance(colony, cell, plate_origin):
+	return max(get_shape_edge_distance(colony, shape, plate_origin) for shape in cell['shapes'])
+
+
+#################################################################################################################
+# Compiling label masks
+#################################################################################################################
+
+# Returns the offset (in mask pixels, of the mask's top left pixel from corner A1) and size of the mask of cells.
+def get_mask_geometry(cells, pixels_per_mm):
+	x_min, y_min, x_max, y_max = get_cells_extent(cells)
+	margin = EDGE_MARGIN_PIXELS + 1
+	offset = (int(math.floor(x_min * pixels_per_mm)) - margin, int(math.floor(y_min * pixels_per_mm)) - margin)
+	size = (
+		int(math.ceil(x_max * pixels_per_mm)) + margin - offset[0],
+		int(math.ceil(y_max * pixels_per_mm)) + margin - offset[1])
+	return offset, size
+
+# Draws a shape with fill, where mm is converted to image coordinates by (x * pixels_per_mm - offset_x, ...).
+def draw_shape(draw, shape, pixels_per_mm, offset, fill):
+	shape_type, values = list(shape.items())[0]
+	# Pixel i covers [i, i + 1) mask pixels from the offset, so its centre is drawn at i + 0.5.
+	to_x = lambda x: x * pixels_per_mm - offset[0] - 0.5
+	to_y = lambda y: y * pixels_per_mm - offset[1] - 0.5
+	x_min, y_min, x_max, y_max = get_shape_extent(shape)
+	if shape_type == 'circle':
+		draw.ellipse((to_x(x_min), to_y(y_min), to_x(x_max), to_y(y_max)), fill=fill)
+	elif shape_type == 'rectangle':
+		draw.rectangle((to_x(x_min), to_y(y_min), to_x(x_max), to_y(y_max)), fill=fill)
+	else:
+		draw.polygon([(to_x(x), to_y(y)) for x, y in values], fill=fill)
+
+# Returns an 8 bit image of the label of each pixel of the mask of cells (see EDGE_LABEL). Pixels covered by more than
+# one cell are labelled EDGE_LABEL.
+def rasterize_cells(cells, pixels_per_mm, offset, size):
+	labels = Image.new('L', size, 0)
+	coverage = Image.new('L', size, 0)
+	for n, cell in enumerate(cells):
+		# Each cell is drawn into a crop of its own extent, then counted into the coverage and pasted into the labels.
+		x_min, y_min, x_max, y_max = get_cells_extent([cell])
+		box = (
+			int(math.floor(x_min * pixels_per_mm)) - offset[0] - 1,
+			int(math.floor(y_min * pixels_per_mm)) - offset[1] - 1,
+			int(math.ceil(x_max * pixels_per_mm)) - offset[0] + 1,
+			int(math.ceil(y_max * pixels_per_mm)) - offset[1] + 1)
+		crop = Image.new('L', (box[2] - box[0], box[3] - box[1]), 0)
+		draw = ImageDraw.Draw(crop)
+		for shape in cell['shapes']:
+			draw_shape(draw, shape, pixels_per_mm, (offset[0] + box[0], offset[1] + box[1]), 1)
+		coverage.paste(ImageChops.add(coverage.crop(box), crop), box)
+		labels.paste(n + 1, box, crop.point([0] + [255] * 255))
+
+	labels.paste(EDGE_LABEL, (0, 0), coverage.point([0, 0] + [255] * 254))
+	return labels
+
+# Returns the labels with every pixel within EDGE_MARGIN_PIXELS of a change of label set to EDGE_LABEL. Everywhere
+# else the label is that of every shape the pixel could touch, so it can be used without testing the shapes.
+def mark_edges(labels):
+	size = 2 * EDGE_MARGIN_PIXELS + 1
+	changes = ImageChops.difference(labels.filter(ImageFilter.MaxFilter(size)), labels.filter(ImageFilter.MinFilter(size)))
+	lookup = labels.copy()
+	lookup.paste(EDGE_LABEL, (0, 0), changes.point([0] + [255] * 255))
+	return lookup
+
+# Returns the label mask of colony_regions (any type), a dict of:
+# - 'layout': the geometry of the cells of colony_regions (see load_layout).
+# - 'cells', 'rows' and 'columns': the cells of colony_regions and the number of rows and columns they cover.
+# - 'pixels_per_mm', 'offset' and 'size': the scale, offset from corner A1 and size of the mask in pixels.
+# - 'labels': the rasterized cells (see rasterize_cells), used to draw previews.
+# - 'lookup' and 'pixels': the labels with edges marked (see mark_edges), and their pixel access for get_label.
+#
+# The labels only depend on the layout (as colony coordinates are relative to the calibration point, not the image),
+# so they are compiled once and saved to cache_folder_path (if set) for later runs.
+def load_mask(colony_regions, cache_folder_path=None):
+	key = incremental.get_hash([colony_regions, MASK_PIXELS_PER_MM])
+	if key in _loaded_masks:
+		return _loaded_masks[key]
+
+	layout = load_layout(colony_regions)
+	cells = layout['cells']
+	offset, size = get_mask_geometry(cells, MASK_PIXELS_PER_MM)
+	cache_filename = os.path.join(cache_folder_path, 'region_mask_{0}.png'.format(key)) if cache_folder_path else None
+	labels = None
+	if cache_filename and os.path.exists(cache_filename):
+		labels = Image.open(cache_filename)
+		labels.load()
+		if labels.mode != 'L' or labels.size != size:
+			logger.warning('Ignoring region mask %s, which doesn\'t match its layout.', cache_filename)
+			labels = None
+	if labels is None:
+		labels = rasterize_cells(cells, MASK_PIXELS_PER_MM, offset, size)
+		if cache_filename:
+			os.makedirs(cache_folder_path, exist_ok=True)
+			labels.save(cache_filename)
+		logger.debug('Compiled region mask of %d cells (%dx%d pixels).', len(cells), size[0], size[1])
+	for cell, extent in zip(cells, layout['extents']):
+		logger.debug('Colony region %d, %d: %s', cell['row'], cell['column'], extent)
+
+	lookup = mark_edges(labels)
+	rows, columns = get_grid_size(cells)
+	mask = {
+		'layout': layout,
+		'cells': cells,
+		'rows': rows,
+		'columns': columns,
+		'pixels_per_mm': MASK_PIXELS_PER_MM,
+		'offset': offset,
+		'size': size,
+		'labels': labels,
+		'lookup': lookup,
+		'pixels': lookup.load()
+	}
+	_loaded_masks[key] = mask
+	return mask
+
+
+#################################################################################################################
+# Assigning colonies to regions
+#################################################################################################################
+
+# Returns the label (see EDGE_LABEL) of the mask at x, y in mm relative to corner A1.
+def get_label(mask, x, y):
+	u = int(math.floor(x * mask['pixels_per_mm'])) - mask['offset'][0]
+	v = int(math.floor(y * mask['pixels_per_mm'])) - mask['offset'][1]
+	if 0 <= u < mask['size'][0] and 0 <= v < mask['size'][1]:
+		return mask['pixels'][u, v]
+	return 0
+
+# Returns the indices of the cells whose extent (plus the edge margin) contains x, y in mm relative to corner A1. Only
+# the cells listed in the square of x, y (see load_layout) are tested.
+def get_nearby_cells(mask, x, y):
+	layout = mask['layout']
+	margin = (EDGE_MARGIN_PIXELS + 1) / float(mask['pixels_per_mm'])
+	nearby_cells = []
+	for n in layout['buckets'].get(get_bucket(x, y), []):
+		x_min, y_min, x_max, y_max = layout['extents'][n]
+		if x_min - margin <= x <= x_max + margin and y_min - margin <= y <= y_max + margin:
+			nearby_cells.append(n)
+	return nearby_cells
+
+# Returns the colonies (relative to plate_origin) inside each region of the mask, as a dict of (row, column) to a list
+# of (colony, edge distance) in the order of colony_locations. Each colony's region is looked up in the mask; only
+# colonies on the edge of a region are tested against the shapes of the cells around them.
+def assign_colonies(mask, colony_locations, plate_origin):
+	colonies_by_region = {}
+	for colony in colony_locations:
+		x = colony['x'] + plate_origin['x']
+		y = colony['y'] + plate_origin['y']
+		label = get_label(mask, x, y)
+		if label == 0:
+			continue
+		for n in ([label - 1] if label != EDGE_LABEL else get_nearby_cells(mask, x, y)):
+			cell = mask['cells'][n]
+			edge_dist = get_cell_edge_distance(colony, cell, plate_origin)
+			if edge_dist > 0:
+				colonies_by_region.setdefault((cell['row'], cell['column']), []).append((colony, edge_dist))
+
+	return colonies_by_region
+
+
+#################################################################################################################
+# Drawing regions
+#################################################################################################################
+
+# Returns the labels of the mask resampled onto an image of size, of a plate whose corner A1 is at plate_location
+# (in pixels), rotated by rotate at pixels_per_mm (see get_image_location in colony_pick_generator.py).
+def get_image_labels(mask, size, plate_location, rotate, pixels_per_mm):
+	# Each image pixel is mapped back to mm (as get_relative_locations does) and on to mask pixels.
+	scale = mask['pixels_per_mm'] / float(pixels_per_mm)
+	cosine = math.cos(math.radians(rotate))
+	sine = math.sin(math.radians(rotate))
+	transform = (
+		cosine * scale,
+		-sine * scale,
+		(-plate_location['x']*cosine + plate_location['y']*sine) * scale - mask['offset'][0],
+		sine * scale,
+		cosine * scale,
+		(-plate_location['y']*cosine - plate_location['x']*sine) * scale - mask['offset'][1])
+	return mask['labels'].transform(size, Image.AFFINE, transform, resample=Image.NEAREST, fillcolor=0)
+
+# Returns a mask image (255 on the outlines) of the regions of a labels image.
+def get_outlines(labels):
+	changes = ImageChops.difference(labels.filter(ImageFilter.MaxFilter(3)), labels)
+	return changes.point([0] + [255] * 255)
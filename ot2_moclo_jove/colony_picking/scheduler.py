@@ -0,0 +1,224 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from ot2_moclo_jove import instrumentation
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# The worker count of an adaptive stage is reconsidered each time this many jobs (and at least one per worker) have
+# finished since the last decision, comparing the throughput with that of the last window.
+MIN_WINDOW_JOBS = 2
+
+# An extra worker is kept only if it raised throughput by more than this fraction. Otherwise the stage goes back to
+# the previous count and stays there.
+MIN_GAIN = 0.1
+
+# No worker is added while the process (and its child processes, e.g. OpenCFU) already keeps this fraction of the
+# CPU budget busy.
+CPU_HEADROOM = 0.9
+
+logger = logging.getLogger(__name__)
+
+# Worker count each adaptive stage ended on, so later calls in the same run (e.g. the next batch of images) start from
+# there rather than from one worker.
+_last_workers = {}
+
+
+#################################################################################################################
+# Running jobs
+#################################################################################################################
+
+# Runs function on each job on up to max_workers threads and returns the results in the order of jobs.
+#
+# If prepare is given, prepare(job) is called on the calling thread as each job is admitted and its result passed to
+# function instead (e.g. to decode images in order). Jobs are admitted while there are fewer than the stage's workers
+# plus its queue depth running or waiting to run, and while the memory_of(job) (an estimate in bytes) of the admitted
+# jobs fits memory_budget_mb. A job is always admitted if nothing else is, however large.
+#
+# If adaptive is True the stage starts with one worker and adds workers while doing so raises its throughput, the
+# process keeps less than cpu_budget cores busy and max_workers is not reached (see update_controller). Otherwise it
+# runs max_workers jobs at once, as a plain thread pool would. The decisions and throughput of each stage are logged
+# and added to the run's trace (see instrumentation.note).
+def run_jobs(stage_name, jobs, function, max_workers=1, adaptive=False, cpu_budget=None, memory_budget_mb=None, memory_of=None, prepare=None):
+	controller = start_controller(stage_name, max_workers, adaptive, cpu_budget, memory_budget_mb)
+	results = [None] * len(jobs)
+	running = {}
+	next_job = 0
+	next_memory = None
+
+	# Queued jobs wait in their threads for a worker (see run_job), so there are threads for them as well.
+	with ThreadPoolExecutor(max_workers=2 * controller['max_workers']) as executor:
+		while next_job < len(jobs) or running:
+			while next_job < len(jobs):
+				if next_memory is None:
+					next_memory = memory_of(jobs[next_job]) if memory_of else 0
+				if not can_admit(controller, len(running), next_memory):
+					break
+				job = prepare(jobs[next_job]) if prepare else jobs[next_job]
+				with controller['condition']:
+					controller['queued'] += 1
+					controller['all_admitted'] = next_job + 1 == len(jobs)
+				running[executor.submit(run_job, controller, function, job)] = (next_job, next_memory)
+				controller['memory_in_use'] += next_memory
+				controller['peak_memory'] = max(controller['peak_memory'], controller['memory_in_use'])
+				next_job += 1
+				next_memory = None
+
+			done, not_done = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				index, memory = running.pop(future)
+				results[index] = future.result()
+				controller['memory_in_use'] -= memory
+				update_controller(controller)
+
+	finish_controller(controller, len(jobs))
+	return results
+
+# Runs function(job) once one of the stage's workers is free.
+def run_job(controller, function, job):
+	with controller['condition']:
+		controller['condition'].wait_for(lambda: controller['active'] < controller['workers'])
+		controller['queued'] -= 1
+		controller['active'] += 1
+		controller['peak_workers'] = max(controller['peak_workers'], controller['active'])
+	try:
+		return function(job)
+	finally:
+		with controller['condition']:
+			controller['active'] -= 1
+			# A worker freed with more jobs to come but none queued for it is left waiting for jobs to be admitted.
+			if controller['queued'] == 0 and not controller['all_admitted']:
+				controller['window']['starved'] = True
+			controller['condition'].notify_all()
+
+
+#################################################################################################################
+# Choosing worker counts
+#################################################################################################################
+
+# CPU time in seconds used so far by this process and its finished child processes (child times are 0 on Windows).
+def get_cpu_seconds():
+	times = os.times()
+	return time.process_time() + times.children_user + times.children_system
+
+def start_controller(stage_name, max_workers, adaptive, cpu_budget=None, memory_budget_mb=None):
+	max_workers = max(1, max_workers)
+	workers = min(_last_workers.get(stage_name, 1), max_workers) if adaptive else max_workers
+	return {
+		'stage': stage_name,
+		'adaptive': adaptive,
+		'max_workers': max_workers,
+		'cpu_budget': cpu_budget or os.cpu_count() or 1,
+		'memory_budget': memory_budget_mb * 1024 * 1024 if memory_budget_mb else None,
+		'workers': workers,
+		'queue_depth': 1 if adaptive else max_workers,
+		'settled': False,
+		'last_change': 0,
+		'last_throughput': None,
+		'queued': 0,
+		'active': 0,
+		'all_admitted': False,
+		'memory_bound': False,
+		'peak_workers': 0,
+		'memory_in_use': 0,
+		'peak_memory': 0,
+		'condition': threading.Condition(),
+		'start_time': time.perf_counter(),
+		'window': new_window(),
+		'decisions': []
+	}
+
+def new_window():
+	return {'jobs': 0, 'start_time': time.perf_counter(), 'cpu_seconds': get_cpu_seconds(), 'starved': False, 'memory_bound': False}
+
+# Returns True if a job needing memory bytes can be admitted while running jobs are running or queued.
+def can_admit(controller, running, memory):
+	if running >= controller['workers'] + controller['queue_depth']:
+		return False
+	if running and controller['memory_budget'] is not None and controller['memory_in_use'] + memory > controller['memory_budget']:
+		controller['window']['memory_bound'] = True
+		return False
+	return True
+
+# Called after each job finishes. Once a window of jobs has finished, decides the worker count and queue depth for the
+# next window from the throughput (jobs per minute) and CPU use measured over this one:
+# - Hitting the memory budget shrinks the queue depth and settles the stage (it adds no more workers or depth).
+# - A worker added in the last window is removed again (and the stage settles) unless throughput rose by MIN_GAIN.
+# - Otherwise a worker is added, unless the stage has settled or is at max_workers or the CPU budget.
+# - The queue depth grows (up to max_workers) while workers are left waiting for jobs to be admitted.
+def update_controller(controller):
+	window = controller['window']
+	window['jobs'] += 1
+	if not controller['adaptive'] or window['jobs'] < max(MIN_WINDOW_JOBS, controller['workers']):
+		return
+
+	seconds = max(time.perf_counter() - window['start_time'], 1e-6)
+	throughput = 60 * window['jobs'] / seconds
+	cpu_cores = (get_cpu_seconds() - window['cpu_seconds']) / seconds
+	last_throughput = controller['last_throughput']
+	change = 0
+	if window['memory_bound']:
+		reason = 'memory budget'
+		controller['queue_depth'] = max(0, controller['queue_depth'] - 1)
+		controller['settled'] = True
+		controller['memory_bound'] = True
+	elif controller['last_change'] > 0 and throughput <= last_throughput * (1 + MIN_GAIN):
+		reason = 'no gain from last worker'
+		change = -1
+		controller['settled'] = True
+	elif controller['settled']:
+		reason = 'settled'
+	elif controller['workers'] >= controller['max_workers']:
+		reason = 'max_workers'
+	elif cpu_cores >= CPU_HEADROOM * controller['cpu_budget']:
+		reason = 'cpu budget'
+	else:
+		reason = 'scaling up'
+		change = 1
+	if window['starved'] and not controller['memory_bound']:
+		controller['queue_depth'] = min(controller['queue_depth'] + 1, controller['max_workers'])
+
+	with controller['condition']:
+		controller['workers'] += change
+		controller['condition'].notify_all()
+	controller['last_change'] = change
+	# After removing a worker, the throughput to beat is that of the count returned to.
+	controller['last_throughput'] = last_throughput if change < 0 else throughput
+	controller['decisions'].append({
+		'jobs_per_minute': round(throughput, 1),
+		'cpu_cores': round(cpu_cores, 2),
+		'memory_mb': round(controller['peak_memory'] / 1024 / 1024, 1),
+		'workers': controller['workers'],
+		'queue_depth': controller['queue_depth'],
+		'reason': reason
+	})
+	logger.debug('%s: %.1f jobs/min on %.2f cores -> %d worker(s), queue depth %d (%s).', controller['stage'], throughput, cpu_cores, controller['workers'], controller['queue_depth'], reason)
+	controller['window'] = new_window()
+
+# Logs the throughput of a stage and adds it, with the decisions made, to the run's trace.
+def finish_controller(controller, num_jobs):
+	if controller['adaptive']:
+		_last_workers[controller['stage']] = controller['workers']
+	seconds = time.perf_counter() - controller['start_time']
+	summary = {
+		'stage': controller['stage'],
+		'jobs': num_jobs,
+		'seconds': round(seconds, 3),
+		'jobs_per_minute': round(60 * num_jobs / seconds, 1) if seconds else None,
+		'adaptive': controller['adaptive'],
+		'workers': controller['workers'],
+		'peak_workers': controller['peak_workers'],
+		'peak_memory_mb': round(controller['peak_memory'] / 1024 / 1024, 1),
+		'decisions': controller['decisions']
+	}
+	instrumentation.note('scheduler', summary)
+	if num_jobs:
+		logger.log(
+			logging.INFO if controller['adaptive'] else logging.DEBUG,
+			'%s: %d job(s) at %.1f per minute on up to %d worker(s), ending on %d after %d decision(s).',
+			controller['stage'], num_jobs, summary['jobs_per_minute'] or 0, controller['peak_workers'], controller['workers'], len(controller['decisions']))
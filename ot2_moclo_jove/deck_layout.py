@@ -0,0 +1,129 @@
+import csv
+import itertools
+import math
+from collections import Counter
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Centre to centre distances (in mm) between neighbouring OT2 deck slots. Slots are numbered left to right and front
+# to back: 1-3 is the front row, 10-12 the back row.
+SLOT_WIDTH_MM = 132.5
+SLOT_DEPTH_MM = 90.5
+
+# The fixed trash occupies slot 12. Moves to it (dropping tips) are included in the travel estimate.
+TRASH = 'trash'
+TRASH_SLOT = '12'
+
+
+#################################################################################################################
+# Planned moves
+#################################################################################################################
+
+# Moves are counted in a Counter keyed by (sorted) pairs of labware names. The generators build these from what the
+# protocol is going to do, before the protocol exists, so they are an estimate of the travel rather than a trace.
+
+def add_path(moves, path, count=1):
+	# Adds the moves between consecutive labware in path (e.g. ['tiprack', 'trough', 'reaction plate', TRASH])
+	# count times.
+	for start, end in zip(path, path[1:]):
+		if start != end:
+			moves[tuple(sorted((start, end)))] += count
+
+def get_slot_position(slot):
+	# Returns the (x, y) position in mm of the centre of a slot relative to the centre of slot 1.
+	index = int(slot) - 1
+	return (index % 3 * SLOT_WIDTH_MM, index // 3 * SLOT_DEPTH_MM)
+
+def get_slot_distance(slot_a, slot_b):
+	(x_a, y_a), (x_b, y_b) = get_slot_position(slot_a), get_slot_position(slot_b)
+	return math.hypot(x_a - x_b, y_a - y_b)
+
+def get_travel(layout, moves):
+	# Returns the total distance in mm travelled between slots by a set of moves for a layout (a dict of labware
+	# name to slot). Moves involving labware without a slot are ignored.
+	travel = 0.0
+	for (a, b), count in moves.items():
+		if a in layout and b in layout:
+			travel += count * get_slot_distance(layout[a], layout[b])
+	return travel
+
+
+#################################################################################################################
+# Finding layouts
+#################################################################################################################
+
+def get_load_order_layout(labware_names, available_slots, fixed_slots=None):
+	# Returns the layout the templates used before layouts were optimized, where each piece of labware (in load
+	# order) takes the last remaining slot in available_slots.
+	layout = {TRASH: TRASH_SLOT}
+	layout.update(fixed_slots or {})
+	slots = list(available_slots)
+	for name in labware_names:
+		layout[name] = slots.pop()
+	return layout
+
+def solve_layout(labware_names, moves, available_slots, fixed_slots=None):
+	# Assigns each piece of labware in labware_names to one of available_slots, keeping labware that is often moved
+	# between close together. fixed_slots maps labware that can't be moved (e.g. plates on modules) to their slots.
+	# The most visited labware is placed first (each in the slot closest to what is already placed), then pairs of
+	# slots are swapped while that reduces the travel.
+	if len(labware_names) > len(available_slots):
+		raise ValueError("Not enough deck slots for {0} pieces of labware (only {1} available).".format(len(labware_names), len(available_slots)))
+
+	layout = {TRASH: TRASH_SLOT}
+	layout.update(fixed_slots or {})
+
+	visits = Counter()
+	for (a, b), count in moves.items():
+		visits[a] += count
+		visits[b] += count
+
+	# Greedy placement. Ties are broken by slot number so the result doesn't depend on the order of available_slots.
+	free_slots = sorted(available_slots, key=int)
+	for name in sorted(labware_names, key=lambda x: -visits[x]):
+		slot = min(free_slots, key=lambda x: get_travel(dict(layout, **{name: x}), moves))
+		layout[name] = slot
+		free_slots.remove(slot)
+
+	# Improve by swapping pairs of labware, or moving labware into an empty slot.
+	improved = True
+	while improved:
+		improved = False
+		travel = get_travel(layout, moves)
+		for a, b in itertools.combinations(list(labware_names) + free_slots, 2):
+			candidate = dict(layout)
+			free_candidate = list(free_slots)
+			if a in layout and b in layout:
+				candidate[a], candidate[b] = layout[b], layout[a]
+			elif a in layout:
+				candidate[a] = b
+				free_candidate[free_candidate.index(b)] = layout[a]
+			else:
+				continue
+			if get_travel(candidate, moves) < travel - 1e-9:
+				layout, free_slots = candidate, free_candidate
+				improved = True
+				break
+	return layout
+
+
+#################################################################################################################
+# Output
+#################################################################################################################
+
+def write_slot_map(layout, filename):
+	# Writes the slot each piece of labware should be put in, for the operator setting up the deck.
+	with open(filename, 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['Slot', 'Labware'])
+		for name, slot in sorted(layout.items(), key=lambda x: int(x[1])):
+			writer.writerow([slot, name])
+
+def get_travel_comment(layout, default_layout, moves):
+	# Returns a comment to paste into a protocol with the estimated travel saved by a layout.
+	travel = get_travel(layout, moves)
+	default_travel = get_travel(default_layout, moves)
+	return '# Deck layout: estimated {0:.1f} m of travel between slots ({1:.1f} m with the default slot order).\n'.format(travel / 1000, default_travel / 1000)
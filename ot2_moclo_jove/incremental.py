@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+from ot2_moclo_jove import instrumentation
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Manifests are saved in the output folder of each generator as .<name>_manifest.json.
+MANIFEST_FILENAME = '.{0}_manifest.json'
+
+# Folder of the ot2_moclo_jove package, whose source is hashed (see get_code_hash).
+PACKAGE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+# Hash of the package source, computed once per process.
+_code_hash = {}
+
+
+#################################################################################################################
+# Hashing inputs
+#################################################################################################################
+
+# A manifest records, for each output (a file, or an intermediate result such as OpenCFU's detections for an image),
+# the hash of everything it was built from, the hash of the code that built it and the fingerprint of each file
+# written for it. An output is reused if its dependencies and the code hash the same and its files haven't changed (or
+# been deleted) since it was built.
+
+def get_hash(value):
+	# Hash of any JSON-serializable value (settings, plate maps, detections, etc.).
+	return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def get_file_hash(filename):
+	# Hash of the contents of a small file (e.g. a protocol template).
+	with open(filename, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def get_file_fingerprint(filename):
+	# Cheap stand-in for the hash of a large file (e.g. an image): its path, modification time and size.
+	stat = os.stat(filename)
+	return [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+
+def get_code_hash():
+	# Hash of every Python file in the package (generators, templates and the modules they use), so that outputs built
+	# by another version of the code are rebuilt.
+	if not 'value' in _code_hash:
+		code_hash = hashlib.sha1()
+		for folder, folder_names, filenames in os.walk(PACKAGE_FOLDER):
+			folder_names[:] = sorted(x for x in folder_names if x != '__pycache__')
+			for filename in sorted(x for x in filenames if x.endswith('.py')):
+				path = os.path.join(folder, filename)
+				code_hash.update(os.path.relpath(path, PACKAGE_FOLDER).encode('utf-8'))
+				code_hash.update(get_file_hash(path).encode('utf-8'))
+		_code_hash['value'] = code_hash.hexdigest()
+	return _code_hash['value']
+
+
+#################################################################################################################
+# Manifests
+#################################################################################################################
+
+def load_manifest(folder_path, name, enabled=True):
+	# Loads the manifest of a generator's outputs in folder_path. If enabled is False nothing is reused, but the
+	# manifest is still kept up to date for later runs.
+	filename = os.path.join(folder_path, MANIFEST_FILENAME.format(name))
+	entries = {}
+	if os.path.exists(filename):
+		with open(filename) as manifest_file:
+			entries = json.load(manifest_file)
+	return {'filename': filename, 'enabled': enabled, 'code': get_code_hash(), 'entries': entries, 'reused': [], 'built': []}
+
+def save_manifest(manifest):
+	# Saves a manifest and reports what was reused, rebuilt and removed in this run.
+	removed_filenames = remove_stale_outputs(manifest)
+	with open(manifest['filename'], 'w+') as manifest_file:
+		json.dump(manifest['entries'], manifest_file, indent=1, sort_keys=True)
+
+	instrumentation.count('outputs_reused', len(manifest['reused']))
+	instrumentation.count('outputs_built', len(manifest['built']))
+	instrumentation.count('outputs_removed', len(removed_filenames))
+	logger.info('Reused %d output(s), rebuilt %d, removed %d stale file(s).', len(manifest['reused']), len(manifest['built']), len(removed_filenames))
+	for key in manifest['reused']:
+		logger.debug('Reused %s', key)
+	for key in manifest['built']:
+		logger.debug('Rebuilt %s', key)
+	for filename in removed_filenames:
+		logger.debug('Removed %s', filename)
+
+def remove_stale_outputs(manifest):
+	# Outputs recorded by earlier runs that were neither reused nor rebuilt in this one are no longer produced (e.g. an
+	# agar plate map after the number of combinations went down), so they are dropped from the manifest and their files
+	# deleted. Files still written for another output, and files changed since they were built (e.g. edited by hand),
+	# are kept. Returns the deleted filenames.
+	current_keys = set(manifest['reused'] + manifest['built'])
+	current_filenames = set(x[0] for key in current_keys for x in manifest['entries'][key]['files'])
+	removed_filenames = []
+	for key in [x for x in manifest['entries'] if not x in current_keys]:
+		for fingerprint in manifest['entries'].pop(key)['files']:
+			filename = fingerprint[0]
+			if not filename in current_filenames and os.path.exists(filename) and get_file_fingerprint(filename) == fingerprint:
+				os.remove(filename)
+				removed_filenames.append(filename)
+	return removed_filenames
+
+def lookup(manifest, key, dependencies):
+	# Returns (True, value) if the output key was built from the same dependencies and its files are unchanged, or
+	# (False, None) if it needs rebuilding.
+	entry = manifest['entries'].get(key)
+	if not manifest['enabled'] or not entry or entry.get('code') != manifest['code'] or entry['dependencies'] != get_hash(dependencies):
+		return False, None
+	for fingerprint in entry['files']:
+		if not os.path.exists(fingerprint[0]) or get_file_fingerprint(fingerprint[0]) != fingerprint:
+			return False, None
+	manifest['reused'].append(key)
+	return True, entry['value']
+
+def store(manifest, key, dependencies, value=None, filenames=()):
+	# Records that the output key was built from dependencies, with its value (if any) and the files written for it.
+	manifest['entries'][key] = {
+		'dependencies': get_hash(dependencies),
+		'code': manifest['code'],
+		'value': value,
+		'files': [get_file_fingerprint(x) for x in filenames]
+	}
+	manifest['built'].append(key)
+
+def build(manifest, filenames, dependencies, write):
+	# Calls write() to write filenames unless they are up to date with dependencies. Returns True if they were written.
+	key = ' '.join(os.path.abspath(x) for x in filenames)
+	up_to_date, value = lookup(manifest, key, dependencies)
+	if up_to_date:
+		return False
+	write()
+	store(manifest, key, dependencies, filenames=filenames)
+	return True
+
+def get_value(manifest, key, dependencies, compute):
+	# Returns the value of compute() (which must be JSON-serializable), reusing the value from an earlier run if it was
+	# computed from the same dependencies.
+	up_to_date, value = lookup(manifest, key, dependencies)
+	if up_to_date:
+		return value
+	value = compute()
+	store(manifest, key, dependencies, value=value)
+	return value
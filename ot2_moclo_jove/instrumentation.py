@@ -0,0 +1,234 @@
+import argparse
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Number of functions (by cumulative time) kept from a cProfile capture in the trace.
+PROFILE_TOP_FUNCTIONS = 30
+
+logger = logging.getLogger(__name__)
+
+
+#################################################################################################################
+# Recording stages and counters
+#################################################################################################################
+
+# State of the current run. The generators record into this through the module functions below rather than passing
+# a recorder around. Stages may be timed from several threads at once, so all updates go through _lock.
+_lock = threading.Lock()
+_run = {}
+
+# Peak traced memory of each stage open on any thread. tracemalloc has a single peak for the whole process, so it is
+# added to every open stage before a new stage resets it.
+_open_stages = []
+
+
+def start(name, profile_cpu=False, profile_memory=False):
+	# Start recording a new run (discarding anything recorded so far).
+	with _lock:
+		close_stage(_run.get('memory'))
+		_run.clear()
+		_run['name'] = name
+		_run['started'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+		_run['start_time'] = time.perf_counter()
+		_run['stages'] = {}
+		_run['counters'] = {}
+		_run['profiler'] = None
+
+	if profile_memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+	if tracemalloc.is_tracing():
+		# The whole run is tracked as an open stage so its peak survives the resets of the stages within it.
+		with _lock:
+			_run['memory'] = {'memory_peak': tracemalloc.get_traced_memory()[1]}
+			_open_stages.append(_run['memory'])
+	if profile_cpu:
+		_run['profiler'] = cProfile.Profile()
+		_run['profiler'].enable()
+
+def record(stage_name, seconds, memory_peak=None):
+	# Adds one timing sample (and optionally the peak traced memory in bytes) to a named stage.
+	with _lock:
+		stage = _run.setdefault('stages', {}).setdefault(stage_name, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0})
+		stage['calls'] += 1
+		stage['total_s'] += seconds
+		stage['max_s'] = max(stage['max_s'], seconds)
+		if memory_peak is not None:
+			stage['memory_peak_bytes'] = max(stage.get('memory_peak_bytes', 0), memory_peak)
+
+def close_stage(open_stage):
+	# Removes an open stage (by identity, as several may have the same peak). Must be called with _lock held.
+	_open_stages[:] = [x for x in _open_stages if x is not open_stage]
+
+def update_open_stages():
+	# Adds the peak traced memory since the last reset to every open stage. Must be called with _lock held.
+	memory_peak = tracemalloc.get_traced_memory()[1]
+	for open_stage in _open_stages:
+		open_stage['memory_peak'] = max(open_stage['memory_peak'], memory_peak)
+
+@contextmanager
+def stage(stage_name):
+	# Times the body of a with statement as one call of the named stage. If memory is being traced, the peak traced
+	# memory while the stage was open is recorded too (including that of stages nested in it or running on other
+	# threads, as tracemalloc doesn't tell them apart).
+	open_stage = None
+	if tracemalloc.is_tracing():
+		with _lock:
+			update_open_stages()
+			tracemalloc.reset_peak()
+			open_stage = {'memory_peak': tracemalloc.get_traced_memory()[1]}
+			_open_stages.append(open_stage)
+	start_time = time.perf_counter()
+	try:
+		yield
+	finally:
+		seconds = time.perf_counter() - start_time
+		memory_peak = None
+		if open_stage is not None:
+			with _lock:
+				if tracemalloc.is_tracing():
+					update_open_stages()
+				close_stage(open_stage)
+			memory_peak = open_stage['memory_peak']
+		record(stage_name, seconds, memory_peak)
+
+def count(counter_name, n=1):
+	# Adds n to a named counter (e.g. images, detections, picks).
+	with _lock:
+		counters = _run.setdefault('counters', {})
+		counters[counter_name] = counters.get(counter_name, 0) + n
+
+def count_bytes_written(filename):
+	# Adds the size of a file the run has written to the bytes_written counter.
+	count('bytes_written', os.path.getsize(filename))
+
+def note(list_name, entry):
+	# Adds entry (a JSON-serializable dict) to a named list of notes about the run, such as the worker counts chosen by
+	# the colony picking scheduler.
+	with _lock:
+		_run.setdefault('notes', {}).setdefault(list_name, []).append(entry)
+
+def get_trace():
+	# Returns what has been recorded for the current run as a JSON-serializable dict.
+	with _lock:
+		return {
+			'name': _run.get('name'),
+			'started': _run.get('started'),
+			'wall_time_s': time.perf_counter() - _run.get('start_time', time.perf_counter()),
+			'stages': json.loads(json.dumps(_run.get('stages', {}))),
+			'counters': dict(_run.get('counters', {})),
+			'notes': json.loads(json.dumps(_run.get('notes', {}))),
+		}
+
+def finish(trace_folder_path=None):
+	# Stops any profilers, logs a summary and, if trace_folder_path is given, writes the trace of the run there as
+	# <name>_trace_<time>.json (plus a .prof file with the raw cProfile data). Returns the trace.
+	profiler = _run.get('profiler')
+	if profiler:
+		profiler.disable()
+
+	trace = get_trace()
+	if tracemalloc.is_tracing():
+		with _lock:
+			update_open_stages()
+			close_stage(_run.get('memory'))
+		trace['memory_peak_bytes'] = _run.get('memory', {}).get('memory_peak', tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+	if profiler:
+		trace['profile'] = get_profile_summary(profiler)
+
+	log_trace(trace)
+
+	if trace_folder_path:
+		trace_name = '{0}_trace_{1}'.format(trace['name'], time.strftime('%Y%m%d-%H%M%S'))
+		trace_filename = os.path.join(trace_folder_path, trace_name + '.json')
+		with open(trace_filename, 'w+') as trace_file:
+			json.dump(trace, trace_file, indent=1, sort_keys=True)
+		if profiler:
+			profiler.dump_stats(os.path.join(trace_folder_path, trace_name + '.prof'))
+		logger.info('Wrote run trace to %s', trace_filename)
+
+	return trace
+
+def get_profile_summary(profiler):
+	# Returns the functions with the highest cumulative time from a cProfile capture.
+	stats = pstats.Stats(profiler, stream=io.StringIO())
+	stats.sort_stats('cumulative')
+	functions = []
+	for function in stats.fcn_list[:PROFILE_TOP_FUNCTIONS]:
+		calls, primitive_calls, total_time, cumulative_time, callers = stats.stats[function]
+		functions.append({
+			'function': '{0}:{1}({2})'.format(*function),
+			'calls': calls,
+			'total_s': total_time,
+			'cumulative_s': cumulative_time
+		})
+	return functions
+
+
+#################################################################################################################
+# Command line options and reporting
+#################################################################################################################
+
+def add_arguments(parser):
+	# Adds the profiling and logging options shared by all generators to an argparse parser.
+	parser.add_argument('--profile', action='store_true', help='Write a JSON trace of stage timings and counters to the output folder.')
+	parser.add_argument('--profile-cpu', action='store_true', help='Also capture a cProfile of the run (implies --profile). Only the main thread is profiled.')
+	parser.add_argument('--profile-memory', action='store_true', help='Also trace peak memory with tracemalloc (implies --profile).')
+	parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Logging level (default: INFO).')
+
+def start_from_arguments(name, args):
+	# Sets up logging and starts recording a run using options added by add_arguments. Returns True if a trace should
+	# be written at the end of the run.
+	logging.basicConfig(level=getattr(logging, args.log_level), format='%(levelname)s %(name)s: %(message)s')
+	start(name, profile_cpu=args.profile_cpu, profile_memory=args.profile_memory)
+	return args.profile or args.profile_cpu or args.profile_memory
+
+def log_trace(trace):
+	# Logs the stages (slowest first) and counters of a trace.
+	for stage_name, stage in sorted(trace['stages'].items(), key=lambda x: -x[1]['total_s']):
+		logger.info('%s: %d call(s), %.3f s total, %.3f s max', stage_name, stage['calls'], stage['total_s'], stage['max_s'])
+	for counter_name, value in sorted(trace['counters'].items()):
+		logger.info('%s: %d', counter_name, value)
+
+def compare_traces(old_trace, new_trace):
+	# Returns lines comparing the stage times and counters of two traces.
+	lines = []
+	for stage_name in sorted(set(old_trace['stages']) | set(new_trace['stages'])):
+		old_time = old_trace['stages'].get(stage_name, {}).get('total_s', 0.0)
+		new_time = new_trace['stages'].get(stage_name, {}).get('total_s', 0.0)
+		change = '{0:+.1f}%'.format(100.0 * (new_time - old_time) / old_time) if old_time else 'new'
+		lines.append('{0}: {1:.3f} s -> {2:.3f} s ({3})'.format(stage_name, old_time, new_time, change))
+	for counter_name in sorted(set(old_trace['counters']) | set(new_trace['counters'])):
+		lines.append('{0}: {1} -> {2}'.format(
+			counter_name,
+			old_trace['counters'].get(counter_name, 0),
+			new_trace['counters'].get(counter_name, 0)))
+	lines.append('wall time: {0:.3f} s -> {1:.3f} s'.format(old_trace['wall_time_s'], new_trace['wall_time_s']))
+	return lines
+
+
+#################################################################################################################
+# Compare two traces from the command line (python -m ot2_moclo_jove.instrumentation old.json new.json)
+#################################################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare two run traces written with --profile.')
+	parser.add_argument('old_trace')
+	parser.add_argument('new_trace')
+	args = parser.parse_args()
+	with open(args.old_trace) as old_file, open(args.new_trace) as new_file:
+		for line in compare_traces(json.load(old_file), json.load(new_file)):
+			print(line)
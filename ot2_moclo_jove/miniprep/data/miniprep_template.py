@@ -1,67 +1,103 @@
-from opentrons import robot, instruments, labware, modules
+import time
 
-available_deck_slots = ['1', '2', '3', '4', '5', '6', '8', '9']
+from opentrons import robot, instruments, labware, modules
 
-tip_racks = [labware.load('tiprack-200ul', available_deck_slots.pop(), 'tiprack-200ul') for x in range(0, 4)]
+# The slot of each piece of labware is set by the generator in deck_layout (see deck_layout.py).
+tip_racks = [labware.load('tiprack-200ul', deck_layout['tiprack-200ul {0}'.format(x)], 'tiprack-200ul') for x in range(0, 4)]
 
 p300 = instruments.P300_Multi(mount='left', tip_racks=tip_racks)
 
-mag = modules.load("magdeck", "10", share=True)
-samples = labware.load('96-deep-well', "10", 'samples', share=True)
-dest_plate = labware.load("96-PCR-tall", "11", "destination plate")
-buffers = labware.load("trough-12row", "7", "buffers")
+mag = modules.load("magdeck", deck_layout['samples'], share=True)
+samples = labware.load('96-deep-well', deck_layout['samples'], 'samples', share=True)
+dest_plate = labware.load("96-PCR-tall", deck_layout['destination plate'], "destination plate")
+buffers = labware.load("trough-12row", deck_layout['buffers'], "buffers")
 etr_mag = [buffers.wells(0), buffers.wells(1)]
 etr = [buffers.wells(2), buffers.wells(3)]
 vhb = [buffers.wells(4), buffers.wells(5), buffers.wells(6), buffers.wells(7)]
 spm = [buffers.wells(8), buffers.wells(9)]
 eb = buffers.wells(10)
 
-#Add 500 L ETR and 20 L Mag-Bind
-p300.transfer(520, etr_mag.bottom(0.5), 
+PROTOCOL_START = time.time()
+
+def elapsed():
+	"""Time since the protocol started, in seconds."""
+	return time.time() - PROTOCOL_START
+
+# If step_markers is set by the generator, the start and end of each step are logged as robot comments (and appended
+# to step_log_filename on the robot, if set) in the form "STEP start|end <seconds since start> <estimated seconds or
+# -> <step name>". run_timing.py turns a run log into a timing report.
+def mark_step(event, name, estimate=None):
+	if not step_markers:
+		return
+	marker = 'STEP {0} {1:.1f} {2} {3}'.format(event, elapsed(), '-' if estimate is None else '{0:.0f}'.format(estimate), name)
+	robot.comment(marker)
+	if step_log_filename and not robot.is_simulating():
+		with open(step_log_filename, 'a') as step_log:
+			step_log.write(marker + '\n')
+
+# The steps below are only outlined so far. Their markers still run, so a protocol can be generated and timed end to
+# end while they are written.
+mark_step('start', 'bind')
+#Add 500 µL ETR and 20 µL Mag-Bind
+#p300.transfer(520, etr_mag.bottom(0.5), 
 #Wait 5 min
 #Magnetize and discard supernatant
-#Demagnetize and add 500 L ETR
+mark_step('end', 'bind')
+mark_step('start', 'wash_etr')
+#Demagnetize and add 500 µL ETR
 #Magnetize and discard supernatant
-#Demagnetize and add 700 L VHB
+mark_step('end', 'wash_etr')
+mark_step('start', 'wash_vhb_1')
+#Demagnetize and add 700 µL VHB
 #Magnetize and discard supernatant
-#Demagnetize and add 700 L VHB
+mark_step('end', 'wash_vhb_1')
+mark_step('start', 'wash_vhb_2')
+#Demagnetize and add 700 µL VHB
 #Magnetize and discard supernatant
-#Demagnetize and aAdd 700 L SPM
+mark_step('end', 'wash_vhb_2')
+mark_step('start', 'wash_spm')
+#Demagnetize and aAdd 700 µL SPM
 #Magnetize and discard supernatant
+mark_step('end', 'wash_spm')
+mark_step('start', 'dry')
 #Wait 1 min
 #Discard last bit of supernatant
 #Wait 9 min
-#Demagnetize and add 50-100 L Elution Buffer (might be able to add less)
+mark_step('end', 'dry')
+mark_step('start', 'elute')
+#Demagnetize and add 50-100 µL Elution Buffer (might be able to add less)
 #Magnetize and remove and save supernatant (which contains dna)
+mark_step('end', 'elute')
+
+
+
+# Left over from the colony picking template and not used by the miniprep yet.
+#source_plate_names = []
+#for block_name, block_map in culture_blocks_dict.items():
+#	for row in block_map:
+#		for element in row:
+#			source_name = element['source']
+#			if not source_name in source_plate_names:
+#				source_plate_names.append(source_name)
 
+#source_plates = {}
+#for name in source_plate_names:
+#	source_plates[name] = labware.load('point-for-colony-picking', available_deck_slots.pop(), name)
 
+#i = 0
+#for block_name, block_map in culture_blocks_dict.items():
+#	for row in block_map:
+#		for colony in row:
+#			p.pick_up_tip()
+#			# This aspirate ensures that the OT2 app realizes we are actually using this plate (so that it will 
+#			# tell the user to calibrate for it).
+#			p.aspirate(10, source_plates[colony['source']].wells(0))
+#			robot.move_to((source_plates[colony['source']], Vector([colony['x'], colony['y'], PLATE_DEPTH])), p)
+#			p.dispense(10, culture_block.wells(i))
+#			p.aspirate(10)
+#			p.dispense(10)
+#			p.drop_tip()
 
-source_plate_names = []
-for block_name, block_map in culture_blocks_dict.items():
-	for row in block_map:
-		for element in row:
-			source_name = element['source']
-			if not source_name in source_plate_names:
-				source_plate_names.append(source_name)
-
-source_plates = {}
-for name in source_plate_names:
-	source_plates[name] = labware.load('point-for-colony-picking', available_deck_slots.pop(), name)
-
-i = 0
-for block_name, block_map in culture_blocks_dict.items():
-	for row in block_map:
-		for colony in row:
-			p.pick_up_tip()
-			# This aspirate ensures that the OT2 app realizes we are actually using this plate (so that it will 
-			# tell the user to calibrate for it).
-			p.aspirate(10, source_plates[colony['source']].wells(0))
-			robot.move_to((source_plates[colony['source']], Vector([colony['x'], colony['y'], PLATE_DEPTH])), p)
-			p.dispense(10, culture_block.wells(i))
-			p.aspirate(10)
-			p.dispense(10)
-			p.drop_tip()
-
-			i += 1
+#			i += 1
 
 
@@ -1,8 +1,13 @@
 import tkinter
 from tkinter import filedialog, messagebox
+import argparse
 import csv
 import json
+import logging
+import os
+from collections import Counter
 import yaml
+from ot2_moclo_jove import deck_layout, incremental, instrumentation
 
 #################################################################################################################
 # Constants
@@ -10,12 +15,28 @@ import yaml
 
 CONFIG_PATH = "data/settings.yaml"
 
+# Slots the template used for the tip racks (the last one is used first) and the labware fixed in place. The samples
+# (culture block) sit on the magnetic module.
+AVAILABLE_DECK_SLOTS = ['1', '2', '3', '4', '5', '6', '8', '9']
+MAG_DECK_SLOT = '10'
+DEFAULT_SLOTS = {'destination plate': '11', 'buffers': '7'}
+NUM_TIP_RACKS = 4
+
+# Number of buffer additions and supernatant removals for each column in the miniprep procedure outlined in
+# miniprep_template.py. The template doesn't carry them out yet, so these only guide the deck layout.
+NUM_BUFFER_ADDITIONS = 6
+NUM_SUPERNATANT_REMOVALS = 6
+
+logger = logging.getLogger(__name__)
+
 
 #################################################################################################################
 # Main function of script
 #################################################################################################################
 
 def main():
+	args = parse_args()
+	write_trace = instrumentation.start_from_arguments('miniprep', args)
 
 	###### GETTING USER INPUT ######
 	config = get_config(CONFIG_PATH)
@@ -23,24 +44,60 @@ def main():
 	culture_block_filenames = ask_culture_block_filenames()
 
 	# Load in CSV files as a dict containing lists of lists.
-	plate_maps = generate_plate_maps(culture_block_filenames)
+	with instrumentation.stage('read_inputs'):
+		plate_maps = generate_plate_maps(culture_block_filenames)
+
+	run(config, plate_maps)
+
+	instrumentation.finish(config['output_folder_path'] if write_trace else None)
+
+# Saves the output plate maps and protocol for already loaded culture block plate maps (see generate_plate_maps).
+# Returns the plate maps with their output plate names. Outputs whose inputs haven't changed since the last run are not
+# rewritten (see incremental.py).
+def run(config, plate_maps):
+	output_folder_path = config['output_folder_path']
+	manifest = incremental.load_manifest(output_folder_path, 'miniprep', config['incremental'])
 
 	# Associates an output plate filename to each plate map.
-	plate_maps = add_output_plate_names(plate_maps, config['output_folder_path'])
+	plate_maps = add_output_plate_names(plate_maps, output_folder_path)
 
 	# Save output plate maps.
-	save_plate_maps(plate_maps)
+	with instrumentation.stage('output_plate_maps'):
+		for plate_map in plate_maps:
+			incremental.build(manifest, [plate_map['plasmid_plate_name']], plate_map['map'], lambda: save_plate_maps([plate_map]))
+
+	# Place labware on the deck so that labware often moved between is close together.
+	with instrumentation.stage('deck_layout'):
+		layout, travel_comment = incremental.get_value(
+			manifest,
+			'deck_layout',
+			[plate_maps, config['optimize_deck_layout']],
+			lambda: get_deck_layout(plate_maps, config['optimize_deck_layout']))
+		slot_map_filename = os.path.join(output_folder_path, 'miniprep_deck_layout.csv')
+		incremental.build(manifest, [slot_map_filename], layout, lambda: deck_layout.write_slot_map(layout, slot_map_filename))
 
 	# Create a protocol file and hard code the plate maps into it.
-	create_protocol(plate_maps, config['protocol_template_path'], config['output_folder_path'])
+	with instrumentation.stage('protocol'):
+		incremental.build(
+			manifest,
+			[os.path.join(output_folder_path, 'miniprep_protocol.py')],
+			[plate_maps, layout, travel_comment, config['step_markers'], config['step_log_filename'], incremental.get_file_hash(config['protocol_template_path'])],
+			lambda: create_protocol(plate_maps, layout, travel_comment, config['protocol_template_path'], output_folder_path, config['step_markers'], config['step_log_filename']))
 
-	# Write the contents of miniprep_template.py (which contains the body of the protocol) to the new protocol file.
+	incremental.save_manifest(manifest)
+
+	return plate_maps
 
 
 #################################################################################################################
 # Functions for getting user input
 #################################################################################################################
 
+def parse_args():
+	parser = argparse.ArgumentParser(description='Generates an OT2 miniprep protocol from culture block maps.')
+	instrumentation.add_arguments(parser)
+	return parser.parse_args()
+
 def get_config(config_path):
 	# Load settings from file.
 	config = yaml.safe_load(open(config_path))
@@ -81,6 +138,18 @@ def generate_plate_maps(filenames):
 
 	return plate_maps
 
+# Converts the culture blocks dict produced by the colony picking generator into plate maps without going through the
+# culture_block_N.csv files.
+def plate_maps_from_culture_blocks(culture_blocks_dict):
+	plate_maps = []
+	for block_name, block_map in culture_blocks_dict.items():
+		plate_maps.append({
+			'culture_block_name': block_name,
+			'map': [[colony['name'] for colony in row] for row in block_map]
+		})
+
+	return plate_maps
+
 # Implicitly assumes input and output plates are identical.
 def add_output_plate_names(plate_maps, output_folder_path):
 	plate_maps_with_outputs = []
@@ -101,18 +170,51 @@ def save_plate_maps(plate_maps):
 		with open(plate_map['plasmid_plate_name'], 'w+', newline='') as plasmid_plate_map_file:
 			writer = csv.writer(plasmid_plate_map_file)
 			writer.writerows(plate_map['map'])
-
-def create_protocol(plate_maps, protocol_template_path, output_folder_path):
+		instrumentation.count('plate_maps')
+		instrumentation.count_bytes_written(plate_map['plasmid_plate_name'])
+
+# Returns the layout (a dict of labware name to slot) to paste into the protocol and a comment with its estimated
+# travel. For each column of samples, each buffer is added and each supernatant removed with a new tip, and the eluted
+# DNA is moved to the destination plate. If optimize is False the template's original slots are used.
+def get_deck_layout(plate_maps, optimize=True):
+	tip_racks = ['tiprack-200ul {0}'.format(i) for i in range(0, NUM_TIP_RACKS)]
+	num_cols = max([len(row) for plate_map in plate_maps for row in plate_map['map']] + [0])
+	moves = Counter()
+	deck_layout.add_path(moves, [tip_racks[0], 'buffers', 'samples', deck_layout.TRASH], NUM_BUFFER_ADDITIONS * num_cols)
+	deck_layout.add_path(moves, [tip_racks[0], 'samples', deck_layout.TRASH], NUM_SUPERNATANT_REMOVALS * num_cols)
+	deck_layout.add_path(moves, [tip_racks[0], 'samples', 'destination plate', deck_layout.TRASH], num_cols)
+
+	default_layout = deck_layout.get_load_order_layout(tip_racks, AVAILABLE_DECK_SLOTS, dict(DEFAULT_SLOTS, samples=MAG_DECK_SLOT))
+	if not optimize:
+		return default_layout, deck_layout.get_travel_comment(default_layout, default_layout, moves)
+
+	available_slots = AVAILABLE_DECK_SLOTS + list(DEFAULT_SLOTS.values())
+	layout = deck_layout.solve_layout(tip_racks + list(DEFAULT_SLOTS), moves, available_slots, {'samples': MAG_DECK_SLOT})
+	travel_comment = deck_layout.get_travel_comment(layout, default_layout, moves)
+	logger.info(travel_comment[2:].strip())
+	return layout, travel_comment
+
+def create_protocol(plate_maps, layout, travel_comment, protocol_template_path, output_folder_path, step_markers=False, step_log_filename=None):
 	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
 	with open(protocol_template_path) as template_file:
 		template_string = template_file.read()
 
-	with open(output_folder_path + '/' + 'miniprep_protocol.py', "w+") as protocol_file:
+	protocol_filename = output_folder_path + '/' + 'miniprep_protocol.py'
+	with open(protocol_filename, "w+") as protocol_file:
 		# Paste in plate maps at top of file.
-		protocol_file.write(json.dumps(plate_maps) + '\n\n')
+		protocol_file.write('plate_maps = ' + json.dumps(plate_maps) + '\n\n')
+
+		# Paste in the slot of each piece of labware.
+		protocol_file.write(travel_comment)
+		protocol_file.write('deck_layout = ' + json.dumps(layout) + '\n\n')
+
+		# Paste in whether to log the start and end of each step (see run_timing.py).
+		protocol_file.write('step_markers = {0!r}\n'.format(bool(step_markers)))
+		protocol_file.write('step_log_filename = {0!r}\n\n'.format(step_log_filename or None))
 
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	instrumentation.count_bytes_written(protocol_filename)
 
 
 #################################################################################################################
@@ -15,37 +15,36 @@ try:
 except:
 	print("Using existing labware definition for {0}".format(COLD_BLOCK))
 
-# Up to 48 rxns per run (4 spots on agar per rxn)
+# Up to 48 rxns per run (spots on agar per rxn set by the generator in agar_layout)
 # Multichannel p300, single channel p10
 # This protocol is optimized for maximum walkaway time
 
 num_rxns = len(combinations_to_make)
-num_plates = math.ceil(num_rxns/24)
+num_plates = max([x['plate'] + 1 for x in agar_layout] + [0])
 
 # Load in 96-well PCR plate (96-PCR-flat) on temp deck for moclos, transformation, and outgrowth.
-temp_deck = modules.load('tempdeck', '10')
-reaction_plate = labware.load('96-PCR-tall', '10', share=True)
+# Slots for the rest of the labware are set by the generator in deck_layout (see deck_layout.py).
+temp_deck = modules.load('tempdeck', deck_layout['Reaction plate'])
+reaction_plate = labware.load('96-PCR-tall', deck_layout['Reaction plate'], share=True)
 
-available_deck_slots = ['11', '8', '7', '5', '4', '2', '1']
-
-# Load in 1 10ul tiprack and 2 300ul tipracks
-tr_10 = [labware.load('tiprack-10ul', '3'), labware.load('tiprack-10ul', '6')]
+# Load in 2 10ul tipracks and 1 300ul tiprack
+tr_10 = [labware.load('tiprack-10ul', deck_layout['tiprack-10ul 0']), labware.load('tiprack-10ul', deck_layout['tiprack-10ul 1'])]
 tr_300 = []
 for i in range(0, 1):
-	tr_300.append(labware.load('tiprack-200ul', '9'))
+	tr_300.append(labware.load('tiprack-200ul', deck_layout['tiprack-200ul']))
 
 # Load in pipettes
 p10_single = instruments.P10_Single(mount='right', tip_racks=tr_10)
 p300_multi = instruments.P300_Multi(mount='left', tip_racks=tr_300)
 
 # Load in reagent tubes on cold block (PCR-strip-tall)
-reagents = labware.load('PCR-strip-tall', available_deck_slots.pop(), 'Reagent plate')
+reagents = labware.load('PCR-strip-tall', deck_layout['Reagent plate'], 'Reagent plate')
 ligase = reagents.wells(0)
 restriction_enzyme = reagents.wells(1)
 buffer = reagents.wells(2)
 
 # Load in water, LB, and wash trough (trough-12row)
-trough = labware.load('trough-12row', available_deck_slots.pop(), 'Reagent trough')
+trough = labware.load('trough-12row', deck_layout['Reagent trough'], 'Reagent trough')
 water = trough.wells(0)
 lb = trough.wells(1)
 wash_0 = trough.wells(2)
@@ -55,59 +54,130 @@ liquid_waste = trough.wells(4)
 # Load in up to 2 DNA plates (96-PCR-flat)
 dna_plate_dict = {}
 for plate_name in dna_plate_map_dict.keys():
-	dna_plate_dict[plate_name] = labware.load('96-PCR-tall', available_deck_slots.pop(), plate_name)
+	dna_plate_dict[plate_name] = labware.load('96-PCR-tall', deck_layout[plate_name], plate_name)
 
 # Load in comp cell plate (96-PCR-flat)
-comp_cells = labware.load(COLD_BLOCK, available_deck_slots.pop(), 'Competent cells')
+comp_cells = labware.load(COLD_BLOCK, deck_layout['Competent cells'], 'Competent cells')
 
-# Load in up to 2 agar plates, same antibiotic for all plasmids is assumed (e-gelgol)
+# Load in as many agar plates as agar_layout uses, same antibiotic for all plasmids is assumed (e-gelgol)
 agar_plates = []
 for i in range(0, num_plates):
-	agar_plates.append(labware.load('e-gelgol', available_deck_slots.pop(), 'Agar plate {0}'.format(i)))
+	agar_plate_name = 'Agar plate {0}'.format(i)
+	agar_plates.append(labware.load('e-gelgol', deck_layout[agar_plate_name], agar_plate_name))
 
-temp_deck.set_temperature(10)
+#################################################################################################################
+# Steps
+#################################################################################################################
 
-# Add water, buffer, restriction enzyme, ligase, and buffer to 2x master mix.
-# Add extra space for dead volume.
-num_mm_wells = math.ceil(num_rxns * 10 / 190.0)
-mm_to_make = 10 * num_rxns + 10 * num_mm_wells
-mm_wells = []
-p10_single.pick_up_tip()
-well_in_plate = 95
-while mm_to_make > 0:
-	if mm_to_make > 200:
-		vol = 200
-		mm_to_make -= 200
-	else:
-		vol = mm_to_make
-		mm_to_make = 0
-	mm_well = reaction_plate.wells(well_in_plate)
-	well_in_plate -= 1
-	mm_wells.append(mm_well)
-	water_to_transfer = 0.65*vol
-	# Transfer large volumes first to avoid dead volume.
-	while water_to_transfer > 0:
-		if water_to_transfer > 10:
-			p10_single.transfer(10, water.bottom(), mm_well.bottom(0.5), new_tip='never')
-			water_to_transfer -= 10
-		else:
-			p10_single.transfer(water_to_transfer, water.bottom(), mm_well.bottom(0.5), new_tip='never')
-			water_to_transfer = 0
-	p10_single.transfer(vol/5.0, buffer.bottom(), mm_well.bottom(0.5), new_tip='never')
-	p10_single.mix(2, 10, mm_well.bottom(0.5))
-	p10_single.transfer(vol/20.0, ligase.bottom(), mm_well.bottom(0.5), new_tip='never')
-	p10_single.mix(2, 10, mm_well.bottom(0.5))
-	p10_single.transfer(vol/10.0, restriction_enzyme.bottom(), mm_well.bottom(0.5), new_tip='never')
-	p10_single.mix(5, 10, mm_well.bottom(0.5))
-p10_single.drop_tip()
-
-# Add master mix to each rxn
-p10_single.pick_up_tip()
-mm_well = 0
-for i in range(0, num_rxns):
-	mm_well = mm_wells[i // 19]
-	p10_single.transfer(10, mm_well.bottom(0.5), reaction_plate.wells(i).bottom(0.5), new_tip='never')
-p10_single.drop_tip()
+# Rough durations (in seconds) of robot actions. These are used to model how long each step takes, both to estimate
+# each step in its markers and to keep track of time when simulating (where delays return immediately).
+SECONDS_PER_TIP = 10
+SECONDS_PER_TRANSFER = 12
+SECONDS_PER_MIX_CYCLE = 2
+SECONDS_PER_BLOW_OUT = 2
+
+def wash_seconds():
+	"""Modelled duration of rinsing a tip in both wash troughs."""
+	return 2 * (2 * 2 * SECONDS_PER_MIX_CYCLE + SECONDS_PER_BLOW_OUT)
+
+# Steps run one after another, in the order they are added. A step with a hold (in minutes) is an incubation: the
+# protocol waits until hold minutes after the step started, so anything done in its body counts towards the hold. tips
+# is the number of tips each pipette ('p10', or 'p300' in columns of 8) picks up in the step, and temperature is what
+# the step leaves the temp deck at (if it changes it), so that a resumed run can skip the step (see Resuming).
+steps = []
+clock = {'start': time.time(), 'simulated': 0.0}
+done_steps = []
+
+def add_step(name, run, seconds, hold=0, tips=None, temperature=None):
+	steps.append({
+		'name': name,
+		'run': run,
+		'seconds': seconds,
+		'hold': hold,
+		'tips': tips or {},
+		'temperature': temperature
+	})
+
+def elapsed():
+	"""Time since the protocol started, in seconds (modelled when simulating)."""
+	if robot.is_simulating():
+		return clock['simulated']
+	return time.time() - clock['start']
+
+# If step_markers is set by the generator, the start and end of each step are logged as robot comments (and appended
+# to step_log_filename on the robot, if set) in the form "STEP start|end <seconds since start> <estimated seconds or
+# -> <step name>". run_timing.py turns a run log into a timing report. An incubation ends when its hold does.
+def mark_step(event, name, estimate=None):
+	if not step_markers:
+		return
+	marker = 'STEP {0} {1:.1f} {2} {3}'.format(event, elapsed(), '-' if estimate is None else '{0:.0f}'.format(estimate), name)
+	robot.comment(marker)
+	if step_log_filename and not robot.is_simulating():
+		with open(step_log_filename, 'a') as step_log:
+			step_log.write(marker + '\n')
+
+def wait(seconds):
+	if seconds > 0 and not resume['skipping']:
+		p10_single.delay(seconds=seconds)
+		clock['simulated'] += seconds
+
+def run_step(step):
+	if resume['skipping'] and resume_from in (len(done_steps), step['name']):
+		start_resumed_run()
+	if resume['skipping']:
+		skip_step(step)
+		return
+
+	step_start = elapsed()
+	mark_step('start', step['name'], max(step['seconds'], step['hold'] * 60))
+	step['run']()
+	clock['simulated'] += step['seconds']
+	wait(step_start + step['hold'] * 60 - elapsed())
+	done_steps.append(step['name'])
+	mark_step('end', step['name'])
+
+def run_steps():
+	if resume_from is not None and not resume_from in [x['name'] for x in steps] + list(range(0, len(steps))):
+		raise ValueError('resume_from {0!r} is not a step of this protocol.'.format(resume_from))
+
+	for step in steps:
+		run_step(step)
+
+	robot.comment('Modelled run time: {0:.0f} min.'.format(elapsed() / 60))
+
+#################################################################################################################
+# Resuming
+#################################################################################################################
+
+# If resume_from is set (see resume_protocol.py), the steps that run before it are skipped. It is the name of a step or
+# its index in the order steps start (counting from 0). Skipped steps still count the tips they would have used, so
+# the pipettes start at the next unused tip, and the temp deck is set to the temperature they would have left it at.
+# Which wells are used doesn't depend on which steps run. An incubation cut short is restarted in full.
+resume = {'skipping': resume_from is not None, 'tips': {'p10': 0, 'p300': 0}, 'temperature': None}
+
+def skip_step(step):
+	robot.comment('Skipping {0} (done before resuming).'.format(step['name']))
+	for pipette_name, tips in step['tips'].items():
+		resume['tips'][pipette_name] += tips
+	if step['temperature'] is not None:
+		resume['temperature'] = step['temperature']
+	done_steps.append(step['name'])
+
+def get_tip(tip_racks, tip):
+	return tip_racks[tip // 96].wells(tip % 96)
+
+def start_resumed_run():
+	resume['skipping'] = False
+	robot.comment('Resuming from {0}.'.format(resume_from))
+	p10_single.start_at_tip(get_tip(tr_10, resume['tips']['p10']))
+	p300_multi.start_at_tip(get_tip(tr_300, 8 * resume['tips']['p300']))
+	if resume['temperature'] is not None:
+		temp_deck.set_temperature(resume['temperature'])
+
+
+#################################################################################################################
+# Protocol
+#################################################################################################################
 
 def find_dna(name, dna_plate_map_dict, dna_plate_dict):
 	"""Return a well containing the named DNA."""
@@ -123,9 +193,15 @@ def find_combination(name, combinations_to_make):
 	"""Return a well containing the named combination."""
 	for i, combination in enumerate(combinations_to_make):
 		if combination["name"] == name:
-			return reaction_plate.wells(i)
+			return reaction_plate.wells(reaction_wells[i])
 	raise ValueError("Could not find combination \"{0}\".".format(name))
 
+# Combination i is in reaction well reaction_wells[i] (set by the generator so that combinations sharing parts share
+# columns) and is transformed in the well 48 below it.
+reaction_well_by_name = {}
+for i, combination in enumerate(combinations_to_make):
+	reaction_well_by_name.setdefault(combination["name"], reaction_wells[i])
+
 combinations_by_part = {}
 for i in combinations_to_make:
 	name = i["name"]
@@ -135,106 +211,227 @@ for i in combinations_to_make:
 		else:
 			combinations_by_part[j] = [name]
 
-for part, combinations in combinations_by_part.items():
-	part_well = find_dna(part, dna_plate_map_dict, dna_plate_dict)
-	combination_wells = [find_combination(x, combinations_to_make) for x in combinations]
+num_cols = math.ceil(num_rxns/8.0)
+
+# Add water, buffer, restriction enzyme, ligase, and buffer to 2x master mix.
+# Add extra space for dead volume.
+num_mm_wells = math.ceil(num_rxns * 10 / 190.0)
+mm_to_make = 10 * num_rxns + 10 * num_mm_wells
+
+# The master mix is made 200 ul at a time, in wells from the end of the reaction plate backwards. The wells are chosen
+# here rather than while making it, so they are known when resuming after the master mix was made.
+mm_wells = []
+mm_volumes = []
+while sum(mm_volumes) < mm_to_make:
+	mm_wells.append(reaction_plate.wells(95 - len(mm_wells)))
+	mm_volumes.append(min(200, mm_to_make - sum(mm_volumes)))
+
+def make_master_mix():
 	p10_single.pick_up_tip()
-	while combination_wells:
-		if len(combination_wells) > 5:
-			current_wells = combination_wells[0:5]
-			combination_wells = combination_wells[5:]
-		else:
-			current_wells = combination_wells
-			combination_wells = []
-		p10_single.aspirate(2 * len(current_wells), part_well.bottom(0.5))
-		for i in current_wells:
-			p10_single.dispense(2, i.bottom(0.5))
-		if combination_wells:
-			p10_single.mix(2, 10, wash_0.bottom(0.5))
-			p10_single.blow_out()
-			p10_single.mix(2, 10, wash_1.bottom(0.5))
-			p10_single.blow_out()
+	for mm_well, vol in zip(mm_wells, mm_volumes):
+		water_to_transfer = 0.65*vol
+		# Transfer large volumes first to avoid dead volume.
+		while water_to_transfer > 0:
+			if water_to_transfer > 10:
+				p10_single.transfer(10, water.bottom(), mm_well.bottom(0.5), new_tip='never')
+				water_to_transfer -= 10
+			else:
+				p10_single.transfer(water_to_transfer, water.bottom(), mm_well.bottom(0.5), new_tip='never')
+				water_to_transfer = 0
+		p10_single.transfer(vol/5.0, buffer.bottom(), mm_well.bottom(0.5), new_tip='never')
+		p10_single.mix(2, 10, mm_well.bottom(0.5))
+		p10_single.transfer(vol/20.0, ligase.bottom(), mm_well.bottom(0.5), new_tip='never')
+		p10_single.mix(2, 10, mm_well.bottom(0.5))
+		p10_single.transfer(vol/10.0, restriction_enzyme.bottom(), mm_well.bottom(0.5), new_tip='never')
+		p10_single.mix(5, 10, mm_well.bottom(0.5))
 	p10_single.drop_tip()
 
-num_cols = math.ceil(num_rxns/8.0)
-p10_single.pick_up_tip()
-for i in combinations_to_make:
-	num_parts = len(i["parts"])
-	# Start off with extra 2 ul of water for evaporation.
-	water_to_add = 12 - 2 * num_parts
-	if water_to_add < 0:
-		water_to_add = 0
-	well = find_combination(i["name"], combinations_to_make)
-	p10_single.transfer(water_to_add, water.bottom(), well.bottom(0.5), new_tip='never')
-	p10_single.mix(4, 10, well.bottom(0.5))
-	p10_single.mix(2, 10, wash_0.bottom(0.5))
-	p10_single.blow_out()
-	p10_single.mix(2, 10, wash_1.bottom(0.5))
-	p10_single.blow_out()
-p10_single.drop_tip()
+add_step(
+	'make_master_mix',
+	make_master_mix,
+	SECONDS_PER_TIP + mm_to_make * (0.65 / 10 + 0.35 / 2) * SECONDS_PER_TRANSFER + num_mm_wells * 9 * SECONDS_PER_MIX_CYCLE,
+	tips={'p10': 1})
+
+def add_master_mix():
+	# Add master mix to each rxn
+	p10_single.pick_up_tip()
+	mm_well = 0
+	for i in range(0, num_rxns):
+		mm_well = mm_wells[i // 19]
+		p10_single.transfer(10, mm_well.bottom(0.5), reaction_plate.wells(reaction_wells[i]).bottom(0.5), new_tip='never')
+	p10_single.drop_tip()
+
+add_step(
+	'add_master_mix',
+	add_master_mix,
+	SECONDS_PER_TIP + num_rxns * SECONDS_PER_TRANSFER,
+	tips={'p10': 1})
+
+def add_parts():
+	for part, combinations in combinations_by_part.items():
+		part_well = find_dna(part, dna_plate_map_dict, dna_plate_dict)
+		# Going down the reaction plate, so each part's dispenses are as close together as the layout allows.
+		combinations = sorted(combinations, key=lambda x: reaction_well_by_name[x])
+		combination_wells = [find_combination(x, combinations_to_make) for x in combinations]
+		p10_single.pick_up_tip()
+		while combination_wells:
+			if len(combination_wells) > 5:
+				current_wells = combination_wells[0:5]
+				combination_wells = combination_wells[5:]
+			else:
+				current_wells = combination_wells
+				combination_wells = []
+			p10_single.aspirate(2 * len(current_wells), part_well.bottom(0.5))
+			for i in current_wells:
+				p10_single.dispense(2, i.bottom(0.5))
+			if combination_wells:
+				p10_single.mix(2, 10, wash_0.bottom(0.5))
+				p10_single.blow_out()
+				p10_single.mix(2, 10, wash_1.bottom(0.5))
+				p10_single.blow_out()
+		p10_single.drop_tip()
+
+num_part_additions = sum(len(x) for x in combinations_by_part.values())
+add_step(
+	'add_parts',
+	add_parts,
+	len(combinations_by_part) * SECONDS_PER_TIP + num_part_additions * (SECONDS_PER_TRANSFER / 2 + wash_seconds() / 5),
+	tips={'p10': len(combinations_by_part)})
+
+def add_water():
+	p10_single.pick_up_tip()
+	for i in combinations_to_make:
+		num_parts = len(i["parts"])
+		# Start off with extra 2 ul of water for evaporation.
+		water_to_add = 12 - 2 * num_parts
+		if water_to_add < 0:
+			water_to_add = 0
+		well = find_combination(i["name"], combinations_to_make)
+		p10_single.transfer(water_to_add, water.bottom(), well.bottom(0.5), new_tip='never')
+		p10_single.mix(4, 10, well.bottom(0.5))
+		p10_single.mix(2, 10, wash_0.bottom(0.5))
+		p10_single.blow_out()
+		p10_single.mix(2, 10, wash_1.bottom(0.5))
+		p10_single.blow_out()
+	p10_single.drop_tip()
+
+add_step(
+	'add_water',
+	add_water,
+	SECONDS_PER_TIP + num_rxns * (SECONDS_PER_TRANSFER + 4 * SECONDS_PER_MIX_CYCLE + wash_seconds()),
+	tips={'p10': 1})
 
 # Incubate rxns for 2 hr (moclo), adding 4 ul of water halfway through.
-start_time = time.time()
-temp_deck.set_temperature(37)
-p10_single.delay(minutes=60)
-p10_single.pick_up_tip()
-for i in combinations_to_make:
-	num_parts = len(i["parts"])
-	# Add an extra 4 ul of water for evaporation.
-	water_to_add = 4
-	well = find_combination(i["name"], combinations_to_make)
-	p10_single.transfer(water_to_add, water.bottom(), well.bottom(0.5), new_tip='never')
-	p10_single.mix(4, 10, well.bottom(0.5))
-	p10_single.mix(2, 10, wash_0.bottom(0.5))
-	p10_single.blow_out()
-	p10_single.mix(2, 10, wash_1.bottom(0.5))
-	p10_single.blow_out()
-p10_single.drop_tip()
-time_elapsed = time.time() - start_time
-p10_single.delay(seconds=(120*60 - time_elapsed))
-temp_deck.set_temperature(4)
-
-# Add comp cells.
-p300_multi.pick_up_tip()
-for i in range(0, num_cols):
-	# Using letters for rows of custom container to maintain backwards compatibility.
-	p300_multi.aspirate(20, comp_cells.wells('A' + str(i + 1)).bottom(0.5))
-
-for i in range(0, num_cols):
-	p300_multi.dispense(20, reaction_plate.wells(48 + i*8).bottom(0.5))
-p300_multi.drop_tip()
-
-# Add 2 ul of rxns to comp cells
-p10_single.pick_up_tip()
-for i in range(0, num_rxns):
-	p10_single.transfer(2, reaction_plate.wells(i).bottom(0.5), reaction_plate.wells(48 + i).bottom(0.5), new_tip='never')
-	p10_single.mix(4, 10, reaction_plate.wells(48 + i).bottom(0.5))
-	p10_single.mix(2, 10, wash_0.bottom(0.5))
-	p10_single.blow_out()
-	p10_single.mix(2, 10, wash_1.bottom(0.5))
-	p10_single.blow_out()
-p10_single.drop_tip()
+def top_up_water():
+	p10_single.pick_up_tip()
+	for i in combinations_to_make:
+		num_parts = len(i["parts"])
+		# Add an extra 4 ul of water for evaporation.
+		water_to_add = 4
+		well = find_combination(i["name"], combinations_to_make)
+		p10_single.transfer(water_to_add, water.bottom(), well.bottom(0.5), new_tip='never')
+		p10_single.mix(4, 10, well.bottom(0.5))
+		p10_single.mix(2, 10, wash_0.bottom(0.5))
+		p10_single.blow_out()
+		p10_single.mix(2, 10, wash_1.bottom(0.5))
+		p10_single.blow_out()
+	p10_single.drop_tip()
+
+def moclo_incubation():
+	temp_deck.set_temperature(37)
+	wait(60 * 60)
+	top_up_water()
+
+add_step(
+	'moclo_incubation',
+	moclo_incubation,
+	SECONDS_PER_TIP + num_rxns * (SECONDS_PER_TRANSFER + 4 * SECONDS_PER_MIX_CYCLE + wash_seconds()),
+	hold=120,
+	tips={'p10': 1},
+	temperature=37)
+
+def add_comp_cells():
+	temp_deck.set_temperature(4)
+	p300_multi.pick_up_tip()
+	for i in range(0, num_cols):
+		# Using letters for rows of custom container to maintain backwards compatibility.
+		p300_multi.aspirate(20, comp_cells.wells('A' + str(i + 1)).bottom(0.5))
+
+	for i in range(0, num_cols):
+		p300_multi.dispense(20, reaction_plate.wells(48 + i*8).bottom(0.5))
+	p300_multi.drop_tip()
+
+add_step(
+	'add_comp_cells',
+	add_comp_cells,
+	SECONDS_PER_TIP + num_cols * SECONDS_PER_TRANSFER,
+	tips={'p300': 1},
+	temperature=4)
+
+def add_rxns_to_cells():
+	# Add 2 ul of rxns to comp cells
+	p10_single.pick_up_tip()
+	for i in range(0, num_rxns):
+		well = reaction_wells[i]
+		p10_single.transfer(2, reaction_plate.wells(well).bottom(0.5), reaction_plate.wells(48 + well).bottom(0.5), new_tip='never')
+		p10_single.mix(4, 10, reaction_plate.wells(48 + well).bottom(0.5))
+		p10_single.mix(2, 10, wash_0.bottom(0.5))
+		p10_single.blow_out()
+		p10_single.mix(2, 10, wash_1.bottom(0.5))
+		p10_single.blow_out()
+	p10_single.drop_tip()
+
+add_step(
+	'add_rxns_to_cells',
+	add_rxns_to_cells,
+	SECONDS_PER_TIP + num_rxns * (SECONDS_PER_TRANSFER + 4 * SECONDS_PER_MIX_CYCLE + wash_seconds()),
+	tips={'p10': 1})
 
 # Incubate at 4C, then heat shock.
-p10_single.delay(minutes=30)
-temp_deck.set_temperature(42)
-p10_single.delay(minutes=1)
-temp_deck.set_temperature(4)
-p10_single.delay(minutes=5)
-
-# Add lb.
-p300_multi.pick_up_tip()
-for i in range(0, num_cols):
-	p300_multi.transfer(150, lb.bottom(), reaction_plate.wells(48 + i * 8).bottom(1), mix_after=(2, 150), new_tip='never')
-	p300_multi.mix(2, 300, wash_0.bottom())
-	p300_multi.blow_out()
-	p300_multi.mix(2, 300, wash_1.bottom())
-	p300_multi.blow_out()
-p300_multi.drop_tip()
+add_step(
+	'cold_incubation',
+	lambda: None,
+	0,
+	hold=30)
+
+def heat_shock():
+	temp_deck.set_temperature(42)
+	p10_single.delay(minutes=1)
+	temp_deck.set_temperature(4)
+	p10_single.delay(minutes=5)
+
+add_step(
+	'heat_shock',
+	heat_shock,
+	6 * 60,
+	temperature=4)
+
+def add_lb():
+	p300_multi.pick_up_tip()
+	for i in range(0, num_cols):
+		p300_multi.transfer(150, lb.bottom(), reaction_plate.wells(48 + i * 8).bottom(1), mix_after=(2, 150), new_tip='never')
+		p300_multi.mix(2, 300, wash_0.bottom())
+		p300_multi.blow_out()
+		p300_multi.mix(2, 300, wash_1.bottom())
+		p300_multi.blow_out()
+	p300_multi.drop_tip()
+
+add_step(
+	'add_lb',
+	add_lb,
+	SECONDS_PER_TIP + num_cols * (SECONDS_PER_TRANSFER + 2 * SECONDS_PER_MIX_CYCLE + wash_seconds()),
+	tips={'p300': 1})
 
 # Grow for 1 hr, adding water/mixing if necessary.
-temp_deck.set_temperature(37)
-p10_single.delay(minutes=60)
+def start_outgrowth():
+	temp_deck.set_temperature(37)
+
+add_step(
+	'outgrowth',
+	start_outgrowth,
+	0,
+	hold=60,
+	temperature=37)
 
 def spread_culture(source, dest, lb, dilute_after=True):
 	p300_multi.mix(2, 150, source.bottom(0.5))
@@ -249,15 +446,24 @@ def spread_culture(source, dest, lb, dilute_after=True):
 		p300_multi.blow_out()
 		p300_multi.transfer(120, lb, source.bottom(0.5), new_tip='never')
 
-# Dilute and plate.
-for i in range(0, num_cols):
-	agar_plate = agar_plates[i // 3]
-	agar_well_num = (i % 3) * 8 * 4
-	p300_multi.pick_up_tip()
-	source = reaction_plate.wells(48 + i * 8)
-	spread_culture(source, agar_plate.wells(agar_well_num), lb)
-	spread_culture(source, agar_plate.wells(agar_well_num + 8), lb)
-	spread_culture(source, agar_plate.wells(agar_well_num + 16), lb)
-	spread_culture(source, agar_plate.wells(agar_well_num + 24), lb, dilute_after=False)
-	p300_multi.drop_tip()
+def plate_cultures():
+	# Dilute and plate each column onto its spots in agar_layout.
+	for i in range(0, num_cols):
+		agar_plate = agar_plates[agar_layout[i]['plate']]
+		agar_wells = agar_layout[i]['wells']
+		p300_multi.pick_up_tip()
+		source = reaction_plate.wells(48 + i * 8)
+		for j, agar_well_num in enumerate(agar_wells):
+			spread_culture(source, agar_plate.wells(agar_well_num), lb, dilute_after=j < len(agar_wells) - 1)
+		p300_multi.drop_tip()
+
+num_spots = sum(len(x['wells']) for x in agar_layout[:num_cols])
 
+add_step(
+	'plate_cultures',
+	plate_cultures,
+	num_cols * SECONDS_PER_TIP + num_spots * (2 * SECONDS_PER_MIX_CYCLE + SECONDS_PER_TRANSFER) + (num_spots - num_cols) * (2 * SECONDS_PER_TRANSFER + wash_seconds()),
+	tips={'p300': num_cols})
+
+temp_deck.set_temperature(10)
+run_steps()
@@ -1,9 +1,16 @@
 import os
 import tkinter
 from tkinter import filedialog, messagebox
+import argparse
+import ast
 import csv
+import itertools
 import json
+import logging
+import math
+from collections import Counter
 import yaml
+from ot2_moclo_jove import deck_layout, incremental, instrumentation, resume_protocol
 
 #################################################################################################################
 # Constants
@@ -11,12 +18,33 @@ import yaml
 
 CONFIG_PATH = "data/settings.yaml"
 
+# Slots the template used to load labware into (the last one is used first) and the labware fixed in place. The
+# reaction plate sits on the temp deck.
+AVAILABLE_DECK_SLOTS = ['11', '8', '7', '5', '4', '2', '1']
+TEMP_DECK_SLOT = '10'
+TIPRACK_SLOTS = {'tiprack-10ul 0': '3', 'tiprack-10ul 1': '6', 'tiprack-200ul': '9'}
+REACTION_PLATE = 'Reaction plate'
+
+# Reactions go in the first half of the reaction plate (wells 0-47, numbered down each column) and are transformed in
+# the second half. Each column of 8 reactions is plated with the multichannel onto a column of agar per dilution spot
+# (see get_agar_layout).
+REACTION_WELLS = 48
+ROWS = 8
+
+# DNA plates suggested by the reformat (see get_dna_reformat) are 96 well plates filled down each column.
+DNA_PLATE_ROWS = 8
+DNA_PLATE_COLUMNS = 12
+
+logger = logging.getLogger(__name__)
+
 
 #################################################################################################################
 # Main function of script
 #################################################################################################################
 
 def main():
+	args = parse_args()
+	write_trace = instrumentation.start_from_arguments('moclo_transform', args)
 
 	###### GETTING USER INPUT ######
 	config = get_config(CONFIG_PATH)
@@ -24,20 +52,86 @@ def main():
 	combinations_filename = ask_combinations_filename()
 
 	# Load in CSV files as a dict containing lists of lists.
-	dna_plate_map_dict = generate_plate_maps(dna_plate_map_filenames)
-	combinations_to_make = generate_combinations(combinations_filename)
+	with instrumentation.stage('read_inputs'):
+		dna_plate_map_dict = generate_plate_maps(dna_plate_map_filenames)
+		combinations_to_make = generate_combinations(combinations_filename)
+
+	run(config, dna_plate_map_dict, combinations_to_make)
+
+	instrumentation.finish(config['output_folder_path'] if write_trace else None)
+
+# Writes the output (agar) plate maps and protocol for already loaded plate maps and combinations. Returns the output
+# plate maps (see generate_output_plate_maps).
+# Outputs whose inputs haven't changed since the last run are not rewritten (see incremental.py).
+def run(config, dna_plate_map_dict, combinations_to_make):
+	instrumentation.count('combinations', len(combinations_to_make))
+	output_folder_path = config['output_folder_path']
+	manifest = incremental.load_manifest(output_folder_path, 'moclo_transform', config['incremental'])
 
-	# Generate and save output plate maps.
-	generate_and_save_output_plate_maps(combinations_to_make, config['output_folder_path'])
+	# Choose a reaction well for each combination so that combinations sharing parts share columns.
+	with instrumentation.stage('reaction_layout'):
+		reaction_wells = incremental.get_value(
+			manifest,
+			'reaction_wells',
+			[combinations_to_make, config['optimize_reaction_layout']],
+			lambda: get_reaction_wells(combinations_to_make, config['optimize_reaction_layout']))
+
+		# Suggest a DNA plate with the parts in the order they are used.
+		if config['suggest_dna_reformat']:
+			reformat_plate_maps, reformat_transfers = get_dna_reformat(dna_plate_map_dict, combinations_to_make, reaction_wells)
+			incremental.build(
+				manifest,
+				[os.path.join(output_folder_path, 'dna_reformat_transfers.csv')] + [os.path.join(output_folder_path, '{0}.csv'.format(x)) for x in reformat_plate_maps],
+				[reformat_plate_maps, reformat_transfers],
+				lambda: save_dna_reformat(reformat_plate_maps, reformat_transfers, output_folder_path))
+
+	# Pack the plating of each reaction column onto as few agar plates as fit on the deck, then generate and save their
+	# plate maps.
+	with instrumentation.stage('output_plate_maps'):
+		agar_layout = get_agar_layout(
+			len(combinations_to_make),
+			config['spots_per_reaction'],
+			config['agar_plate_columns'],
+			get_max_agar_plates(dna_plate_map_dict))
+		output_plate_maps = generate_output_plate_maps(combinations_to_make, reaction_wells, agar_layout)
+		for plate in output_plate_maps:
+			incremental.build(
+				manifest,
+				[os.path.join(output_folder_path, "{0}.csv".format(plate['name']))],
+				plate,
+				lambda: save_output_plate_maps([plate], output_folder_path))
+
+	# Place labware on the deck so that labware often moved between is close together.
+	with instrumentation.stage('deck_layout'):
+		layout, travel_comment = incremental.get_value(
+			manifest,
+			'deck_layout',
+			[dna_plate_map_dict, combinations_to_make, agar_layout, config['optimize_deck_layout']],
+			lambda: get_deck_layout(dna_plate_map_dict, combinations_to_make, agar_layout, config['optimize_deck_layout']))
+		slot_map_filename = os.path.join(output_folder_path, 'moclo_transform_deck_layout.csv')
+		incremental.build(manifest, [slot_map_filename], layout, lambda: deck_layout.write_slot_map(layout, slot_map_filename))
 
 	# Create a protocol file and hard code the plate maps into it.
-	create_protocol(dna_plate_map_dict, combinations_to_make, config['protocol_template_path'], config['output_folder_path'])
+	with instrumentation.stage('protocol'):
+		incremental.build(
+			manifest,
+			[os.path.join(output_folder_path, 'moclo_transform_protocol.py'), os.path.join(output_folder_path, 'moclo_transform_protocol_steps.json')],
+			[dna_plate_map_dict, combinations_to_make, reaction_wells, agar_layout, layout, travel_comment, config['step_markers'], config['step_log_filename'], incremental.get_file_hash(config['protocol_template_path'])],
+			lambda: create_protocol(dna_plate_map_dict, combinations_to_make, reaction_wells, agar_layout, layout, travel_comment, config['protocol_template_path'], output_folder_path, config['step_markers'], config['step_log_filename']))
+
+	incremental.save_manifest(manifest)
+	return output_plate_maps
 
 
 #################################################################################################################
 # Functions for getting user input
 #################################################################################################################
 
+def parse_args():
+	parser = argparse.ArgumentParser(description='Generates an OT2 MoClo assembly and transformation protocol.')
+	instrumentation.add_arguments(parser)
+	return parser.parse_args()
+
 def get_config(config_path):
 	# Load settings from file.
 	config = yaml.safe_load(open(config_path))
@@ -92,60 +186,316 @@ def generate_combinations(combinations_filename):
 					"name": row[0],
 					"parts": [x for x in row[1:] if x]
 				})
-	print("combinations_to_make", combinations_to_make)
+	logger.debug("combinations_to_make: %s", combinations_to_make)
 	return combinations_to_make
 
 
+#################################################################################################################
+# Functions for laying out reactions
+#################################################################################################################
+
+# Number of (part, reaction plate column) pairs in a layout (a list of columns, each a list of combinations). Each
+# part is dispensed into its combinations one after another, so the fewer columns a part is spread over, the shorter
+# the moves between dispenses, and the more a column's reactions look alike.
+def get_part_columns(columns):
+	return sum(len(set(part for combo in column for part in combo['parts'])) for column in columns)
+
+# Returns the reaction well (0-47, numbered down each column) for each combination. If optimize is True combinations
+# that share parts are put in the same column: each column is started with the combination sharing the most parts with
+# the combinations left, and filled with those sharing the most parts with the column so far. Pairs of combinations
+# in different columns are then swapped while that spreads parts over fewer columns. The columns used (and so the
+# competent cells, agar plates and their maps) are the same as in CSV order, where combination i is in well i. Only the
+# order of the wells changes: parts are still added with the P10 single channel, in the same aspirate cycles and washes.
+def get_reaction_wells(combinations_to_make, optimize=True):
+	if not optimize or len(combinations_to_make) > REACTION_WELLS:
+		return list(range(0, len(combinations_to_make)))
+
+	indices = list(range(0, len(combinations_to_make)))
+	part_counts = Counter(part for combo in combinations_to_make for part in set(combo['parts']))
+	columns = []
+	while indices:
+		# Ties go to the combination earliest in the CSV, so the layout doesn't depend on anything but the inputs.
+		seed = max(indices, key=lambda i: (sum(part_counts[x] for x in set(combinations_to_make[i]['parts'])), -i))
+		column = [seed]
+		indices.remove(seed)
+		column_parts = set(combinations_to_make[seed]['parts'])
+		while indices and len(column) < ROWS:
+			best = max(indices, key=lambda i: (len(column_parts & set(combinations_to_make[i]['parts'])), -i))
+			column.append(best)
+			indices.remove(best)
+			column_parts |= set(combinations_to_make[best]['parts'])
+		columns.append(column)
+
+	# Improve by swapping pairs of combinations between columns. Only the two columns involved change, so only they
+	# are counted.
+	def get_cost(*columns):
+		return get_part_columns([[combinations_to_make[i] for i in column] for column in columns])
+
+	improved = True
+	while improved:
+		improved = False
+		for a, b in itertools.combinations(range(0, len(columns)), 2):
+			cost = get_cost(columns[a], columns[b])
+			for i, j in itertools.product(range(0, len(columns[a])), range(0, len(columns[b]))):
+				columns[a][i], columns[b][j] = columns[b][j], columns[a][i]
+				if get_cost(columns[a], columns[b]) < cost:
+					improved = True
+					break
+				columns[a][i], columns[b][j] = columns[b][j], columns[a][i]
+			if improved:
+				break
+
+	reaction_wells = [0] * len(combinations_to_make)
+	for column_index, column in enumerate(columns):
+		for row, i in enumerate(column):
+			reaction_wells[i] = column_index * ROWS + row
+
+	csv_order_cost = get_part_columns([combinations_to_make[i:i + ROWS] for i in range(0, len(combinations_to_make), ROWS)])
+	logger.info('Reaction layout: parts spread over %d column(s) (%d in CSV order).', get_cost(*columns), csv_order_cost)
+	return reaction_wells
+
+# Name (e.g. A1) of well i of a plate, numbered down each column.
+def get_well_name(i, rows=ROWS):
+	return 'ABCDEFGHIJKLMNOP'[i % rows] + str(i // rows + 1)
+
+# Suggests moving the parts that are used onto new DNA plates, in the order they are first used when going down the
+# reaction plate, so the parts of each column of reactions sit together (and in a plate map that can be used for the
+# next run). Returns the new plate maps (keyed by plate name, as lists of rows) and the transfers to make, as rows of
+# part, source plate, source well, destination plate and destination well. Parts not found on any DNA plate are left out.
+def get_dna_reformat(dna_plate_map_dict, combinations_to_make, reaction_wells):
+	sources = {}
+	for plate_name, plate_map in dna_plate_map_dict.items():
+		for i, row in enumerate(plate_map):
+			for j, part in enumerate(row):
+				if part and not part in sources:
+					sources[part] = (plate_name, get_well_name(j * DNA_PLATE_ROWS + i, DNA_PLATE_ROWS))
+
+	parts = []
+	for well, combo in sorted(zip(reaction_wells, combinations_to_make), key=lambda x: x[0]):
+		for part in combo['parts']:
+			if part in sources and not part in parts:
+				parts.append(part)
+
+	plate_size = DNA_PLATE_ROWS * DNA_PLATE_COLUMNS
+	reformat_plate_maps = {}
+	transfers = [['Part', 'Source plate', 'Source well', 'Destination plate', 'Destination well']]
+	for i, part in enumerate(parts):
+		plate_name = 'DNA_reformat_{0}'.format(i // plate_size)
+		plate_map = reformat_plate_maps.setdefault(plate_name, [[''] * DNA_PLATE_COLUMNS for row in range(0, DNA_PLATE_ROWS)])
+		well = i % plate_size
+		plate_map[well % DNA_PLATE_ROWS][well // DNA_PLATE_ROWS] = part
+		transfers.append([part, sources[part][0], sources[part][1], plate_name, get_well_name(well, DNA_PLATE_ROWS)])
+	return reformat_plate_maps, transfers
+
+def save_dna_reformat(reformat_plate_maps, transfers, output_folder_path):
+	for plate_name, plate_map in reformat_plate_maps.items():
+		filename = os.path.join(output_folder_path, '{0}.csv'.format(plate_name))
+		with open(filename, 'w+', newline='') as f:
+			csv.writer(f).writerows(plate_map)
+		instrumentation.count_bytes_written(filename)
+
+	filename = os.path.join(output_folder_path, 'dna_reformat_transfers.csv')
+	with open(filename, 'w+', newline='') as f:
+		csv.writer(f).writerows(transfers)
+	instrumentation.count_bytes_written(filename)
+
+
+# Returns the number of agar plates that fit on the deck next to the rest of the labware (see get_deck_labware_names).
+def get_max_agar_plates(dna_plate_map_dict):
+	return len(AVAILABLE_DECK_SLOTS) - len(get_deck_labware_names(dna_plate_map_dict, 0))
+
+# Packs the plating of num_rxns reactions onto as few agar plates (8 rows by agar_plate_columns columns) as possible.
+# The multichannel plates a whole reaction column at a time, diluting it between spots, so each reaction column takes
+# spots_per_reaction whole columns of one agar plate, next to each other. Plates are filled in order, so only the last
+# one can be partly used. Returns the agar layout: for each reaction column, a dict with the agar 'plate' index, its
+# 'position' on the plate (the column of the plate map it is in) and the agar 'wells' (numbered down each column) to
+# spot it onto, in dilution order. Raises a ValueError if a reaction doesn't fit on a plate or more than max_plates
+# plates are needed.
+def get_agar_layout(num_rxns, spots_per_reaction=4, agar_plate_columns=12, max_plates=None):
+	per_plate = agar_plate_columns // spots_per_reaction
+	if per_plate < 1:
+		raise ValueError('{0} spots per reaction do not fit on an agar plate of {1} columns.'.format(spots_per_reaction, agar_plate_columns))
+
+	num_cols = math.ceil(num_rxns / ROWS)
+	num_plates = math.ceil(num_cols / per_plate)
+	if max_plates is not None and num_plates > max_plates:
+		raise ValueError('{0} reactions at {1} spots each need {2} agar plates, but only {3} fit on the deck. Plate fewer spots per reaction or split the run.'.format(
+			num_rxns, spots_per_reaction, num_plates, max_plates))
+
+	agar_layout = []
+	for i in range(0, num_cols):
+		plate, position = divmod(i, per_plate)
+		first_column = position * spots_per_reaction
+		agar_layout.append({
+			'plate': plate,
+			'position': position,
+			'wells': [(first_column + j) * ROWS for j in range(0, spots_per_reaction)]})
+	logger.info('Agar layout: %d reaction column(s) on %d agar plate(s), %d per plate.', num_cols, num_plates, per_plate)
+	return agar_layout
+
+# Number of agar plates used by an agar layout (see get_agar_layout).
+def get_num_agar_plates(agar_layout):
+	return max([x['plate'] + 1 for x in agar_layout] + [0])
+
+
 #################################################################################################################
 # Functions for creating output files
 #################################################################################################################
 
-def generate_and_save_output_plate_maps(combinations_to_make, output_folder_path):
-	# Split combinations_to_make into 8x3 plate maps.
-	output_plate_maps_flipped = []
-	for i, combo in enumerate(combinations_to_make):
-		name = combo["name"]
-		if i % 24 == 0:
-			# new plate
-			output_plate_maps_flipped.append([[name]])
-		elif i % 8 == 0:
-			# new column
-			output_plate_maps_flipped[-1].append([name])
-		else:
-			output_plate_maps_flipped[-1][-1].append(name)
-	print("output_plate_maps_flipped", output_plate_maps_flipped)
-	# Correct row/column flip.
+# Splits combinations_to_make into plate maps, one per agar plate, placing each combination where the reaction in
+# reaction_wells (see get_reaction_wells) is plated according to agar_layout (see get_agar_layout). Each plate map has
+# a column per reaction column on the plate. Positions without a reaction are left blank. Returns a list of dicts with
+# the plate 'name' (e.g. Agar_plate_0) and the 'map' as a list of rows.
+def generate_output_plate_maps(combinations_to_make, reaction_wells=None, agar_layout=None):
+	if reaction_wells is None:
+		reaction_wells = list(range(0, len(combinations_to_make)))
+	if agar_layout is None:
+		agar_layout = get_agar_layout(max([x + 1 for x in reaction_wells] + [0]))
+
 	output_plate_maps = []
-	for plate in output_plate_maps_flipped:
-		corrected_plate = []
-		for i, row in enumerate(plate):
-			for j, element in enumerate(row):
-				if j >= len(corrected_plate):
-					corrected_plate.append([element])
-				else:
-					corrected_plate[j].append(element)
-		output_plate_maps.append(corrected_plate)
-	print("output_plate_maps", output_plate_maps)
-	for i, plate in enumerate(output_plate_maps):
-		output_filename = os.path.join(output_folder_path, "Agar_plate_{0}.csv".format(i))
+	for combo, well in zip(combinations_to_make, reaction_wells):
+		plate_index = agar_layout[well // ROWS]['plate']
+		row = well % ROWS
+		column = agar_layout[well // ROWS]['position']
+		while len(output_plate_maps) <= plate_index:
+			output_plate_maps.append({'name': 'Agar_plate_{0}'.format(len(output_plate_maps)), 'map': []})
+		plate_map = output_plate_maps[plate_index]['map']
+		while len(plate_map) <= row:
+			plate_map.append([])
+		plate_map[row] += [''] * (column + 1 - len(plate_map[row]))
+		plate_map[row][column] = combo["name"]
+	logger.debug("output_plate_maps: %s", output_plate_maps)
+	return output_plate_maps
+
+def save_output_plate_maps(output_plate_maps, output_folder_path):
+	for plate in output_plate_maps:
+		output_filename = os.path.join(output_folder_path, "{0}.csv".format(plate['name']))
 		with open(output_filename, 'w+', newline='') as f:
 			writer = csv.writer(f)
-			print(plate)
-			writer.writerows(plate)
+			writer.writerows(plate['map'])
+		instrumentation.count('plate_maps')
+		instrumentation.count_bytes_written(output_filename)
+
+# Names (as labelled in the protocol) of the labware to place on the deck, in the order the template used to load them.
+def get_deck_labware_names(dna_plate_map_dict, num_agar_plates):
+	return (['Reagent plate', 'Reagent trough']
+		+ list(dna_plate_map_dict.keys())
+		+ ['Competent cells']
+		+ ['Agar plate {0}'.format(i) for i in range(0, num_agar_plates)])
+
+# Estimates how often the pipettes move between each pair of labware in the protocol (see deck_layout.add_path). Tips
+# are all counted against the first rack of each size.
+def get_deck_moves(dna_plate_map_dict, combinations_to_make, agar_layout):
+	moves = Counter()
+	num_rxns = len(combinations_to_make)
+	num_cols = math.ceil(num_rxns / 8.0)
+	tips_10 = 'tiprack-10ul 0'
+	tips_300 = 'tiprack-200ul'
+	trough = 'Reagent trough'
+	trash = deck_layout.TRASH
+
+	# Master mix: water from the trough and enzymes/buffer from the reagent plate.
+	num_mm_wells = math.ceil(num_rxns * 10 / 190.0)
+	mm_to_make = 10 * num_rxns + 10 * num_mm_wells
+	deck_layout.add_path(moves, [tips_10, trough])
+	while mm_to_make > 0:
+		vol = min(mm_to_make, 200)
+		mm_to_make -= vol
+		deck_layout.add_path(moves, [trough, REACTION_PLATE], 2 * math.ceil(0.65 * vol / 10))
+		deck_layout.add_path(moves, ['Reagent plate', REACTION_PLATE], 6)
+	deck_layout.add_path(moves, [REACTION_PLATE, trash])
+	deck_layout.add_path(moves, [tips_10, REACTION_PLATE, trash])
 
-def create_protocol(dna_plate_map_dict, combinations_to_make, protocol_template_path, output_folder_path):
+	# Parts, in chunks of 5 wells with a wash in the trough between chunks.
+	for combination in combinations_to_make:
+		for part in combination['parts']:
+			plate_name = next((name for name, plate_map in dna_plate_map_dict.items() if any(part in row for row in plate_map)), None)
+			if plate_name:
+				deck_layout.add_path(moves, [tips_10, plate_name, REACTION_PLATE, trash], 1 / 5.0)
+				deck_layout.add_path(moves, [REACTION_PLATE, trough, plate_name], 1 / 5.0)
+
+	# Water, water top-up and reactions into cells, with a wash after each reaction.
+	for i in range(0, 3):
+		deck_layout.add_path(moves, [tips_10, trough])
+		deck_layout.add_path(moves, [trough, REACTION_PLATE], 2 * num_rxns)
+		deck_layout.add_path(moves, [trough, trash])
+
+	# Competent cells, LB and plating with the multichannel.
+	deck_layout.add_path(moves, [tips_300, 'Competent cells', REACTION_PLATE, trash])
+	deck_layout.add_path(moves, [tips_300, trough, trash])
+	deck_layout.add_path(moves, [trough, REACTION_PLATE], 2 * num_cols)
+	for column in agar_layout:
+		agar_plate = 'Agar plate {0}'.format(column['plate'])
+		num_spots = len(column['wells'])
+		deck_layout.add_path(moves, [tips_300, REACTION_PLATE])
+		deck_layout.add_path(moves, [REACTION_PLATE, agar_plate], 2 * num_spots - 1)
+		deck_layout.add_path(moves, [REACTION_PLATE, trough], 2 * (num_spots - 1))
+		deck_layout.add_path(moves, [agar_plate, trash])
+	return moves
+
+# Returns the layout (a dict of labware name to slot) to paste into the protocol and a comment with its estimated
+# travel. If optimize is False the slots are assigned in load order, as the template used to.
+def get_deck_layout(dna_plate_map_dict, combinations_to_make, agar_layout, optimize=True):
+	labware_names = get_deck_labware_names(dna_plate_map_dict, get_num_agar_plates(agar_layout))
+	moves = get_deck_moves(dna_plate_map_dict, combinations_to_make, agar_layout)
+
+	default_fixed_slots = dict(TIPRACK_SLOTS, **{REACTION_PLATE: TEMP_DECK_SLOT})
+	default_layout = deck_layout.get_load_order_layout(labware_names, AVAILABLE_DECK_SLOTS, default_fixed_slots)
+	if not optimize:
+		return default_layout, deck_layout.get_travel_comment(default_layout, default_layout, moves)
+
+	# The tip racks can go anywhere but the temp deck.
+	available_slots = AVAILABLE_DECK_SLOTS + list(TIPRACK_SLOTS.values())
+	layout = deck_layout.solve_layout(labware_names + list(TIPRACK_SLOTS), moves, available_slots, {REACTION_PLATE: TEMP_DECK_SLOT})
+	travel_comment = deck_layout.get_travel_comment(layout, default_layout, moves)
+	logger.info(travel_comment[2:].strip())
+	return layout, travel_comment
+
+def create_protocol(dna_plate_map_dict, combinations_to_make, reaction_wells, agar_layout, layout, travel_comment, protocol_template_path, output_folder_path, step_markers=False, step_log_filename=None):
 	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
 	with open(protocol_template_path) as template_file:
 		template_string = template_file.read()
 
-	with open(output_folder_path + '/' + 'moclo_transform_protocol.py', "w+") as protocol_file:
+	protocol_filename = output_folder_path + '/' + 'moclo_transform_protocol.py'
+	with open(protocol_filename, "w+") as protocol_file:
 		# Paste in plate maps at top of file.
 		protocol_file.write('dna_plate_map_dict = ' + json.dumps(dna_plate_map_dict) + '\n\n')
 
 		protocol_file.write('combinations_to_make = ' + json.dumps(combinations_to_make) + '\n\n')
 
+		# Paste in the reaction well of each combination (see get_reaction_wells).
+		protocol_file.write('reaction_wells = ' + json.dumps(reaction_wells) + '\n\n')
+
+		# Paste in the agar plate and wells each reaction column is plated onto (see get_agar_layout).
+		protocol_file.write('agar_layout = ' + json.dumps(agar_layout) + '\n\n')
+
+		# Paste in the slot of each piece of labware.
+		protocol_file.write(travel_comment)
+		protocol_file.write('deck_layout = ' + json.dumps(layout) + '\n\n')
+
+		# Paste in whether to log the start and end of each step (see run_timing.py).
+		protocol_file.write('step_markers = {0!r}\n'.format(bool(step_markers)))
+		protocol_file.write('step_log_filename = {0!r}\n\n'.format(step_log_filename or None))
+
+		# Paste in where to resume a stopped run from (set by resume_protocol.py).
+		protocol_file.write('resume_from = None\n\n')
+
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	instrumentation.count_bytes_written(protocol_filename)
+
+	# The steps run in the order they are added (see run_steps in the template).
+	resume_protocol.save_step_manifest(protocol_filename, [{'name': x, 'index': i} for i, x in enumerate(get_template_step_names(template_string))])
+
+# Returns the names of the steps added (with add_step) at the top level of a protocol template, in the order they are
+# added.
+def get_template_step_names(template_string):
+	step_names = []
+	for statement in ast.parse(template_string).body:
+		call = getattr(statement, 'value', None)
+		if isinstance(call, ast.Call) and getattr(call.func, 'id', None) == 'add_step' and isinstance(call.args[0], ast.Constant):
+			step_names.append(call.args[0].value)
+	return step_names
 
 
 #################################################################################################################
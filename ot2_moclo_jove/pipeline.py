@@ -0,0 +1,208 @@
+import os
+import re
+import csv
+import argparse
+import yaml
+from ot2_moclo_jove import instrumentation
+from ot2_moclo_jove.moclo_transform import moclo_transform_generator
+from ot2_moclo_jove.colony_picking import colony_pick_generator
+from ot2_moclo_jove.miniprep import miniprep_generator
+
+
+#################################################################################################################
+# Main function of script
+#################################################################################################################
+
+# Runs MoClo/transformation -> colony picking -> miniprep protocol generation in one go, handing the plate maps from
+# each stage to the next in memory. The CSV files each generator writes are side outputs only, so there is no need to
+# re-select Agar_plate_N.csv or culture_block_N.csv files between stages. A run can also start at a later stage, from
+# the plate maps an earlier run saved to the output folder.
+def main():
+	args = parse_args()
+	write_trace = instrumentation.start_from_arguments('pipeline', args)
+
+	stages = get_stages(args.output_folder, args.image_folder)
+	if args.start and args.start != stages[0]['name']:
+		previous_stage = stages[[stage['name'] for stage in stages].index(args.start) - 1]
+		artefacts = previous_stage['load'](args.output_folder)
+	else:
+		artefacts = {
+			'dna_plate_map_dict': moclo_transform_generator.generate_plate_maps(args.dna_plate_maps),
+			'combinations_to_make': moclo_transform_generator.generate_combinations(args.combinations)
+		}
+	run_pipeline(artefacts, stages, args.until, args.start)
+
+	instrumentation.finish(args.output_folder if write_trace else None)
+
+
+#################################################################################################################
+# Functions for getting user input
+#################################################################################################################
+
+def parse_args():
+	stage_names = [stage['name'] for stage in get_stages(None)]
+	parser = argparse.ArgumentParser(description='Generates the MoClo/transformation, colony picking and miniprep protocols in one run.')
+	parser.add_argument('--dna-plate-maps', nargs='+', help='CSV plate maps of the DNA parts (needed to run moclo_transform).')
+	parser.add_argument('--combinations', help='CSV file of the combinations of parts to assemble (needed to run moclo_transform).')
+	parser.add_argument('--output-folder', required=True, help='Folder to save all protocols and plate maps to.')
+	parser.add_argument('--from', dest='start', choices=stage_names, help='First stage to run, using the plate maps an earlier run saved to the output folder (default: the first stage).')
+	parser.add_argument('--until', choices=stage_names, help='Last stage to run (default: all stages).')
+	parser.add_argument('--image-folder', help='Folder of photos of the agar plates to pick colonies from, in place of image_folder_path in the colony picking settings.yaml.')
+	instrumentation.add_arguments(parser)
+	args = parser.parse_args()
+
+	first = stage_names.index(args.start) if args.start else 0
+	last = stage_names.index(args.until) if args.until else len(stage_names) - 1
+	if first > last:
+		parser.error('--from {0} comes after --until {1}.'.format(args.start, args.until))
+	stages_to_run = stage_names[first:last + 1]
+	if 'moclo_transform' in stages_to_run and not (args.dna_plate_maps and args.combinations):
+		parser.error('--dna-plate-maps and --combinations are needed to run moclo_transform.')
+	# The agar plates made by moclo_transform can't have been grown and photographed yet, so whatever is in the image
+	# folder would be paired with the wrong plate maps.
+	if 'moclo_transform' in stages_to_run and 'colony_picking' in stages_to_run and not args.image_folder:
+		parser.error('colony_picking needs photos of the agar plates moclo_transform is about to make. Run with --until moclo_transform, then with --from colony_picking once the plates have grown and been photographed, or pass their photos with --image-folder.')
+	return args
+
+# Loads the settings.yaml of a generator module. Relative paths in it are relative to the generator's folder (which is
+# where the generators themselves are run from).
+def load_stage_config(generator, output_folder_path):
+	folder = os.path.dirname(os.path.abspath(generator.__file__))
+	with open(os.path.join(folder, generator.CONFIG_PATH)) as config_file:
+		config = yaml.safe_load(config_file)
+
+	for key, value in config.items():
+		if key.endswith('_path') and isinstance(value, str) and not os.path.isabs(value):
+			config[key] = os.path.join(folder, value)
+	config['output_folder_path'] = output_folder_path
+
+	return config
+
+
+#################################################################################################################
+# Pipeline stages
+#################################################################################################################
+
+# Types of the artefacts handed between stages. Plate maps are lists of rows, either in a dict with their 'name' (agar
+# plates) or 'culture_block_name' (culture blocks), or keyed by plate name (DNA plates).
+ARTEFACT_TYPES = {
+	'dna_plate_map_dict': dict,
+	'combinations_to_make': list,
+	'agar_plate_maps': list,
+	'culture_blocks_dict': dict,
+	'plasmid_plate_maps': list
+}
+
+# Finds the plate maps an earlier run saved to output_folder_path as <prefix><i>.csv, in order of i.
+def get_saved_plate_map_filenames(output_folder_path, prefix):
+	pattern = re.compile(r'^{0}(\d+)\.csv$'.format(re.escape(prefix)))
+	numbered_filenames = []
+	for filename in os.listdir(output_folder_path):
+		match = pattern.match(filename)
+		if match:
+			numbered_filenames.append((int(match.group(1)), os.path.join(output_folder_path, filename)))
+	if not numbered_filenames:
+		raise ValueError('No {0}N.csv plate maps in {1}. Run the earlier stages first.'.format(prefix, output_folder_path))
+	return [filename for i, filename in sorted(numbered_filenames)]
+
+def load_agar_plate_maps(output_folder_path):
+	filenames = get_saved_plate_map_filenames(output_folder_path, 'Agar_plate_')
+	return {'agar_plate_maps': colony_pick_generator.load_source_plate_maps(filenames)}
+
+# Culture block maps only save the name of the plasmid in each well, which is all the miniprep needs.
+def load_culture_blocks(output_folder_path):
+	culture_blocks_dict = {}
+	for filename in get_saved_plate_map_filenames(output_folder_path, 'culture_block_'):
+		with open(filename, newline='', encoding='utf-8-sig') as csvfile:
+			block_name = os.path.splitext(os.path.basename(filename))[0]
+			culture_blocks_dict[block_name] = [[{'name': name} for name in row] for row in csv.reader(csvfile)]
+	return {'culture_blocks_dict': culture_blocks_dict}
+
+def run_moclo_transform(config, dna_plate_map_dict, combinations_to_make):
+	return {'agar_plate_maps': moclo_transform_generator.run(config, dna_plate_map_dict, combinations_to_make)}
+
+def run_colony_picking(config, agar_plate_maps):
+	if not config['opencfu_folder_path']:
+		raise ValueError('opencfu_folder_path must be set in the colony picking settings.yaml to run the pipeline.')
+	return {'culture_blocks_dict': colony_pick_generator.run(config, agar_plate_maps)}
+
+def run_miniprep(config, culture_blocks_dict):
+	plate_maps = miniprep_generator.plate_maps_from_culture_blocks(culture_blocks_dict)
+	return {'plasmid_plate_maps': miniprep_generator.run(config, plate_maps)}
+
+# Returns the stages of the pipeline in the order they run, each with the artefacts it needs and produces, how to load
+# those outputs from the files a stage saved (for a run starting at a later stage) and any settings to override.
+def get_stages(output_folder_path, image_folder_path=None):
+	return [
+		{
+			'name': 'moclo_transform',
+			'generator': moclo_transform_generator,
+			'inputs': ['dna_plate_map_dict', 'combinations_to_make'],
+			'outputs': ['agar_plate_maps'],
+			'run': run_moclo_transform,
+			'load': load_agar_plate_maps,
+			'settings': {},
+			'output_folder_path': output_folder_path
+		},
+		{
+			'name': 'colony_picking',
+			'generator': colony_pick_generator,
+			'inputs': ['agar_plate_maps'],
+			'outputs': ['culture_blocks_dict'],
+			'run': run_colony_picking,
+			'load': load_culture_blocks,
+			'settings': {'image_folder_path': image_folder_path} if image_folder_path else {},
+			'output_folder_path': output_folder_path
+		},
+		{
+			'name': 'miniprep',
+			'generator': miniprep_generator,
+			'inputs': ['culture_blocks_dict'],
+			'outputs': ['plasmid_plate_maps'],
+			'run': run_miniprep,
+			'load': None,
+			'settings': {},
+			'output_folder_path': output_folder_path
+		}
+	]
+
+# Checks that an artefact handed between stages exists and has the expected type.
+def check_artefact(artefacts, name, stage_name):
+	if not name in artefacts:
+		raise ValueError('Stage {0} needs {1}, which no earlier stage produced.'.format(stage_name, name))
+	if not isinstance(artefacts[name], ARTEFACT_TYPES[name]):
+		raise TypeError('{0} should be a {1} but {2} got a {3}.'.format(name, ARTEFACT_TYPES[name].__name__, stage_name, type(artefacts[name]).__name__))
+
+# Runs the stages in order (starting at the stage named start and stopping after the stage named until, if given),
+# passing artefacts between them in memory. Returns all artefacts.
+def run_pipeline(artefacts, stages, until=None, start=None):
+	started = start is None
+	for stage in stages:
+		started = started or stage['name'] == start
+		if not started:
+			continue
+
+		for name in stage['inputs']:
+			check_artefact(artefacts, name, stage['name'])
+
+		config = load_stage_config(stage['generator'], stage['output_folder_path'])
+		config.update(stage['settings'])
+		with instrumentation.stage(stage['name']):
+			outputs = stage['run'](config, *[artefacts[name] for name in stage['inputs']])
+
+		for name in stage['outputs']:
+			artefacts[name] = outputs[name]
+			check_artefact(artefacts, name, stage['name'])
+
+		if stage['name'] == until:
+			break
+
+	return artefacts
+
+
+#################################################################################################################
+# Call main function
+#################################################################################################################
+
+if __name__ == '__main__':
+    main()
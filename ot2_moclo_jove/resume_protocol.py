@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import re
+import sys
+from ot2_moclo_jove import run_timing
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# The line the generators paste into each protocol to set where to resume from.
+RESUME_FROM_PATTERN = re.compile(r'^resume_from = .*$', re.MULTILINE)
+
+
+#################################################################################################################
+# Main function of script
+#################################################################################################################
+
+def main():
+	args = parse_args()
+	try:
+		steps = load_step_manifest(args.protocol_filename)['steps']
+	except FileNotFoundError:
+		sys.exit('No step manifest found for {0} (expected {1}). Was it made by a generator?'.format(args.protocol_filename, get_step_manifest_filename(args.protocol_filename)))
+
+	if args.step is not None:
+		resume_from = int(args.step) if args.step.isdigit() else args.step
+	else:
+		if args.log_filename == '-':
+			logged_steps = run_timing.parse_markers(sys.stdin)
+		else:
+			with open(args.log_filename, encoding='utf-8', errors='replace') as log_file:
+				logged_steps = run_timing.parse_markers(log_file)
+		try:
+			resume_from = get_resume_point(logged_steps, steps)
+		except ValueError as error:
+			sys.exit(str(error))
+
+	output_filename = args.output or '{0}_resumed{1}'.format(*os.path.splitext(args.protocol_filename))
+	write_resumed_protocol(args.protocol_filename, resume_from, output_filename)
+	print(describe_resume_point(resume_from, steps))
+	print('Saved {0}.'.format(output_filename))
+
+
+#################################################################################################################
+# Functions for getting user input
+#################################################################################################################
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Writes a copy of a generated protocol that resumes where a stopped run left off, read from the step markers in its run log (see run_timing.py).')
+	parser.add_argument('protocol_filename', help='Protocol that was run.')
+	parser.add_argument('log_filename', nargs='?', default='-', help='Run log (or step log file) of the stopped run, or - for stdin.')
+	parser.add_argument('--step', help='Step name or index to resume from, instead of reading it from the log.')
+	parser.add_argument('--output', help='Filename of the resumed protocol (by default the protocol filename with _resumed added).')
+	return parser.parse_args()
+
+
+#################################################################################################################
+# Functions for step manifests
+#################################################################################################################
+
+# Generators save a step manifest next to each protocol, listing the steps the protocol can resume from.
+def get_step_manifest_filename(protocol_filename):
+	return '{0}_steps.json'.format(os.path.splitext(protocol_filename)[0])
+
+# Saves the step manifest of a protocol. steps is a list of dicts, each with the step 'name' (as in its step markers)
+# and anything else worth knowing about it (e.g. the well and tip of a colony pick).
+def save_step_manifest(protocol_filename, steps):
+	with open(get_step_manifest_filename(protocol_filename), 'w') as manifest_file:
+		json.dump({'protocol': os.path.basename(protocol_filename), 'steps': steps}, manifest_file, indent=1)
+
+def load_step_manifest(protocol_filename):
+	with open(get_step_manifest_filename(protocol_filename)) as manifest_file:
+		return json.load(manifest_file)
+
+
+#################################################################################################################
+# Functions for finding the resume point
+#################################################################################################################
+
+# Returns the step to resume from given the steps logged by the stopped run (see run_timing.parse_markers) and the
+# steps in the protocol's manifest. This is the first step that started but never finished (so it is run again in
+# full), or if every step that started finished, the index of the next step in the order steps start. Steps that
+# finished in an earlier resumed run of the same protocol count as done.
+def get_resume_point(logged_steps, steps):
+	step_names = [x['name'] for x in steps]
+	unknown = [x['name'] for x in logged_steps if not x['name'] in step_names]
+	if unknown:
+		raise ValueError('The log has steps that are not in this protocol (e.g. {0}). Is it the log of another protocol?'.format(unknown[0]))
+
+	finished = set(x['name'] for x in logged_steps if not x['unfinished'])
+	for step in logged_steps:
+		if step['unfinished'] and not step['name'] in finished:
+			return step['name']
+
+	if len(finished) >= len(steps):
+		raise ValueError('Every step of this protocol finished, so there is nothing to resume.')
+	# Name the next step if the manifest knows the order steps start in.
+	next_steps = [x for x in steps if x.get('index') == len(finished)]
+	return next_steps[0]['name'] if next_steps else len(finished)
+
+def describe_resume_point(resume_from, steps):
+	matches = [x for x in steps if resume_from in (x['name'], x.get('index'))]
+	details = ', '.join('{0} {1}'.format(key, value) for key, value in sorted(matches[0].items()) if not key in ('name', 'index')) if matches else ''
+	return 'Resuming from {0}{1}.'.format(
+		resume_from if isinstance(resume_from, str) else 'step {0}'.format(resume_from),
+		' ({0})'.format(details) if details else '')
+
+# Writes a copy of protocol_filename set to resume from resume_from (a step name or index).
+def write_resumed_protocol(protocol_filename, resume_from, output_filename):
+	with open(protocol_filename) as protocol_file:
+		protocol = protocol_file.read()
+	if not RESUME_FROM_PATTERN.search(protocol):
+		sys.exit('{0} has no resume_from line. Generate it again to make it resumable.'.format(protocol_filename))
+	with open(output_filename, 'w') as output_file:
+		output_file.write(RESUME_FROM_PATTERN.sub(lambda x: 'resume_from = {0!r}'.format(resume_from), protocol, count=1))
+
+
+#################################################################################################################
+# Call main function
+#################################################################################################################
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,149 @@
+import argparse
+import re
+import sys
+
+
+#################################################################################################################
+# Constants
+#################################################################################################################
+
+# Step markers logged by the protocol templates: "STEP start|end <seconds since start> <estimated seconds or -> <step
+# name>". They are found anywhere in a line, so run logs copied from the OT2 app (or with timestamps or other prefixes
+# added) can be parsed as they are.
+MARKER_PATTERN = re.compile(r'STEP (start|end) (\d+(?:\.\d+)?) (\d+|-) (.+?)\s*$')
+
+
+#################################################################################################################
+# Main function of script
+#################################################################################################################
+
+def main():
+	args = parse_args()
+	if args.log_filename == '-':
+		steps = parse_markers(sys.stdin)
+	else:
+		with open(args.log_filename, encoding='utf-8', errors='replace') as log_file:
+			steps = parse_markers(log_file)
+
+	if not steps:
+		sys.exit('No step markers found in {0}. Was the protocol generated with step_markers set?'.format(args.log_filename))
+	print(format_report(steps, args.steps))
+
+
+#################################################################################################################
+# Functions for getting user input
+#################################################################################################################
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Turns the step markers in the run log of a generated protocol into a per-phase timing report, compared with the estimates made when the protocol was generated.')
+	parser.add_argument('log_filename', help='Run log (or step log file) to read, or - for stdin.')
+	parser.add_argument('--steps', action='store_true', help='List every step as well as the totals for each phase.')
+	return parser.parse_args()
+
+
+#################################################################################################################
+# Functions for parsing run logs
+#################################################################################################################
+
+# A step's phase is the first word of its name, so e.g. every "pick <i> <plasmid>" step is in the pick phase.
+def get_phase(step_name):
+	return step_name.split(' ')[0]
+
+# Returns the steps marked in lines, in the order they started. Each is a dict with the step 'name', its 'phase', its
+# 'start' and 'end' in seconds since the protocol started and its 'estimate' in seconds (None if not estimated). Steps
+# that never ended (e.g. the run was stopped) end at the last marker and are flagged 'unfinished'.
+def parse_markers(lines):
+	steps = []
+	open_steps = {}
+	last_time = 0.0
+	for line in lines:
+		match = MARKER_PATTERN.search(line)
+		if not match:
+			continue
+		event, seconds, estimate, name = match.groups()
+		last_time = max(last_time, float(seconds))
+		if event == 'start':
+			step = {
+				'name': name,
+				'phase': get_phase(name),
+				'start': float(seconds),
+				'end': None,
+				'estimate': None if estimate == '-' else float(estimate),
+				'unfinished': False
+			}
+			steps.append(step)
+			open_steps.setdefault(name, []).append(step)
+		elif open_steps.get(name):
+			open_steps[name].pop()['end'] = float(seconds)
+
+	for step in steps:
+		if step['end'] is None:
+			step['end'] = last_time
+			step['unfinished'] = True
+	return steps
+
+# Returns the number of steps, actual seconds and estimated seconds of each phase, in the order the phases started.
+# Phases where any step wasn't estimated have no estimate.
+def get_phase_totals(steps):
+	phases = {}
+	for step in steps:
+		phase = phases.setdefault(step['phase'], {'steps': 0, 'actual': 0.0, 'estimate': 0.0})
+		phase['steps'] += 1
+		phase['actual'] += step['end'] - step['start']
+		if step['estimate'] is None or phase['estimate'] is None:
+			phase['estimate'] = None
+		else:
+			phase['estimate'] += step['estimate']
+	return phases
+
+
+#################################################################################################################
+# Functions for reporting
+#################################################################################################################
+
+def format_minutes(seconds):
+	return '-' if seconds is None else '{0:.1f}'.format(seconds / 60)
+
+def format_difference(actual, estimate):
+	if estimate is None:
+		return '-'
+	return '{0:+.1f}'.format((actual - estimate) / 60)
+
+def format_report(steps, list_steps=False):
+	lines = ['{0:<30} {1:>6} {2:>12} {3:>12} {4:>12}'.format('Phase', 'Steps', 'Actual (min)', 'Est. (min)', 'Diff (min)')]
+	for name, phase in get_phase_totals(steps).items():
+		lines.append('{0:<30} {1:>6} {2:>12} {3:>12} {4:>12}'.format(
+			name,
+			phase['steps'],
+			format_minutes(phase['actual']),
+			format_minutes(phase['estimate']),
+			format_difference(phase['actual'], phase['estimate'])))
+
+	# The run time is taken from the first and last markers, so time between steps is counted too.
+	run_seconds = max(x['end'] for x in steps) - min(x['start'] for x in steps)
+	lines.append('Run time: {0} min'.format(format_minutes(run_seconds)))
+
+	unfinished = [x['name'] for x in steps if x['unfinished']]
+	if unfinished:
+		lines.append('Unfinished: {0}'.format(', '.join(unfinished)))
+
+	if list_steps:
+		lines.append('')
+		lines.append('{0:<30} {1:>12} {2:>12} {3:>12} {4:>12}'.format('Step', 'Start (min)', 'Actual (min)', 'Est. (min)', 'Diff (min)'))
+		for step in steps:
+			lines.append('{0:<30} {1:>12} {2:>12} {3:>12} {4:>12}'.format(
+				step['name'],
+				format_minutes(step['start']),
+				format_minutes(step['end'] - step['start']),
+				format_minutes(step['estimate']),
+				format_difference(step['end'] - step['start'], step['estimate'])))
+
+	return '\n'.join(lines)
+
+
+#################################################################################################################
+# Call main function
+#################################################################################################################
+
+if __name__ == '__main__':
+	main()
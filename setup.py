@@ -7,7 +7,7 @@ setup(name='ot2_moclo_jove',
       author='Nick Emery',
       author_email='emernic@bu.edu',
       license='MIT',
-      packages=['ot2_moclo_jove'],
+      packages=['ot2_moclo_jove', 'ot2_moclo_jove.colony_picking', 'ot2_moclo_jove.miniprep', 'ot2_moclo_jove.moclo_transform'],
       install_requires=[
           'pyyaml',
           'Pillow'